@@ -0,0 +1,10 @@
+"""The number of steps of the Collatz sequence from n to 1."""
+n = 7
+steps = 0
+
+while n > 1:
+    if n % 2 == 0:
+        n = n//2
+    else:
+        n = 3*n+1
+    steps += 1
@@ -0,0 +1,7 @@
+"""The sum of the decimal digits of n."""
+n = 4321
+sum = 0
+
+while n > 0:
+    sum += n % 10
+    n = n//10
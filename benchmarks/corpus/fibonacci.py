@@ -0,0 +1,10 @@
+"""The n-th Fibonacci number."""
+n = 20
+a = 0
+b = 1
+t = 0
+
+for _ in range(n):
+    t = a+b
+    a = b
+    b = t
@@ -0,0 +1,9 @@
+"""Greatest common divisor by repeated subtraction."""
+a = 1071
+b = 462
+
+while a != b:
+    if a > b:
+        a -= b
+    else:
+        b -= a
@@ -0,0 +1,15 @@
+"""Raise b to the power of e by repeated multiplication and stop at a limit."""
+b = 3
+e = 7
+p = 1
+limit = 5000
+
+while e > 0:
+    p = p*b
+    e -= 1
+    if p > limit:
+        goto .overflow
+halt
+
+label .overflow
+p = 0
@@ -0,0 +1,16 @@
+"""Count the primes below n by trial division."""
+n = 40
+count = 0
+i = 2
+d = 0
+prime = 0
+
+while i < n:
+    d = 2
+    prime = 1
+    while d*d <= i and prime:
+        if i % d == 0:
+            prime = 0
+        d += 1
+    count += prime
+    i += 1
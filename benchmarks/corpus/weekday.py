@@ -0,0 +1,17 @@
+"""Count the working days of the month starting on the given day of the week."""
+day = 3
+days = 30
+working = 0
+weekend = 0
+
+for _ in range(days):
+    if day == 5:
+        weekend += 1
+    elif day == 6:
+        weekend += 1
+        day = 0
+        goto .next
+    else:
+        working += 1
+    day += 1
+    label .next
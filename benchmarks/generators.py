@@ -0,0 +1,155 @@
+"""
+Generators of synthetic Python Bonsai programs for benchmarking.
+
+Every generator takes a size and returns the source of a valid program whose
+length or complexity grows with the size. All programs halt.
+
+Exports:
+    straightLine: func    - long straight-line arithmetic
+    nestedBranches: func  - deeply nested if/else statements
+    manyVariables: func   - many variables used together
+    largeLiterals: func   - large constants in assignments and comparisons
+    labelsAndGotos: func  - a dense graph of labels and gotos
+    docstrings: func      - long sections of comments and docstrings
+    GENERATORS: dict      - all generators by name
+"""
+
+from random import Random
+
+def straightLine(size: int) -> str:
+    """
+    Return a program of size arithmetic statements without any branches.
+
+    Parameters:
+        @param size: the number of statements
+
+        @type size: int
+
+    @return: the source of the program
+    @rtype: str
+    """
+    statements = ["a = 1", "b = 2", "c = 0", "d = 0"]
+    patterns = ["c = a+b", "d += c", "a = d-c", "b = a+2", "c = b-a", "d = c+a+b", "a += 1", "b -= 1"]
+    for i in range(size):
+        statements.append(patterns[i % len(patterns)])
+    return "\n".join(statements)+"\n"
+
+def nestedBranches(size: int) -> str:
+    """
+    Return a program of if/else statements nested size levels deep.
+
+    Parameters:
+        @param size: the depth of the nesting
+
+        @type size: int
+
+    @return: the source of the program
+    @rtype: str
+    """
+    statements = ["a = {}".format(size), "b = 0", "c = 0"]
+    for depth in range(size):
+        indent = "    "*depth
+        statements.append("{}if a > {}:".format(indent, depth))
+        statements.append("{}    b += 1".format(indent))
+    for depth in reversed(range(size)):
+        indent = "    "*depth
+        statements.append("{}else:".format(indent))
+        statements.append("{}    c += {}".format(indent, depth+1))
+    return "\n".join(statements)+"\n"
+
+def manyVariables(size: int) -> str:
+    """
+    Return a program declaring size variables and adding up neighbouring ones.
+
+    Parameters:
+        @param size: the number of variables
+
+        @type size: int
+
+    @return: the source of the program
+    @rtype: str
+    """
+    statements = ["v{} = {}".format(i, i % 3) for i in range(size)]
+    for i in range(1, size):
+        statements.append("v{} += v{}".format(i, i-1))
+    return "\n".join(statements)+"\n"
+
+def largeLiterals(size: int) -> str:
+    """
+    Return a program using constants as large as size.
+
+    Parameters:
+        @param size: the magnitude of the constants
+
+        @type size: int
+
+    @return: the source of the program
+    @rtype: str
+    """
+    return "\n".join([
+        "a = {}".format(size),
+        "b = 0",
+        "b += {}".format(size),
+        "if a == {}:".format(size),
+        "    b -= {}".format(size//2),
+        "if b > {}:".format(size//3),
+        "    a = a*2",
+        "a = a//{}".format(size//4+1),
+        "b = {}".format(size+1)
+    ])+"\n"
+
+def labelsAndGotos(size: int) -> str:
+    """
+    Return a program of size labels each of which may jump forward to another one.
+
+    Parameters:
+        @param size: the number of labels
+
+        @type size: int
+
+    @return: the source of the program
+    @rtype: str
+    """
+    random = Random(size)
+    statements = ["c = 0"]
+    for i in range(size):
+        statements.extend([
+            "label .l{}".format(i),
+            "c += 1",
+            "if c > {}:".format(random.randrange(4)),
+            "    goto .l{}".format(random.randrange(i+1, size+1))
+        ])
+    statements.extend(["label .l{}".format(size), "halt"])
+    return "\n".join(statements)+"\n"
+
+def docstrings(size: int) -> str:
+    """
+    Return a program of size comments and docstrings between a few statements.
+
+    Parameters:
+        @param size: the number of comments and docstrings
+
+        @type size: int
+
+    @return: the source of the program
+    @rtype: str
+    """
+    statements = ["a = 0"]
+    for i in range(size):
+        if i % 2:
+            statements.append("# comment number {} explaining nothing in particular".format(i))
+        else:
+            statements.append('"""Docstring number {}.\n\nIt spans several lines."""'.format(i))
+        if i % 16 == 0:
+            statements.append("a += 1")
+    return "\n".join(statements)+"\n"
+
+GENERATORS = {
+    "straightLine": straightLine,
+    "nestedBranches": nestedBranches,
+    "manyVariables": manyVariables,
+    "largeLiterals": largeLiterals,
+    "labelsAndGotos": labelsAndGotos,
+    "docstrings": docstrings
+}
+"""all generators by name"""
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Generated-code quality benchmark for Py2Bon.
+
+Compiles a fixed corpus of programs, runs them in the simulator on fixed inputs
+and records the number of Bonsai lines, registers and executed steps, as well as
+the number of lines at -Os. The numbers are compared to a checked-in baseline and
+the benchmark fails if any of them grew by more than a tolerance, if a program
+computes different results or if it takes more lines at -Os than at -O2.
+
+Exports:
+    CORPUS: dict - the programs of the corpus and their inputs
+    measure: func - compile and run the corpus and return its metrics
+    compare: func - compare metrics to a baseline
+"""
+
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+"""the directory of the compiler and the root of the paths in CORPUS"""
+
+sys.path.insert(0, ROOT)
+
+from compile import simulatePB
+from passes import PassManager
+
+CORPUS = {
+    "test_program.py": [{}, {"s1": 0}, {"n1": 30}],
+    "test_program_2.py": [{}, {"a": 25}],
+    "benchmarks/corpus/gcd.py": [{}, {"a": 48, "b": 180}],
+    "benchmarks/corpus/fibonacci.py": [{}, {"n": 12}],
+    "benchmarks/corpus/primes.py": [{}, {"n": 25}],
+    "benchmarks/corpus/collatz.py": [{}, {"n": 6}],
+    "benchmarks/corpus/digits.py": [{}, {"n": 909}],
+    "benchmarks/corpus/weekday.py": [{}, {"day": 0, "days": 31}],
+    "benchmarks/corpus/power.py": [{}, {"b": 9, "e": 5}]
+}
+"""the programs of the corpus by their path and the inputs they are run with"""
+
+METRICS = ["lines", "registers", "steps", "sizeLines"]
+"""the metrics recorded for every program, all of them are better if smaller"""
+
+def measure() -> dict:
+    """
+    Compile and run the programs of the corpus and return their metrics.
+
+    @return: the metrics and the final values of the registers of every run by program
+    @rtype: dict
+    """
+    metrics = {}
+    for path, inputs in CORPUS.items():
+        with open(os.path.join(ROOT, path), "r") as file:
+            source = file.read()
+        simulator, results = simulatePB(source, inputs)
+        small, smallResults = simulatePB(source, inputs, passes=PassManager("s"))
+        metrics[path] = {
+            "lines": len(simulator.instructions),
+            "registers": len(simulator.registers),
+            "steps": simulator.steps,
+            "sizeLines": len(small.instructions),
+            "results": results
+        }
+        if smallResults != results:
+            metrics[path]["results"] = {"O2": results, "Os": smallResults}
+            # a program computing something else at -Os never matches the baseline
+    return metrics
+
+def compare(metrics: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compare metrics to a baseline and return the differences.
+
+    Parameters:
+        @param metrics:   metrics as returned by measure
+        @param baseline:  metrics measured before
+        @param tolerance: the relative growth of a metric that is not a regression
+
+        @type metrics:   dict
+        @type baseline:  dict
+        @type tolerance: float
+
+    @return: the program, metric, baseline value, current value and whether it is
+             a regression for every metric that changed, and the lines at -O2 and at
+             -Os of every program that is longer at -Os as a "size" regression
+    @rtype: list
+    """
+    differences = []
+    for path, values in metrics.items():
+        if values["sizeLines"] > values["lines"]:
+            differences.append((path, "size", values["lines"], values["sizeLines"], True))
+            # optimizing for size must never make a program longer
+        if path not in baseline:
+            continue
+        for metric in METRICS:
+            if metric not in baseline[path]:
+                continue
+                # a baseline recorded before a metric was added is compared on the others
+            old, new = baseline[path][metric], values[metric]
+            if old != new:
+                differences.append((path, metric, old, new, new > old*(1+tolerance)))
+        if values["results"] != baseline[path]["results"]:
+            differences.append((path, "results", baseline[path]["results"], values["results"], True))
+            # a program computing something else is always a regression
+    return differences
+
+def main():
+    """Parse command line arguments, measure the corpus and compare it to the baseline."""
+    parser = argparse.ArgumentParser(description="Benchmark the quality of the code generated by Py2Bon.")
+    parser.add_argument("--baseline", metavar="PATH",
+                        default=os.path.join(ROOT, "benchmarks", "quality_baseline.json"),
+                        help="the baseline to compare to, defaults to the checked-in one")
+    parser.add_argument("--tolerance", metavar="FRACTION", type=float, default=0.02,
+                        help="the relative growth of a metric that is not a regression")
+    parser.add_argument("--update", action="store_true", help="save the measured metrics as the new baseline")
+    args = parser.parse_args()
+    metrics = measure()
+    print("{:<32} {:>8} {:>10} {:>12} {:>10}".format("program", "lines", "registers", "steps", "lines -Os"))
+    for path, values in metrics.items():
+        print("{:<32} {:>8} {:>10} {:>12} {:>10}".format(path, values["lines"], values["registers"], values["steps"],
+                                                        values["sizeLines"]))
+    if args.update:
+        with open(args.baseline, "w") as file:
+            json.dump(metrics, file, indent=4, sort_keys=True)
+            file.write("\n")
+        return
+    with open(args.baseline, "r") as file:
+        baseline = json.load(file)
+    differences = compare(metrics, baseline, args.tolerance)
+    if differences:
+        print("\nChanges compared to {}:".format(args.baseline))
+    for path, metric, old, new, regression in differences:
+        if metric == "results":
+            print("{:<32} computes different results: {} instead of {}".format(path, new, old))
+        elif metric == "size":
+            print("{:<32} takes {} lines at -Os, more than {} at -O2  REGRESSION".format(path, new, old))
+        else:
+            print("{:<32} {:<10} {:>12} -> {:>12} {:>+8.2%}{}".format(path, metric, old, new, (new-old)/max(old, 1),
+                                                                    "  REGRESSION" if regression else ""))
+    if any(regression for path, metric, old, new, regression in differences):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
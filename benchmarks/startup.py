@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Cold-start benchmark for Py2Bon.
+
+Measures how long a new interpreter takes to get ready to compile: the time
+to import the compiler, taken from python -X importtime, and the end-to-end
+time of py2bon.py compiling an empty file. Every measurement starts a fresh
+process, so nothing is cached between runs but the bytecode of the modules.
+The results can be saved as JSON and compared to a previously saved baseline.
+
+Exports:
+    importTimes: func - the import times of the modules imported by a module
+    startupTime: func - the end-to-end time of py2bon.py compiling an empty file
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+"""the directory of the compiler's modules"""
+
+def importTimes(module: str, repeat=5) -> dict:
+    """
+    Import a module in new interpreters and return the import times of all modules it imports.
+
+    The best of the repeated runs is taken for every module.
+
+    Parameters:
+        @param module: the name of the module to import
+        @param repeat: the number of interpreters to import it in
+
+        @type module: str
+        @type repeat: int
+
+    @return: the time in seconds to import every module including the modules
+             it imports, by name
+    @rtype: dict
+    """
+    times = {}
+    for i in range(repeat):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import "+module], cwd=ROOT,
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                own, cumulative, name = line[len("import time:"):].split("|")
+                if cumulative.strip().isdigit():
+                    name = name.strip()
+                    times[name] = min(times.get(name, float("inf")), int(cumulative)/1e6)
+                    # lines are given in microseconds
+    return times
+
+def startupTime(repeat=5) -> float:
+    """
+    Return the best end-to-end time of py2bon.py compiling an empty file in a new interpreter.
+
+    @param repeat: the number of runs to take the best of
+    @type repeat:  int
+
+    @return: the time in seconds
+    @rtype: float
+    """
+    times = []
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "empty.py")
+        open(source, "w").close()
+        for i in range(repeat):
+            start = perf_counter()
+            subprocess.run([sys.executable, os.path.join(ROOT, "py2bon.py"), "-k", source], check=True,
+                           stdout=subprocess.DEVNULL)
+            times.append(perf_counter()-start)
+    return min(times)
+
+def main():
+    """Parse command line arguments, run the benchmark and print the slowest imports."""
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of Py2Bon.")
+    parser.add_argument("--module", default="compile", help="the module whose import is timed, defaults to compile")
+    parser.add_argument("--top", metavar="N", type=int, default=10, help="the number of slowest imports to print")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5, help="the number of runs to take the best of")
+    parser.add_argument("--save", metavar="PATH", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results to saved ones")
+    args = parser.parse_args()
+    times = importTimes(args.module, args.repeat)
+    results = {"import": times.get(args.module, 0.0), "startup": startupTime(args.repeat),
+               "imports": dict(sorted(times.items(), key=lambda e: -e[1])[:args.top])}
+    print("{:<32} {:>10}".format("module", "import"))
+    for name, time in results["imports"].items():
+        print("{:<32} {:>8.2f}ms".format(name, 1000*time))
+    print("\nimport {:<25} {:>8.2f}ms".format(args.module, 1000*results["import"]))
+    print("{:<32} {:>8.2f}ms".format("py2bon.py on an empty file", 1000*results["startup"]))
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)["results"]
+        print("\nCompared to {}:".format(args.compare))
+        for name in ["import", "startup"]:
+            print("{:<32} {:>7.2f}x".format(name, results[name]/baseline[name]))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "module": args.module,
+                       "repeat": args.repeat, "results": results}, file, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
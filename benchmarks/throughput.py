@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+Compile-throughput benchmark for Py2Bon.
+
+Compiles the programs of every generator at increasing sizes and times every
+stage of the compiler and the end-to-end compilePB. For every size, the scaling
+exponent relative to the previous size is reported, e.g. 1.0 for linear and
+2.0 for quadratic growth. The results can be saved as JSON and compared to
+a previously saved baseline.
+
+Exports:
+    benchmark: func - time the compilation of the generated programs
+    compare: func   - compare results to a baseline
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+from math import log
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the compiler's modules are found in the parent directory
+
+from compile import compilePB, statsPB
+from generators import GENERATORS
+
+def benchmark(generators: list, sizes: list, repeat=3) -> dict:
+    """
+    Time the compilation of the programs of the given generators at the given sizes.
+
+    The best of the repeated runs is taken for every stage and for compilePB.
+
+    Parameters:
+        @param generators: the names of the generators in GENERATORS
+        @param sizes:      the sizes to generate programs of
+        @param repeat:     the number of times every program is compiled
+
+        @type generators: list
+        @type sizes:      list
+        @type repeat:     int
+
+    @return: the results by generator and size
+    @rtype: dict
+    """
+    results = {}
+    for name in generators:
+        results[name] = {}
+        for size in sizes:
+            pyBonCode = GENERATORS[name](size)
+            stages = {}
+            for i in range(repeat):
+                stats = statsPB(pyBonCode, memory=False)
+                for stage, values in stats["stages"].items():
+                    stages[stage] = min(stages.get(stage, values["time"]), values["time"])
+            times = []
+            for i in range(repeat):
+                start = perf_counter()
+                compilePB(pyBonCode)
+                times.append(perf_counter()-start)
+            results[name][str(size)] = {
+                "sourceLines": pyBonCode.count("\n"),
+                "bonsaiLines": stats["bonsaiLines"],
+                "stages": stages,
+                "compilePB": min(times)
+            }
+    return results
+
+def compare(results: dict, baseline: dict) -> list:
+    """
+    Compare the end-to-end times of results to a baseline.
+
+    Parameters:
+        @param results:  results as returned by benchmark
+        @param baseline: results saved before
+
+        @type results:  dict
+        @type baseline: dict
+
+    @return: the generator, size and ratio of the time to the baseline for every
+             result found in the baseline
+    @rtype: list
+    """
+    ratios = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            if size in baseline.get(name, {}):
+                ratios.append((name, size, result["compilePB"]/baseline[name][size]["compilePB"]))
+    return ratios
+
+def main():
+    """Parse command line arguments, run the benchmark and print the scaling curves."""
+    parser = argparse.ArgumentParser(description="Benchmark the compilation speed of Py2Bon.")
+    parser.add_argument("--generators", metavar="NAME,...", default=",".join(GENERATORS),
+                        help="the generators to benchmark, defaults to all of them")
+    parser.add_argument("--sizes", metavar="N,...", default="16,32,64,128,256",
+                        help="the sizes of the generated programs")
+    parser.add_argument("--repeat", metavar="N", type=int, default=3, help="the number of runs to take the best of")
+    parser.add_argument("--save", metavar="PATH", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results to saved ones")
+    args = parser.parse_args()
+    generators = args.generators.split(",")
+    for name in generators:
+        if name not in GENERATORS:
+            parser.error("there is no generator {}".format(name))
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    results = benchmark(generators, sizes, args.repeat)
+    stageNames = list(next(iter(next(iter(results.values())).values()))["stages"])
+    print("{:<16} {:>6} {:>7} {:>8}".format("generator", "size", "lines", "bonsai") +
+          "".join(" {:>10}".format(stage.split(".")[-1][:10]) for stage in stageNames) +
+          " {:>10} {:>6}".format("compilePB", "scale"))
+    for name, sizesResults in results.items():
+        previous = None
+        for size in sizes:
+            result = sizesResults[str(size)]
+            scale = ""
+            if previous is not None and result["compilePB"] > 0 and previous[1] > 0:
+                scale = "{:.2f}".format(log(result["compilePB"]/previous[1])/log(size/previous[0]))
+                # the exponent of the growth since the previous size
+            print("{:<16} {:>6} {:>7} {:>8}".format(name, size, result["sourceLines"], result["bonsaiLines"]) +
+                  "".join(" {:>8.2f}ms".format(1000*result["stages"][stage]) for stage in stageNames) +
+                  " {:>8.2f}ms {:>6}".format(1000*result["compilePB"], scale))
+            previous = (size, result["compilePB"])
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        print("\nCompared to {}:".format(args.compare))
+        for name, size, ratio in compare(results, baseline["results"]):
+            print("{:<16} {:>6} {:>7.2f}x".format(name, size, ratio))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "repeat": args.repeat, "results": results}, file, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+"""
+Binary format of Bonsai programs.
+
+A binary program holds the same instructions, registers and comments as the
+Bonsai code, but packed into arrays of 32-bit words so that tools do not need
+to parse text. All numbers are unsigned and little-endian. The layout is:
+
+    header       magic b"BON\\0", version (2 bytes), width of the addresses in
+                 the text (1 byte), a reserved zero byte and the number of
+                 instructions, registers and comments and the length of the
+                 comments in bytes (4 bytes each)
+    instructions a word per instruction, the index of its opcode in OPCODES
+                 in the top 3 bits and its 1-based operand or 0 in the others
+    registers    a word per register with its start value
+    comments     the comments encoded as UTF-8 and separated by newlines
+
+Programs are read without copying their instructions and registers, from a
+file through mmap or from any other buffer through memoryview.
+
+Exports:
+    OPCODES: list            - the opcodes by their number in the binary format
+    pack: func               - pack the parts of a program into the binary format
+    fromText: func           - convert Bonsai code to the binary format
+    toText: func             - convert a binary program to Bonsai code
+    formatText: func         - format the parts of a program as Bonsai code
+    load: func               - map a binary program from a file
+    BinaryProgram: class     - a binary program read from a buffer
+    BinaryFormatError: class - an error raised if a program cannot be converted
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"BON\0"
+"""the first bytes of every binary program"""
+
+VERSION = 1
+"""the version of the binary format written"""
+
+HEADER = struct.Struct("<4sHBBIIII")
+"""the layout of the header, see the module documentation"""
+
+OPCODES = ["INC", "DEC", "JMP", "TST", "HLT"]
+"""the opcodes by their number in the binary format"""
+
+OPERAND_BITS = 29
+"""the number of bits of a word holding the operand"""
+
+def pack(width: int, instructions, registers, comments) -> bytes:
+    """
+    Pack the parts of a program into the binary format.
+
+    Parameters:
+        @param width:        the number of digits of the addresses in the text
+        @param instructions: the (opcode, operand) tuples of the program with 1-based
+                             operands or None
+        @param registers:    the start values of the registers
+        @param comments:     the comments without their leading semicolons
+
+        @type width:        int
+        @type instructions: iterable
+        @type registers:    iterable
+        @type comments:     list
+
+    @return: the binary program
+    @rtype: bytes
+    """
+    words = array("I")
+    for opcode, operand in instructions:
+        if operand is not None and not 0 < operand < 1 << OPERAND_BITS:
+            raise BinaryFormatError("The operand {} of {} does not fit the binary format.".format(operand, opcode))
+        words.append(OPCODES.index(opcode) << OPERAND_BITS | (operand or 0))
+    try:
+        values = array("I", registers)
+    except OverflowError:
+        raise BinaryFormatError("A register value does not fit the binary format.")
+    text = "\n".join(comments).encode("utf-8")
+    if sys.byteorder != "little":
+        words.byteswap()
+        values.byteswap()
+        # the format is little-endian on every machine
+    return b"".join([HEADER.pack(MAGIC, VERSION, width, 0, len(words), len(values), len(comments), len(text)),
+                     words.tobytes(), values.tobytes(), text])
+
+def fromText(bonCode: str) -> bytes:
+    """
+    Convert Bonsai code to the binary format.
+
+    @param bonCode: the Bonsai code as emitted by the compiler
+    @type bonCode:  str
+
+    @return: the binary program
+    @rtype: bytes
+    """
+    instructions = []
+    registers = []
+    comments = []
+    width = 2
+    for line in bonCode.splitlines():
+        if line[:1] == ";":
+            comments.append(line[1:])
+        elif line[:1] == "#":
+            registers.append(int(line[1:]))
+        elif line:
+            operand = line[3:].strip()
+            if line[:3] not in OPCODES:
+                raise BinaryFormatError("Unknown instruction {} on line {}.".format(line[:3], len(instructions)+1))
+            instructions.append((line[:3], int(operand) if operand else None))
+            width = len(line)-3
+            # every instruction is padded to the width of the addresses
+    return pack(width, instructions, registers, comments)
+
+def toText(data) -> str:
+    """
+    Convert a binary program to Bonsai code.
+
+    @param data: the binary program as bytes or any other buffer or a BinaryProgram
+    @type data:  bytes
+
+    @return: the Bonsai code
+    @rtype: str
+    """
+    program = data if isinstance(data, BinaryProgram) else BinaryProgram(data)
+    return "".join(formatText(program.width, program.instructions(), program.registers, program.comments))
+
+def formatText(width: int, instructions, registers, comments):
+    """
+    Format the parts of a program as lines of Bonsai code.
+
+    Parameters:
+        @param width:        the number of digits of the addresses
+        @param instructions: the (opcode, operand) tuples of the program with 1-based
+                             operands or None
+        @param registers:    the start values of the registers
+        @param comments:     the comments without their leading semicolons
+
+        @type width:        int
+        @type instructions: iterable
+        @type registers:    iterable
+        @type comments:     list
+
+    @return: the lines of the Bonsai code
+    @rtype: generator
+    """
+    for opcode, operand in instructions:
+        yield "{}{:{}d}\r\n".format(opcode, operand, width) if operand is not None else opcode+" "*width+"\r\n"
+    for value in registers:
+        yield "#{:5d}\r\n".format(value)
+    for comment in comments:
+        yield ";{}\r\n".format(comment)
+
+def load(path: str):
+    """
+    Map a binary program from a file without reading it.
+
+    @param path: the path of the binary program
+    @type path:  str
+
+    @return: the program, which should be closed when it is no longer needed
+    @rtype: BinaryProgram
+    """
+    with open(path, "rb") as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise BinaryFormatError("The file {} is empty.".format(path))
+        # the mapping stays valid after the file is closed
+    try:
+        return BinaryProgram(buffer)
+    except BinaryFormatError:
+        buffer.close()
+        raise
+
+class BinaryProgram(object):
+
+    """
+    A binary program read from a buffer.
+
+    The instructions and registers are views of the buffer, so they are not
+    copied on machines storing numbers little-endian.
+
+    Properties:
+        width     - the number of digits of the addresses in the text
+        words     - the instructions as packed words, see the module documentation
+        registers - the start values of the registers
+        comments  - the comments without their leading semicolons
+
+    Methods:
+        instructions() - generate the (opcode, operand) tuple of every instruction
+                         with 1-based operands or None
+        close()        - release the buffer
+    """
+
+    def __init__(self, buffer):
+        """
+        Read a binary program from a buffer.
+
+        Parameters:
+            @param buffer: the binary program as bytes, mmap or any other buffer
+
+            @type buffer: bytes
+        """
+        with memoryview(buffer).cast("B") as view:
+            if len(view) < HEADER.size:
+                raise BinaryFormatError("The program is too short for a binary program.")
+            magic, version, width, reserved, instructions, registers, comments, length = HEADER.unpack_from(view)
+            if magic != MAGIC:
+                raise BinaryFormatError("The program is no binary program.")
+            if version != VERSION:
+                raise BinaryFormatError("Version {} of the binary format is not supported.".format(version))
+            start = HEADER.size
+            end = start+4*(instructions+registers)
+            if len(view) != end+length:
+                raise BinaryFormatError("The program is {} bytes long instead of {}.".format(len(view), end+length))
+            self.buffer = buffer
+            """@type: bytes"""
+            self.width = width
+            """@type: int"""
+            self.words = _words(view[start:start+4*instructions])
+            """@type: memoryview"""
+            self.registers = _words(view[start+4*instructions:end])
+            """@type: memoryview"""
+            self.comments = str(view[end:], "utf-8").split("\n") if comments else []
+            """@type: list"""
+        # the views of the instructions and registers keep the buffer exported until they are released
+
+    def instructions(self):
+        """
+        Generate the (opcode, operand) tuple of every instruction.
+
+        @return: the instructions with 1-based operands or None for HLT
+        @rtype: generator
+        """
+        mask = (1 << OPERAND_BITS)-1
+        for word in self.words:
+            yield OPCODES[word >> OPERAND_BITS], (word & mask) or None
+
+    def close(self):
+        """Release the views of the buffer and close it if it is a mapped file."""
+        self.words.release()
+        self.registers.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+def _words(view: memoryview) -> memoryview:
+    """Return a view of 4-byte little-endian words as unsigned integers, copying them only if needed."""
+    if sys.byteorder == "little":
+        return view.cast("I")
+    words = array("I", view.tobytes())
+    words.byteswap()
+    return memoryview(words)
+
+class BinaryFormatError(Exception):
+
+    """An error raised if a program cannot be converted to or from the binary format."""
+
+    pass
+
+def main():
+    """Parse command line arguments and convert a program between the text and the binary format."""
+    import argparse
+    # only the command line needs argparse, not the compiler importing this module
+    parser = argparse.ArgumentParser(description="Convert Bonsai programs between the text and the binary format.")
+    parser.add_argument("-o", "--out", metavar="PATH",
+                        help="the converted program, defaults to the input with the extension .bin or .bon")
+    parser.add_argument("file", help="the program to convert, binary if it starts with the binary magic bytes")
+    args = parser.parse_args()
+    with open(args.file, "rb") as file:
+        binary = file.read(len(MAGIC)) == MAGIC
+    outname = args.out or os.path.splitext(args.file)[0]+(".bon" if binary else ".bin")
+    try:
+        if binary:
+            program = load(args.file)
+            with open(outname, "w", newline="") as file:
+                file.write(toText(program))
+            program.close()
+        else:
+            with open(args.file, "r", newline="") as file:
+                data = fromText(file.read())
+            with open(outname, "wb") as file:
+                file.write(data)
+    except BinaryFormatError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,61 @@
 Main compilation module.
 
 Exports:
-    compilePB: func - compile Python Bonsai code
+    compilePB: func       - compile Python Bonsai code
+    compileMappedPB: func - compile Python Bonsai code and return it with its source map
+    compileObjectPB: func - compile Python Bonsai code to a relocatable object for the linker
+    profilePB: func       - compile Python Bonsai code, run it in the simulator
+                            and return its profile
+    annotatePB: func      - compile Python Bonsai code, run it in the simulator
+                            and return the source annotated with the executed steps
+    simulatePB: func      - compile Python Bonsai code, run it in the simulator and
+                            return the simulator and the final values of the registers
+    costPB: func          - compile Python Bonsai code and return the source annotated
+                            with its static cost
+    statsPB: func         - compile Python Bonsai code and return the time and memory
+                            taken by every stage and the sizes of their results
+    emitPB: func          - compile Python Bonsai code and write the results of the
+                            stages to files as JSON lines
+    reportPB: func        - compile Python Bonsai code once and return the Bonsai code
+                            with the profile, listings and statistics asked for
+    EMIT_STAGES: list     - the names of the stages whose results can be written
+    REPORTS: list         - the names of the reports reportPB can return
+    Compiler: class       - a compiler session with fixed options, safe to share between threads
+    Result: class         - the result of a compilation by a Compiler
 """
 
 from lexer import Lexer
 from syntactic_analyzer import SyntacticAnalysis
 from semantic_analyzer import SemanticAnalysis
-from intermediate_code import IntermediateCode
+from intermediate_code import IntermediateCode, SizeError, TEMPLATES
 from optimizer import Optimizer
+from passes import PassManager
+from simulator import Simulator, SimulatorError
+from binary_format import toText
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager, nullcontext
 from sys import stderr
+from threading import Lock
+from time import perf_counter
+import json
 
-def compilePB(pyBonCode: str, verbosity=0) -> str:
-    """Compile Python Bonsai code and return Bonsai code.
+EMIT_STAGES = ["tokens", "ast", "ir", "ir-opt", "bon"]
+"""the names of the results of the stages emitPB can write"""
+
+REPORTS = ["profile", "lines", "cost", "stats"]
+"""the names of the reports reportPB can return, those of profilePB, annotatePB, costPB and statsPB"""
+
+Result = namedtuple("Result", ["code", "sourceMap", "stats", "intermediateCode"])
+"""the Bonsai code or binary program, the 1-based source line of every Bonsai line,
+the statistics of the stages as returned by statsPB without memory and the optimized
+intermediate code of a compilation"""
+
+_TRACING = Lock()
+"""held while the memory of the stages of a compilation is traced, as tracemalloc is shared by all threads"""
+
+def compilePB(pyBonCode: str, verbosity=0, profile=None, outline=False, target="extended", maxLines=None,
+              passes=None, sink=None, binary=False) -> str:
+    """Compile Python Bonsai code and return Bonsai code or write it to a sink.
 
     This function combines the various stages of the compiler and optionally outputs the interim stages.
     The stages called are (in order):
@@ -23,26 +66,841 @@ def compilePB(pyBonCode: str, verbosity=0) -> str:
         - Intermediate Code Generator
         - Optimizer
         - Intermediate Code Compiler
+    A program that does not fit the target or maxLines is compiled again with the templates
+    for size, which also read constants from the constant pool wherever that is shorter,
+    and then with outlining until it fits. Only what reduces the lines or registers that
+    do not fit is kept; if the program never fits, the SizeError of the attempt exceeding
+    the target least is raised, listing the lines of every statement. With a sink, the
+    lines of the Bonsai code are written to it as they are produced instead of being
+    returned as a single string. A binary program as described in binary_format is
+    returned or written to a binary sink instead if asked for.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be compiled as raw source
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+        @param sink:      a file-like object to write the Bonsai code to or None
+        @param binary:    whether to compile to the binary format instead of text
+
+        @type pyBonCode: str
+        @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+        @type sink:      TextIO
+        @type binary:    bool
+
+    @return: the Bonsai code, the binary program or None if it was written to the sink
+    @rtype: str
+    """
+    return _compile(pyBonCode, verbosity, profile, outline=outline, target=target, maxLines=maxLines,
+                    passes=passes, sink=sink, binary=binary)[0]
+
+def compileMappedPB(pyBonCode: str, verbosity=0, profile=None, outline=False, target="extended", maxLines=None,
+                    passes=None, sink=None, binary=False) -> tuple:
+    """Compile Python Bonsai code and return Bonsai code and its source map.
+
+    The source map contains the source line every Bonsai line was generated for,
+    starting at 1, or None for lines that do not belong to a statement. With a sink,
+    the Bonsai code is written to it as for compilePB and None is returned in its place.
+    The Bonsai code may be a binary program as for compilePB.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be compiled as raw source
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+        @param sink:      a file-like object to write the Bonsai code to or None
+        @param binary:    whether to compile to the binary format instead of text
+
+        @type pyBonCode: str
+        @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+        @type sink:      TextIO
+        @type binary:    bool
+
+    @return: the Bonsai code and the source map
+    @rtype: tuple
+    """
+    bonCode, ic = _compile(pyBonCode, verbosity, profile, outline=outline, target=target, maxLines=maxLines,
+                           passes=passes, sink=sink, binary=binary)
+    return bonCode, [line+1 if line is not None else None for line in ic.sourceMap]
+
+def profilePB(pyBonCode: str, inputs=None, verbosity=0, profile=None, outline=False, target="extended", maxLines=None,
+              passes=None) -> dict:
+    """Compile Python Bonsai code, run it in the simulator and return its profile.
+
+    The program is run once for every given input. The profile contains the number
+    of runs, how often the line of every label was executed and for every branch,
+    how often it was executed and how often its condition held.
+    It can be saved as JSON and passed to compilePB.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be profiled as raw source
+        @param inputs:    a list of dicts mapping register names to their start values;
+                          the program is run once with the declared values if not given
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a previously recorded profile to compile the program with
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+
+        @type pyBonCode: str
+        @type inputs:    list
+        @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+
+    @return: the recorded profile
+    @rtype: dict
+    """
+    bonCode, ic = _compile(pyBonCode, verbosity, profile, outline=outline, target=target, maxLines=maxLines,
+                           passes=passes)
+    return _profile(_simulate(bonCode, ic, inputs), ic)
+
+def _profile(simulator: Simulator, ic) -> dict:
+    """Return the profile of the runs of a program as described for profilePB.
+
+    Parameters:
+        @param simulator: the simulator after running the program
+        @param ic:        the intermediate code the program was compiled from
+
+        @type simulator: Simulator
+        @type ic:        IntermediateCode
+
+    @return: the recorded profile
+    @rtype: dict
+    """
+    labels = {}
+    for label, line in ic.symbolTable.items():
+        if label[0] == ".":
+            start, end = ic.bonLines[line], max(ic.bonLines[line+1], ic.bonLines[line]+1)
+            labels[label] = (simulator.counts[start] if start < len(simulator.counts) else 0)-sum(
+                simulator.counts[jump] for jump in range(start, min(end, len(simulator.counts)))
+                if simulator.instructions[jump] == ("JMP", start+1))
+            # jumps back to the start from within the instruction, i.e. its loops,
+            # do not enter the label
+    branches = {}
+    for label, count in labels.items():
+        if label.startswith(".BRANCH_"):
+            number = label[len(".BRANCH_"):]
+            if ".IF_"+number in labels:
+                taken = labels[".IF_"+number]
+            else:
+                taken = count-labels[".ELSE_"+number]
+                # a chain of equality tests has a label for every case instead
+            branches[number] = {"count": count, "taken": taken}
+    return {"runs": simulator.runs, "labels": labels, "branches": branches}
+
+def annotatePB(pyBonCode: str, inputs=None, verbosity=0, profile=None, outline=False, target="extended", maxLines=None,
+               passes=None) -> str:
+    """Compile Python Bonsai code, run it in the simulator and return the annotated source.
+
+    Every source line is prefixed with the number of Bonsai instructions executed
+    for it in all runs and their share of all executed instructions.
+    Instructions not generated for a statement, such as the final halt, are
+    summed up in an additional line.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be profiled as raw source
+        @param inputs:    a list of dicts mapping register names to their start values;
+                          the program is run once with the declared values if not given
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a previously recorded profile to compile the program with
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+
+        @type pyBonCode: str
+        @type inputs:    list
+        @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+
+    @return: the annotated listing
+    @rtype: str
+    """
+    bonCode, ic = _compile(pyBonCode, verbosity, profile, outline=outline, target=target, maxLines=maxLines,
+                           passes=passes)
+    return _annotate(pyBonCode, _simulate(bonCode, ic, inputs), ic)
+
+def _annotate(pyBonCode: str, simulator: Simulator, ic) -> str:
+    """Return the source annotated with the steps executed by a program as described for annotatePB.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code the program was compiled from
+        @param simulator: the simulator after running the program
+        @param ic:        the intermediate code the program was compiled from
+
+        @type pyBonCode: str
+        @type simulator: Simulator
+        @type ic:        IntermediateCode
+
+    @return: the annotated listing
+    @rtype: str
+    """
+    steps = simulator.rollUp(ic.sourceMap)
+    total = max(simulator.steps, 1)
+
+    def formatLine(count, number, source):
+        if not count:
+            return "{:>10} {:>7} {:>5}  {}".format("", "", number, source)
+        return "{:>10d} {:>6.2f}% {:>5}  {}".format(count, 100*count/total, number, source)
+
+    listing = [formatLine(steps.get(i), i+1, source) for i, source in enumerate(pyBonCode.splitlines())]
+    if steps.get(None):
+        listing.append(formatLine(steps[None], "", "(not part of a statement)"))
+    listing.append(formatLine(simulator.steps, "", "(total in {} runs)".format(simulator.runs)))
+    return "\n".join(listing)+"\n"
+
+def simulatePB(pyBonCode: str, inputs=None, verbosity=0, profile=None, optimize=True, maxSteps=10000000,
+               outline=False, target="extended", maxLines=None, passes=None) -> tuple:
+    """Compile Python Bonsai code, run it in the simulator and return the simulator and the results.
+
+    The program is run once for every given input. The simulator holds the number
+    of executed steps and lines of all runs.
+    Without optimizing, neither the optimizer nor the passes on the Bonsai code run,
+    e.g. to check the optimizations against the plain code.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be run as raw source
+        @param inputs:    a list of dicts mapping register names to their start values;
+                          the program is run once with the declared values if not given
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param optimize:  whether to optimize the program
+        @param maxSteps:  the number of instructions after which a run is aborted
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 or without optimizing level 0 if not given
+
+        @type pyBonCode: str
+        @type inputs:    list
+        @type verbosity: int
+        @type profile:   dict
+        @type optimize:  bool
+        @type maxSteps:  int
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+
+    @return: the simulator and a list of dicts mapping register names to their final
+             values for every run
+    @rtype: tuple
+    """
+    bonCode, ic = _compile(pyBonCode, verbosity, profile, optimize=optimize, outline=outline, target=target,
+                           maxLines=maxLines, passes=passes)
+    results = []
+    simulator = _simulate(bonCode, ic, inputs, results, maxSteps)
+    return simulator, results
+
+def costPB(pyBonCode: str, verbosity=0, profile=None, outline=False, target="extended", maxLines=None,
+           passes=None) -> str:
+    """Compile Python Bonsai code and return the source annotated with its static cost.
+
+    Every source line generating code is prefixed with the number of Bonsai lines
+    and help registers it uses and with the number of steps it takes when executed
+    once, in terms of the values of the registers before it is executed.
+    Approximate step counts are marked with a tilde, such as those of lines whose
+    Bonsai code the Bonsai passes changed, for which the steps are an upper bound.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code as raw source
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+
+        @type pyBonCode: str
+        @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+
+    @return: the annotated listing
+    @rtype: str
+    """
+    bonCode, ic = _compile(pyBonCode, verbosity, profile, outline=outline, target=target, maxLines=maxLines,
+                           passes=passes)
+    return _cost(pyBonCode, ic)
+
+def _cost(pyBonCode: str, ic) -> str:
+    """Return the source annotated with the static cost of a compiled program as described for costPB.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code the program was compiled from
+        @param ic:        the intermediate code the program was compiled from
+
+        @type pyBonCode: str
+        @type ic:        IntermediateCode
+
+    @return: the annotated listing
+    @rtype: str
+    """
+    lines = {}
+    for line in ic.sourceMap:
+        lines[line] = lines.get(line, 0)+1
+
+    def row(line, number, source):
+        if line not in lines:
+            return ("", "", "", number, source)
+        cost = ic.costs.get(line, {"steps": {}, "approximate": False, "helpRegisters": 0})
+        return (lines[line], cost["helpRegisters"] or "", _format_steps(cost), number, source)
+
+    rows = [("lines", "help", "steps", "line", "source")]
+    rows.extend(row(i, i+1, source) for i, source in enumerate(pyBonCode.splitlines()))
+    if None in lines:
+        rows.append(row(None, "", "(not part of a statement)"))
+    width = max(len(steps) for lines, helpRegisters, steps, number, source in rows)
+    listing = ["{:>7} {:>5} {:<{width}} {:>5}  {}".format(*row, width=width) for row in rows]
+    return "\n".join(listing)+"\n"
+
+def _format_steps(cost: dict) -> str:
+    """Format the steps of a static cost as a sum of terms.
+
+    Parameters:
+        @param cost: a cost as found in the costs of the intermediate code
+
+        @type cost: dict
+
+    @return: the formatted steps, e.g. 11·y+3
+    @rtype: str
+    """
+    terms = sorted((term for term in cost["steps"] if term), key=lambda term: (-term.count("·"), term))
+    steps = "+".join(("{}·{}".format(cost["steps"][term], term) if cost["steps"][term] != 1 else term)
+                     for term in terms)
+    if cost["steps"].get("") or not steps:
+        steps += "{}{}".format("+" if steps else "", cost["steps"].get("", 0))
+    return ("~" if cost["approximate"] else "")+steps
+
+def _simulate(bonCode: str, ic, inputs, results=None, maxSteps=10000000) -> Simulator:
+    """Run compiled Bonsai code in the simulator once for every input.
+
+    Parameters:
+        @param bonCode:  the compiled Bonsai code
+        @param ic:       the intermediate code the Bonsai code was compiled from
+        @param inputs:   a list of dicts mapping register names to their start values or None
+        @param results:  a list to append the final values of the registers of every run
+                         to by name or None
+        @param maxSteps: the number of instructions after which a run is aborted
+
+        @type bonCode:  str
+        @type ic:       IntermediateCode
+        @type inputs:   list
+        @type results:  list
+        @type maxSteps: int
+
+    @return: the simulator after all runs
+    @rtype: Simulator
+    """
+    simulator = Simulator(bonCode)
+    for values in inputs or [{}]:
+        for name in values:
+            if name not in ic.symbolTable or name[0] == ".":
+                raise SimulatorError("There is no register {}.".format(name))
+        registers = simulator.run(dict((ic.symbolTable[name], value) for name, value in values.items()), maxSteps)
+        if results is not None:
+            results.append(dict((name, registers[register]) for name, register in ic.symbolTable.items()
+                                if name[0] != "."))
+    return simulator
+
+def statsPB(pyBonCode: str, verbosity=0, profile=None, memory=True, outline=False, target="extended", maxLines=None,
+            passes=None) -> dict:
+    """Compile Python Bonsai code and return statistics about the compilation.
+
+    For every stage, the wall time in seconds and the peak of the memory allocated
+    while it ran in bytes are recorded. Tracing the memory slows down the compiler,
+    so it can be turned off for accurate timing. The statistics also contain the number of
+    tokens, syntax tree nodes, intermediate instructions before and after optimizing,
+    the rounds of the optimizer and how often every optimization changed the code,
+    the number of Bonsai lines and of registers. Under passes, the rounds of every
+    stage of the pass manager and the changes and time of each of its passes are given.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be compiled as raw source
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param memory:    whether to record the peak memory of the stages
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+
+        @type pyBonCode: str
+        @type verbosity: int
+        @type profile:   dict
+        @type memory:    bool
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+
+    @return: the statistics
+    @rtype: dict
+    """
+    stats = {"stages": {}}
+    with _tracing(memory):
+        bonCode, ic = _compile(pyBonCode, verbosity, profile, stats, outline=outline, target=target,
+                               maxLines=maxLines, passes=passes, memory=memory)
+    return _stats(stats, bonCode, ic)
+
+@contextmanager
+def _tracing(memory: bool):
+    """Trace the memory allocated by a compilation if asked for.
+
+    Compilations tracing their memory run one after another.
+
+    @param memory: whether to trace the memory
+    @type memory:  bool
+    """
+    with _TRACING if memory else nullcontext():
+        if memory:
+            import tracemalloc
+        tracing = not memory or tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+def _stats(stats: dict, bonCode, ic) -> dict:
+    """Complete the statistics recorded by a compilation as described for statsPB.
+
+    Parameters:
+        @param stats:   the statistics of the stages recorded by _compile
+        @param bonCode: the compiled Bonsai code or binary program
+        @param ic:      the intermediate code the program was compiled from
+
+        @type stats:   dict
+        @type bonCode: str
+        @type ic:      IntermediateCode
+
+    @return: the statistics
+    @rtype: dict
+    """
+    stats["optimizerIterations"] = ic.optimizerStats["iterations"]
+    stats["optimizerHits"] = ic.optimizerStats["hits"]
+    stats["passes"] = ic.passManager.stats
+    stats["bonsaiLines"] = len(ic.sourceMap)
+    stats["registers"] = len(Simulator(bonCode).registers)
+    return stats
+
+def emitPB(pyBonCode: str, files: dict, verbosity=0, profile=None, outline=False, target="extended", maxLines=None,
+           passes=None) -> str:
+    """Compile Python Bonsai code, write the results of the stages and return Bonsai code.
+
+    Every result is written as soon as its stage has finished, one JSON object per
+    line, and only if it was asked for. The results are:
+        - tokens: every token with its type, value, line and column
+        - ast:    every node of the decorated syntax tree in pre-order with the index
+                  of its parent
+        - ir:     every intermediate instruction with the labels pointing to it
+        - ir-opt: every optimized intermediate instruction with the labels pointing to it
+        - bon:    every Bonsai instruction with its source line, the registers
+                  and the comments
+    Lines and columns start at 1.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be compiled as raw source
+        @param files:     a dict mapping names of EMIT_STAGES to the files to write them to
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+
+        @type pyBonCode: str
+        @type files:     dict
+        @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+
+    @return: the compiled Bonsai code
+    @rtype: str
+    """
+    for name in files:
+        if name not in EMIT_STAGES:
+            raise ValueError("There is no stage {}.".format(name))
+    return _compile(pyBonCode, verbosity, profile, emit=files, outline=outline, target=target, maxLines=maxLines,
+                    passes=passes)[0]
+
+def reportPB(pyBonCode: str, reports: list, inputs=None, verbosity=0, profile=None, outline=False, target="extended",
+             maxLines=None, passes=None, sink=None, binary=False, emit=None) -> tuple:
+    """Compile Python Bonsai code once and return Bonsai code, its source map and reports about it.
+
+    The reports describe the returned program, as they are all made from the same
+    compilation. They are given by their names in REPORTS:
+        - profile: the profile of the runs of the program as returned by profilePB
+        - lines:   the source annotated with the executed steps as returned by annotatePB
+        - cost:    the source annotated with the static cost as returned by costPB
+        - stats:   the statistics of the compilation as returned by statsPB
+    The program is run once for every given input for the profile and the lines.
+    The Bonsai code and its source map are returned as by compileMappedPB and the
+    results of the stages in emit are written as by emitPB.
 
     Parameters:
         @param pyBonCode: the Python Bonsai code to be compiled as raw source
+        @param reports:   the names of the reports to return
+        @param inputs:    a list of dicts mapping register names to their start values;
+                          the program is run once with the declared values if not given
         @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param target:    the name of the machine in TARGETS to compile for
+        @param maxLines:  the largest number of Bonsai lines the program may have or None
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+        @param sink:      a file-like object to write the Bonsai code to or None
+        @param binary:    whether to compile to the binary format instead of text
+        @param emit:      a dict mapping names of EMIT_STAGES to the files to write them to or None
 
         @type pyBonCode: str
+        @type reports:   list
+        @type inputs:    list
         @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type target:    str
+        @type maxLines:  int
+        @type passes:    PassManager
+        @type sink:      TextIO
+        @type binary:    bool
+        @type emit:      dict
+
+    @return: the Bonsai code, the source map and the reports by name
+    @rtype: tuple
+    """
+    for name in reports:
+        if name not in REPORTS:
+            raise ValueError("There is no report {}.".format(name))
+    for name in emit or {}:
+        if name not in EMIT_STAGES:
+            raise ValueError("There is no stage {}.".format(name))
+    stats = {"stages": {}} if "stats" in reports else None
+    whole = stats is not None or "profile" in reports or "lines" in reports
+    # the code is needed as a whole to run it and to count its registers
+    with _tracing(stats is not None):
+        bonCode, ic = _compile(pyBonCode, verbosity, profile, stats, emit, outline=outline, target=target,
+                               maxLines=maxLines, passes=passes, sink=None if whole else sink, binary=binary,
+                               memory=stats is not None)
+    if sink is not None and whole:
+        sink.write(bonCode)
+    results = {}
+    if stats is not None:
+        results["stats"] = _stats(stats, bonCode, ic)
+    if "profile" in reports or "lines" in reports:
+        simulator = _simulate(bonCode, ic, inputs)
+        if "profile" in reports:
+            results["profile"] = _profile(simulator, ic)
+        if "lines" in reports:
+            results["lines"] = _annotate(pyBonCode, simulator, ic)
+    if "cost" in reports:
+        results["cost"] = _cost(pyBonCode, ic)
+    return (None if sink is not None else bonCode,
+            [line+1 if line is not None else None for line in ic.sourceMap], results)
+
+def compileObjectPB(pyBonCode: str, verbosity=0, profile=None, outline=False, passes=None) -> dict:
+    """Compile Python Bonsai code to a relocatable object.
+
+    Gotos to labels the program does not define jump to other objects, see linker.py.
+    The intermediate code is optimized as for compilePB, but the Bonsai code is not,
+    and the target and the size of the program are only checked when linking.
+
+    Parameters:
+        @param pyBonCode: the Python Bonsai code to be compiled as raw source
+        @param verbosity: the verbosity level defines which interim stages to print
+        @param profile:   a profile as returned by profilePB to guide the optimizations
+        @param outline:   whether templates called several times may share one copy to save lines
+        @param passes:    the PassManager choosing the optimization level and passes,
+                          one for level 2 if not given
+
+        @type pyBonCode: str
+        @type verbosity: int
+        @type profile:   dict
+        @type outline:   bool
+        @type passes:    PassManager
+
+    @return: the object, which can be saved as JSON
+    @rtype: dict
+    """
+    return _compile(pyBonCode, verbosity, profile, outline=outline, passes=passes, relocatable=True)[0]
+
+class Compiler(object):
+
+    """
+    A compiler session compiling programs with the same options.
+
+    The options are fixed when the session is created, so a session can be
+    shared by the threads of a ThreadPoolExecutor or a long-running service.
+    Every compilation has its own lexer, syntax tree, pass manager and
+    intermediate code, while the tables shared by all of them, such as the
+    RegExp of the lexer, the transitions of the parser and the templates,
+    are built once and only read. The results of the most recent sources
+    are cached and shared by all callers, so they must not be changed.
+    Nothing is printed and the memory of the stages is not traced.
+
+    Properties:
+        level         - the name of the optimization level in LEVELS
+        enable        - the names of passes to run in addition to those of the level
+        disable       - the names of passes not to run
+        maxIterations - the largest number of rounds of the passes or None
+        profile       - a profile as returned by profilePB to guide the optimizations or None
+        outline       - whether templates called several times may share one copy to save lines
+        target        - the name of the machine in TARGETS to compile for
+        maxLines      - the largest number of Bonsai lines the program may have or None
+        binary        - whether to compile to the binary format instead of text
+        cacheSize     - the number of results cached, 0 to cache none
+
+    Methods:
+        compile(source)                - compile a program and return its Result
+        compileAsync(source, executor) - compile a program in an executor and return its Result
     """
+
+    def __init__(self, level="2", enable=(), disable=(), maxIterations=None, profile=None, outline=False,
+                 target="extended", maxLines=None, binary=False, cacheSize=64):
+        """
+        Create a compiler session.
+
+        Parameters:
+            @param level:         the name of the optimization level in LEVELS
+            @param enable:        the names of passes to run in addition to those of the level
+            @param disable:       the names of passes not to run
+            @param maxIterations: the largest number of rounds of the passes or None
+            @param profile:       a profile as returned by profilePB or None
+            @param outline:       whether templates called several times may share one copy
+            @param target:        the name of the machine in TARGETS to compile for
+            @param maxLines:      the largest number of Bonsai lines the program may have or None
+            @param binary:        whether to compile to the binary format instead of text
+            @param cacheSize:     the number of results cached
+
+            @type level:         str
+            @type enable:        list
+            @type disable:       list
+            @type maxIterations: int
+            @type profile:       dict
+            @type outline:       bool
+            @type target:        str
+            @type maxLines:      int
+            @type binary:        bool
+            @type cacheSize:     int
+        """
+        PassManager(level, enable, disable, maxIterations)
+        # the level and passes are checked once
+        self.level = level
+        """@type: str"""
+        self.enable = tuple(enable)
+        """@type: tuple"""
+        self.disable = tuple(disable)
+        """@type: tuple"""
+        self.maxIterations = maxIterations
+        """@type: int"""
+        self.profile = profile
+        """@type: dict"""
+        self.outline = outline
+        """@type: bool"""
+        self.target = target
+        """@type: str"""
+        self.maxLines = maxLines
+        """@type: int"""
+        self.binary = binary
+        """@type: bool"""
+        self.cacheSize = cacheSize
+        """@type: int"""
+        self.cache = OrderedDict()
+        # the results by source, least recently used first
+        self.lock = Lock()
+        # guards the cache; compilations themselves run concurrently
+
+    def compile(self, source: str) -> Result:
+        """
+        Compile a program and return its result.
+
+        Raises the same errors as compilePB for invalid programs or programs not fitting the target.
+
+        @param source: the Python Bonsai code to be compiled as raw source
+        @type source:  str
+
+        @return: the result, possibly cached
+        @rtype: Result
+        """
+        with self.lock:
+            if source in self.cache:
+                self.cache.move_to_end(source)
+                return self.cache[source]
+        stats = {"stages": {}}
+        passes = PassManager(self.level, self.enable, self.disable, self.maxIterations)
+        bonCode, ic = _compile(source, 0, self.profile, stats, outline=self.outline, target=self.target,
+                               maxLines=self.maxLines, passes=passes, binary=self.binary)
+        stats["optimizerIterations"] = ic.optimizerStats["iterations"]
+        stats["optimizerHits"] = ic.optimizerStats["hits"]
+        stats["passes"] = passes.stats
+        stats["bonsaiLines"] = len(ic.sourceMap)
+        result = Result(bonCode, [line+1 if line is not None else None for line in ic.sourceMap], stats, ic)
+        if self.cacheSize > 0:
+            with self.lock:
+                self.cache[source] = result
+                while len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+        # a source compiled by several threads at once is compiled by each of them
+        return result
+
+    async def compileAsync(self, source: str, executor=None) -> Result:
+        """
+        Compile a program in an executor without blocking the event loop and return its result.
+
+        Parameters:
+            @param source:   the Python Bonsai code to be compiled as raw source
+            @param executor: the executor to compile in, the default executor of the loop if None
+
+            @type source:   str
+            @type executor: concurrent.futures.Executor
+
+        @return: the result, possibly cached
+        @rtype: Result
+        """
+        import asyncio
+        # asyncio takes longer to import than the whole compiler, so it is only imported when needed
+        return await asyncio.get_running_loop().run_in_executor(executor, self.compile, source)
+
+def _compile(pyBonCode: str, verbosity, profile, stats=None, emit=None, optimize=True, outline=False,
+             target="extended", maxLines=None, passes=None, sink=None, binary=False, relocatable=False,
+             memory=False) -> tuple:
+    """Compile Python Bonsai code and return Bonsai code and the optimized intermediate code.
+
+    Programs that do not fit the target or maxLines are made smaller as described for compilePB.
+    The Bonsai code is streamed to a sink unless it is needed as a whole for the verbose output
+    or the bon records, in which case it is written to the sink at once.
+
+    Parameters:
+        @param pyBonCode:   the Python Bonsai code to be compiled as raw source
+        @param verbosity:   the verbosity level defines which interim stages to print
+        @param profile:     a profile as returned by profilePB or None
+        @param stats:       a dict to record the time and memory of every stage and the
+                            sizes of their results in or None
+        @param emit:        a dict mapping names of EMIT_STAGES to the files to write
+                            their results to or None
+        @param optimize:    whether to run the optimizer and the passes on the Bonsai code
+        @param outline:     whether templates called several times may share one copy to save lines
+        @param target:      the name of the machine in TARGETS to compile for
+        @param maxLines:    the largest number of Bonsai lines the program may have or None
+        @param passes:      the PassManager choosing the optimization level and passes,
+                            one for level 2 or without optimizing level 0 if not given
+        @param sink:        a file-like object to write the Bonsai code to or None
+        @param binary:      whether to compile to the binary format instead of text
+        @param relocatable: whether to compile to a relocatable object instead
+        @param memory:      whether to record the peak memory of the stages while tracemalloc is tracing
+
+        @type pyBonCode:   str
+        @type verbosity:   int
+        @type profile:     dict
+        @type stats:       dict
+        @type emit:        dict
+        @type optimize:    bool
+        @type outline:     bool
+        @type target:      str
+        @type maxLines:    int
+        @type passes:      PassManager
+        @type sink:        TextIO
+        @type binary:      bool
+        @type relocatable: bool
+        @type memory:      bool
+
+    @return: the Bonsai code or object, or None if it was streamed to the sink, and the
+             compiled intermediate code
+    @rtype: tuple
+    """
+
+    def stage(name: str, function, *args):
+        # run a stage and record its time and peak memory
+        if stats is None:
+            return function(*args)
+        tracing = memory and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        start = perf_counter()
+        result = function(*args)
+        stats["stages"][name] = {"time": perf_counter()-start}
+        if tracing:
+            stats["stages"][name]["peakMemory"] = tracemalloc.get_traced_memory()[1]-allocated
+        return result
+
+    def write(name: str, records):
+        # write the records of a stage as JSON lines if they were asked for;
+        # the records are only generated then
+        if emit and name in emit:
+            for record in records():
+                emit[name].write(json.dumps(record, separators=(",", ":"))+"\n")
+
+    if memory:
+        import tracemalloc
+        # only imported if the memory is traced, as it slows down starting the compiler
     if verbosity is None:
         verbosity = 0
-    tokens = Lexer(pyBonCode).tokens()
+    tokens = stage("Lexer", lambda: Lexer(pyBonCode).tokens())
+    write("tokens", lambda: ({"type": token.typ, "value": token.val, "line": token.line+1,
+                              "column": token.posInLine+1} for token in tokens))
     if verbosity > 1:
         print("Tokens:", file=stderr)
         for token in tokens:
             print(token, file=stderr)
         print("", file=stderr)
-    ast = SyntacticAnalysis(tokens)
-    SemanticAnalysis(ast)
+    ast = stage("SyntacticAnalysis", SyntacticAnalysis, tokens)
+    stage("SemanticAnalysis", SemanticAnalysis, ast)
     ic = IntermediateCode()
-    ic.fromSyntaxTree(ast)
+    ic.profile = profile
+    ic.relocatable = relocatable
+    write("ast", lambda: _ast_records(ast))
+    stage("IntermediateCode.fromSyntaxTree", ic.fromSyntaxTree, ast)
+    write("ir", lambda: _instruction_records(ic))
+    if stats is not None:
+        nodes = [ast.root]
+        for node in nodes:
+            nodes.extend(node.children)
+        stats["tokens"] = len(tokens)
+        stats["astNodes"] = len(nodes)
+        stats["instructions"] = len(ic.instructions)
     if verbosity > 2:
         print("Original instructions:", file=stderr)
         _print_instructions(ic)
@@ -50,8 +908,44 @@ def compilePB(pyBonCode: str, verbosity=0) -> str:
         print(ic.symbolTable, file=stderr)
         print("\nRegisters:", file=stderr)
         print(ic.registers, file=stderr)
-    oc = Optimizer(ic)
-    bonCode = oc.compile()
+    if passes is None:
+        passes = PassManager("2" if optimize else "0")
+    oc = stage("Optimizer", Optimizer, ic, passes)
+    passes.configure(oc)
+    oc.outline = oc.outline or outline
+    oc.target = target
+    oc.maxLines = maxLines
+    write("ir-opt", lambda: _instruction_records(oc))
+    shrinking = [(name, value) for name, value in [("templates", TEMPLATES["size"]), ("outline", True)]
+                 if getattr(oc, name) != value]
+    # the ways to make a program smaller that does not fit the target,
+    # starting with the one slowing it down the least
+    streaming = sink is not None and verbosity == 0 and not (emit and "bon" in emit)
+    smallest = None
+    while True:
+        try:
+            bonCode = stage("compile", oc.compile, sink if streaming else None, binary)
+            break
+        except SizeError as error:
+            overflow = error.overflow()
+            if smallest is not None and (overflow == smallest.overflow() or
+                                         any(new > old for new, old in zip(overflow, smallest.overflow()))):
+                setattr(oc, *undo)
+                # a way that does not make what does not fit smaller without making anything
+                # else overflow is not kept for the next ones
+            else:
+                smallest = error
+            if not shrinking:
+                raise smallest
+            name, value = shrinking.pop(0)
+            undo = (name, getattr(oc, name))
+            setattr(oc, name, value)
+            # nothing was written to the sink yet, as the size is checked first
+    if sink is not None and not streaming:
+        sink.write(bonCode)
+    write("bon", lambda: _bonsai_records(toText(bonCode) if binary else bonCode, oc))
+    if stats is not None:
+        stats["optimizedInstructions"] = len(oc.instructions)
     if verbosity > 0:
         print("\nOptimized instructions:", file=stderr)
         _print_instructions(oc)
@@ -60,8 +954,77 @@ def compilePB(pyBonCode: str, verbosity=0) -> str:
         print("\nRegisters:", file=stderr)
         print(oc.registers, file=stderr)
         print("\nCompiled Bonsai code:", file=stderr)
-        print(bonCode, file=stderr)
-    return bonCode
+        print(json.dumps(bonCode) if relocatable else toText(bonCode) if binary else bonCode, file=stderr)
+    return bonCode, oc
+
+def _ast_records(ast):
+    """Generate a record for every node of a syntax tree in pre-order.
+
+    Parameters:
+        @param ast: the syntax tree
+
+        @type ast: AST
+
+    @return: the records
+    @rtype: generator
+    """
+    indices = {}
+    nodes = [ast.root]
+    while nodes:
+        node = nodes.pop()
+        indices[node] = len(indices)
+        yield {"index": indices[node], "parent": indices.get(node.parent), "type": node.typ, "value": node.val,
+               "line": node.line+1 if node.line is not None else None, "decorators": node.decorators}
+        nodes.extend(reversed(node.children))
+
+def _instruction_records(ic):
+    """Generate a record for every instruction of intermediate code.
+
+    Parameters:
+        @param ic: the intermediate code
+
+        @type ic: IntermediateCode
+
+    @return: the records
+    @rtype: generator
+    """
+    labels = {}
+    for label, line in ic.symbolTable.items():
+        if label[0] == ".":
+            labels.setdefault(line, []).append(label)
+    for i, instruction in enumerate(ic.instructions):
+        yield {"index": i, "labels": sorted(labels.get(i, [])), "opcode": instruction.opcode,
+               "op1": list(instruction.op1) if instruction.op1 else None,
+               "op2": list(instruction.op2) if instruction.op2 else None,
+               "line": instruction.line+1 if instruction.line is not None else None}
+
+def _bonsai_records(bonCode: str, ic):
+    """Generate a record for every line of Bonsai code.
+
+    Parameters:
+        @param bonCode: the compiled Bonsai code
+        @param ic:      the intermediate code the Bonsai code was compiled from
+
+        @type bonCode: str
+        @type ic:      IntermediateCode
+
+    @return: the records
+    @rtype: generator
+    """
+    address = 0
+    register = 0
+    for line in bonCode.splitlines():
+        if line[:1] == ";":
+            yield {"comment": line[1:]}
+        elif line[:1] == "#":
+            register += 1
+            yield {"register": register, "value": int(line[1:])}
+        else:
+            source = ic.sourceMap[address]
+            address += 1
+            operand = line[3:].strip()
+            yield {"address": address, "opcode": line[:3], "operand": int(operand) if operand else None,
+                   "line": source+1 if source is not None else None}
 
 def _print_instructions(ic):
 
@@ -81,19 +1044,15 @@ def _print_instructions(ic):
             "CONSTANT": "$"
         }[op.typ] + str(op.val)
 
-    instructionStrings = []
-    for instruction in ic.instructions:
-        instructionStrings.append(
-            instruction.opcode.ljust(3) +
-            (" " + formatOperand(instruction.op1) +
-             (", " + formatOperand(instruction.op2) if instruction.op2 else "")
-             if instruction.op1 else "")
-        )
     labels = dict((int(line), label) for label, line in ic.symbolTable.items() if label[0] == ".")
-    max_length = max(map(lambda e: len(e[1]), labels.items()))
-    for i, instruction in enumerate(instructionStrings):
+    max_length = max((len(label) for label in labels.values()), default=0)
+    for i, instruction in enumerate(ic.instructions):
         print(
             labels.get(i, "").rjust(max_length),
-            instruction,
+            instruction.opcode.ljust(3) +
+            (" " + formatOperand(instruction.op1) +
+             (", " + formatOperand(instruction.op2) if instruction.op2 else "")
+             if instruction.op1 else ""),
             file=stderr
         )
+        # every instruction is formatted when it is printed
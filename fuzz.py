@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+
+"""
+Differential fuzzer for Py2Bon.
+
+Generates random valid programs from the grammar of Python Bonsai, evaluates
+them at the source level and compiles them with and without optimizations.
+Both compiled programs are run in the simulator and their final registers
+are checked against the evaluation. The programs are checked by a pool of
+processes and failing ones are shrunk to a small program that still fails.
+
+Programs whose evaluation is undefined, such as those subtracting below zero,
+or that take too long are discarded.
+
+Exports:
+    generateProgram: func - generate a random program
+    renderProgram: func   - return the source of a program
+    evaluate: func        - evaluate a program at the source level
+    checkProgram: func    - compile and run a program and return how it fails
+    shrinkProgram: func   - shrink a failing program
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from random import Random
+from time import perf_counter
+
+from compile import simulatePB
+from passes import PassManager, LEVELS
+from simulator import SimulatorError
+
+MAX_VALUE = 100
+"""the largest value evaluation allows, as larger ones take the simulator too long"""
+
+MAX_STATEMENTS = 2000
+"""the number of statements after which evaluation gives up"""
+
+MAX_STEPS = 3000000
+"""the number of Bonsai instructions after which a run gives up"""
+
+class Undefined(Exception):
+
+    """An error raised if the evaluation of a program is undefined or takes too long."""
+
+    pass
+
+class Goto(Exception):
+
+    """Raised by a goto to unwind the evaluation to the statement sequence containing the label."""
+
+    pass
+
+def generateProgram(random: Random) -> dict:
+    """
+    Generate a random program.
+
+    A program is a dict of the start values of its variables and a list of statements.
+    Statements are tuples:
+        ("assign", variable, operator, expression)
+        ("if", [(condition, block), ...], block or None)
+        ("for", expression, block)
+        ("while", counter, start, (left, operator, right), block) - counts down counter
+            from start while the comparison holds, which is counter > 0 or a comparison
+            of counter plus a sum with the same sum
+        ("loop", counter, start, block) - a label followed by the block, which jumps back
+            to the label with a goto while counter is above 0 and decrements it
+        ("label", name), ("goto", name), ("halt", )
+    Expressions are lists of operands, i.e. variables or constants, and operators.
+    Conditions are lists of conjunctions of (negated, left, operator, right) comparisons,
+    with right None for a bare expression. Labels and loops are only placed at the top
+    level and other gotos only jump forward, so that every program halts.
+
+    Parameters:
+        @param random: the source of randomness
+
+        @type random: Random
+
+    @return: the program
+    @rtype: dict
+    """
+    variables = ["v{}".format(i) for i in range(random.randint(1, 5))]
+    counters = []
+    labels = []
+
+    def operand():
+        if random.random() < 0.6:
+            return random.choice(variables)
+        return random.choice([0, 1, 2, 3, 5, 7, 8, 9, 13, 20])
+        # includes constants some of the optimizations treat specially
+
+    def expression(size=3):
+        parts = [operand()]
+        for i in range(random.randint(0, size-1)):
+            operator = random.choice(["+", "+", "+", "-", "*", "//", "%"])
+            if operator in ["//", "%"] and random.random() < 0.7:
+                parts.extend([operator, random.randint(1, 9)])
+                # most divisors are constants, as most programs would be undefined otherwise
+            else:
+                parts.extend([operator, operand()])
+        return parts
+
+    def condition():
+        return [[(random.random() < 0.2, expression(2),
+                  random.choice([">", ">=", "<", "<=", "==", "!=", None]), expression(2))
+                 for j in range(random.choice([1, 1, 1, 2]))]
+                for i in range(random.choice([1, 1, 1, 2]))]
+
+    def block(depth, size):
+        statements = []
+        for i in range(random.randint(1, size)):
+            kind = random.random()
+            if depth < 3 and kind < 0.2:
+                statements.append(("if", [(condition(), block(depth+1, 3)) for i in range(random.choice([1, 1, 2, 3]))],
+                                   block(depth+1, 3) if random.random() < 0.5 else None))
+            elif depth < 2 and kind < 0.27:
+                statements.append(("for", [random.randint(0, 3)] if random.random() < 0.7 else expression(2),
+                                   block(depth+1, 3)))
+            elif depth < 2 and kind < 0.32:
+                counters.append("c{}".format(len(counters)))
+                comparison = ([counters[-1]], ">", [0])
+                if random.random() < 0.5:
+                    total = expression(2)
+                    comparison = random.choice([([counters[-1], "+"]+total, ">", total),
+                                                ([counters[-1], "+"]+total, "!=", total),
+                                                ([counters[-1], "+"]+total, ">=", total+["+", 1])])
+                    # a sum on both sides holds as long as the counter is above 0, while the
+                    # help registers calculating it may be hoisted or reset by the optimizer
+                statements.append(("while", counters[-1], random.randint(0, 3), comparison, block(depth+1, 3)))
+            elif depth == 0 and kind < 0.36:
+                counters.append("c{}".format(len(counters)))
+                statements.append(("loop", counters[-1], random.randint(0, 3), block(depth+1, 3)))
+                # a loop built from a label and a backward goto, as found by the optimizer
+            elif kind < 0.40:
+                labels.append(".l{}".format(len(labels)))
+                statements.append(("goto", labels[-1]))
+            elif kind < 0.41:
+                statements.append(("halt", ))
+            else:
+                statements.append(("assign", random.choice(variables), random.choice(["=", "=", "=", "+=", "+=", "-="]),
+                                   expression()))
+        return statements
+
+    statements = block(0, 12)
+    for label in labels:
+        statements.insert(random.randint(len(statements)//2, len(statements)), ("label", label))
+        # the labels are placed somewhere in the second half of the program
+    values = dict((variable, random.randint(0, 6)) for variable in variables)
+    values.update((counter, 0) for counter in counters)
+    return {"values": values, "statements": statements}
+
+def renderProgram(program: dict) -> str:
+    """
+    Return the source of a program.
+
+    Parameters:
+        @param program: the program as returned by generateProgram
+
+        @type program: dict
+
+    @return: the Python Bonsai source
+    @rtype: str
+    """
+    lines = ["{} = {}".format(variable, value) for variable, value in program["values"].items()]
+
+    def renderExpression(parts):
+        return "".join(str(part) for part in parts)
+
+    def renderCondition(condition):
+        return " or ".join(" and ".join("{}{}{}".format(
+            "not " if negated else "", renderExpression(left),
+            " {} {}".format(operator, renderExpression(right)) if operator else "")
+            for negated, left, operator, right in conjunction) for conjunction in condition)
+
+    def renderBlock(statements, indent):
+        for statement in statements:
+            if statement[0] == "assign":
+                lines.append("{}{} {} {}".format(indent, statement[1], statement[2], renderExpression(statement[3])))
+            elif statement[0] == "if":
+                for i, (condition, block) in enumerate(statement[1]):
+                    lines.append("{}{} {}:".format(indent, "elif" if i else "if", renderCondition(condition)))
+                    renderBlock(block, indent+"    ")
+                if statement[2]:
+                    lines.append("{}else:".format(indent))
+                    renderBlock(statement[2], indent+"    ")
+            elif statement[0] == "for":
+                lines.append("{}for _ in range({}):".format(indent, renderExpression(statement[1])))
+                renderBlock(statement[2], indent+"    ")
+            elif statement[0] == "while":
+                left, operator, right = statement[3]
+                lines.append("{}{} = {}".format(indent, statement[1], statement[2]))
+                lines.append("{}while {} {} {}:".format(indent, renderExpression(left), operator, renderExpression(right)))
+                renderBlock(statement[4], indent+"    ")
+                lines.append("{}    {} -= 1".format(indent, statement[1]))
+            elif statement[0] == "loop":
+                lines.append("{}{} = {}".format(indent, statement[1], statement[2]))
+                lines.append("{}label .{}".format(indent, statement[1]))
+                renderBlock(statement[3], indent)
+                lines.append("{}if {} > 0:".format(indent, statement[1]))
+                lines.append("{}    {} -= 1".format(indent, statement[1]))
+                lines.append("{}    goto .{}".format(indent, statement[1]))
+            elif statement[0] == "label":
+                lines.append("{}label {}".format(indent, statement[1]))
+            elif statement[0] == "goto":
+                lines.append("{}goto {}".format(indent, statement[1]))
+            elif statement[0] == "halt":
+                lines.append("{}halt".format(indent))
+
+    renderBlock(program["statements"], "")
+    return "\n".join(lines)+"\n"
+
+def evaluate(program: dict) -> dict:
+    """
+    Evaluate a program at the source level and return the final values of its variables.
+
+    Expressions are evaluated from left to right and conditions are short-circuited
+    as in Python. Raises Undefined if a value drops below zero, is divided by zero
+    or grows too large, or if the program runs too long.
+
+    Parameters:
+        @param program: the program as returned by generateProgram
+
+        @type program: dict
+
+    @return: the final values of the variables
+    @rtype: dict
+    """
+    values = dict(program["values"])
+    executed = [0]
+
+    def check(value):
+        if value < 0:
+            raise Undefined("A value dropped below zero.")
+        elif value > MAX_VALUE:
+            raise Undefined("A value grew too large.")
+        return value
+
+    def operand(part):
+        return part if type(part) == int else values[part]
+
+    def evaluateExpression(parts):
+        terms = [[operand(parts[0])]]
+        for operator, part in zip(parts[1::2], parts[2::2]):
+            if operator in ["+", "-"]:
+                terms.append([operator, operand(part)])
+            else:
+                terms[-1].extend([operator, operand(part)])
+        # multiplicative operators bind more tightly
+        value = 0
+        for term in terms:
+            sign = "+"
+            if term[0] in ["+", "-"]:
+                sign = term.pop(0)
+            product = term[0]
+            for operator, factor in zip(term[1::2], term[2::2]):
+                if operator == "*":
+                    product = check(product*factor)
+                elif factor == 0:
+                    raise Undefined("A value is divided by zero.")
+                else:
+                    product = product//factor if operator == "//" else product % factor
+            value = check(value+product if sign == "+" else value-product)
+        return value
+
+    def compare(left, operator, right):
+        return {
+            ">": lambda a, b: a > b, ">=": lambda a, b: a >= b, "<": lambda a, b: a < b,
+            "<=": lambda a, b: a <= b, "==": lambda a, b: a == b, "!=": lambda a, b: a != b
+        }[operator](evaluateExpression(left), evaluateExpression(right))
+
+    def evaluateComparison(negated, left, operator, right):
+        return negated != ((evaluateExpression(left) > 0) if operator is None else compare(left, operator, right))
+
+    def evaluateCondition(condition):
+        return any(all(evaluateComparison(*comparison) for comparison in conjunction) for conjunction in condition)
+        # a comparison skipped by Python may be undefined, so the compiler must not evaluate it either
+
+    def run(statements):
+        for statement in statements:
+            executed[0] += 1
+            if executed[0] > MAX_STATEMENTS:
+                raise Undefined("The program runs too long.")
+            if statement[0] == "assign":
+                value = evaluateExpression(statement[3])
+                values[statement[1]] = check({
+                    "=": value, "+=": values[statement[1]]+value, "-=": values[statement[1]]-value
+                }[statement[2]])
+            elif statement[0] == "if":
+                for condition, block in statement[1]:
+                    if evaluateCondition(condition):
+                        run(block)
+                        break
+                else:
+                    if statement[2]:
+                        run(statement[2])
+            elif statement[0] == "for":
+                for i in range(evaluateExpression(statement[1])):
+                    run(statement[2])
+            elif statement[0] == "while":
+                values[statement[1]] = statement[2]
+                while compare(*statement[3]):
+                    run(statement[4])
+                    values[statement[1]] -= 1
+            elif statement[0] == "loop":
+                values[statement[1]] = statement[2]
+                run(statement[3])
+                while values[statement[1]] > 0:
+                    values[statement[1]] -= 1
+                    run(statement[3])
+            elif statement[0] == "goto":
+                raise Goto(statement[1])
+            elif statement[0] == "halt":
+                raise StopIteration()
+
+    statements = program["statements"]
+    start = 0
+    while True:
+        try:
+            run(statements[start:])
+            break
+        except Goto as goto:
+            start = statements.index(("label", goto.args[0]))
+            # labels are only found at the top level
+        except StopIteration:
+            break
+    return values
+
+def checkProgram(program: dict, outline=False, level="2") -> str:
+    """
+    Compile and run a program with and without optimizations and return how it fails.
+
+    Parameters:
+        @param program: the program as returned by generateProgram
+        @param outline: whether the optimized program shares the code of repeated templates
+        @param level:   the optimization level of the optimized program
+
+        @type program: dict
+        @type outline: bool
+        @type level:   str
+
+    @return: a description of the failure or None if the program passes or is discarded
+    @rtype: str
+    """
+    try:
+        expected = evaluate(program)
+    except Undefined:
+        return None
+    source = renderProgram(program)
+    results = {}
+    for optimize in [False, True]:
+        try:
+            simulator, runs = simulatePB(source, optimize=optimize, maxSteps=MAX_STEPS, outline=outline and optimize,
+                                         passes=PassManager(level) if optimize else None)
+            results[optimize] = runs[0]
+        except SimulatorError as error:
+            if "did not halt" in str(error):
+                results[optimize] = "timeout"
+            else:
+                results[optimize] = "error: {}".format(error)
+        except Exception as error:
+            if type(error).__name__ == "SemanticError" and not optimize:
+                return None
+                # the program is outside of the language, e.g. a constant expression is negative
+            return "the compiler raised {}: {}".format(type(error).__name__, error)
+    if results[False] == results[True] == "timeout":
+        return None
+        # both take too long to tell
+    for optimize, name in [(False, "unoptimized"), (True, "optimized")]:
+        if results[optimize] != expected:
+            return "the {} program computes {} instead of {}".format(name, results[optimize], expected)
+    return None
+
+def shrinkProgram(program: dict, failure: str, outline=False, level="2") -> dict:
+    """
+    Shrink a failing program to a smaller one failing in the same way.
+
+    Statements are removed, branches, loops and expressions are simplified and
+    constants reduced as long as the program keeps failing.
+
+    Parameters:
+        @param program: the failing program
+        @param failure: how it fails as returned by checkProgram
+        @param outline: whether the optimized program shares the code of repeated templates
+        @param level:   the optimization level of the optimized program
+
+        @type program: dict
+        @type failure: str
+        @type outline: bool
+        @type level:   str
+
+    @return: the shrunk program
+    @rtype: dict
+    """
+    kind = failure.split(" computes ")[0].split(":")[0]
+    # the same kind of failure is kept, the computed values may change
+
+    def simplerExpressions(parts):
+        if len(parts) > 1:
+            for i in range(0, len(parts), 2):
+                yield [parts[i]]
+            for i in range(1, len(parts), 2):
+                yield parts[:i]+parts[i+2:]
+                yield parts[:i-1]+parts[i+1:]
+        for i, part in enumerate(parts[::2]):
+            if type(part) == int and part > 0:
+                yield parts[:2*i]+[part//2]+parts[2*i+1:]
+            elif type(part) == str:
+                yield parts[:2*i]+[1]+parts[2*i+1:]
+
+    def simplerConditions(condition):
+        if len(condition) > 1:
+            for i in range(len(condition)):
+                yield condition[:i]+condition[i+1:]
+        for i, conjunction in enumerate(condition):
+            if len(conjunction) > 1:
+                for j in range(len(conjunction)):
+                    yield condition[:i]+[conjunction[:j]+conjunction[j+1:]]+condition[i+1:]
+            for j, (negated, left, operator, right) in enumerate(conjunction):
+                comparisons = []
+                if negated:
+                    comparisons.append((False, left, operator, right))
+                if operator is not None:
+                    comparisons.append((negated, left, None, right))
+                comparisons.extend((negated, simpler, operator, right) for simpler in simplerExpressions(left))
+                if operator is not None:
+                    comparisons.extend((negated, left, operator, simpler) for simpler in simplerExpressions(right))
+                for comparison in comparisons:
+                    yield condition[:i]+[conjunction[:j]+[comparison]+conjunction[j+1:]]+condition[i+1:]
+
+    def simplerStatements(statement):
+        if statement[0] == "assign":
+            if statement[2] != "=":
+                yield ("assign", statement[1], "=", statement[3])
+            for simpler in simplerExpressions(statement[3]):
+                yield ("assign", statement[1], statement[2], simpler)
+        elif statement[0] == "if":
+            for i, (condition, block) in enumerate(statement[1]):
+                if len(statement[1]) > 1:
+                    yield ("if", statement[1][:i]+statement[1][i+1:], statement[2])
+                for simpler in simplerConditions(condition):
+                    yield ("if", statement[1][:i]+[(simpler, block)]+statement[1][i+1:], statement[2])
+                for simpler in simplerBlocks(block):
+                    yield ("if", statement[1][:i]+[(condition, simpler)]+statement[1][i+1:], statement[2])
+            if statement[2]:
+                yield ("if", statement[1], None)
+                for simpler in simplerBlocks(statement[2]):
+                    yield ("if", statement[1], simpler)
+        elif statement[0] == "for":
+            for simpler in simplerExpressions(statement[1]):
+                yield ("for", simpler, statement[2])
+            for simpler in simplerBlocks(statement[2]):
+                yield ("for", statement[1], simpler)
+        elif statement[0] == "while":
+            if statement[2] > 0:
+                yield ("while", statement[1], statement[2]-1, statement[3], statement[4])
+            if statement[3] != ([statement[1]], ">", [0]):
+                yield ("while", statement[1], statement[2], ([statement[1]], ">", [0]), statement[4])
+            for simpler in simplerBlocks(statement[4]):
+                yield ("while", statement[1], statement[2], statement[3], simpler)
+        elif statement[0] == "loop":
+            if statement[2] > 0:
+                yield ("loop", statement[1], statement[2]-1, statement[3])
+            for simpler in simplerBlocks(statement[3]):
+                yield ("loop", statement[1], statement[2], simpler)
+
+    def simplerBlocks(statements):
+        for i, statement in enumerate(statements):
+            if len(statements) > 1:
+                yield statements[:i]+statements[i+1:]
+            if statement[0] == "if":
+                for condition, block in statement[1]:
+                    yield statements[:i]+block+statements[i+1:]
+                if statement[2]:
+                    yield statements[:i]+statement[2]+statements[i+1:]
+            elif statement[0] in ["for", "while", "loop"]:
+                yield statements[:i]+statement[-1]+statements[i+1:]
+            for simpler in simplerStatements(statement):
+                yield statements[:i]+[simpler]+statements[i+1:]
+
+    def simplerPrograms(program):
+        for statements in simplerBlocks(program["statements"]):
+            yield {"values": program["values"], "statements": statements}
+        for variable, value in program["values"].items():
+            if value > 0 and variable[0] == "v":
+                yield {"values": dict(program["values"], **{variable: value//2}), "statements": program["statements"]}
+
+    def isValid(program):
+        source = renderProgram(program)
+        return all(("label", ".l"+label) in program["statements"]
+                   for label in set(line.split(" .l")[1] for line in source.splitlines() if " goto .l" in " "+line))
+        # every goto needs its label, which is always at the top level
+
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        for candidate in simplerPrograms(program):
+            if not isValid(candidate):
+                continue
+            candidateFailure = checkProgram(candidate, outline, level)
+            if candidateFailure and candidateFailure.split(" computes ")[0].split(":")[0] == kind:
+                program = candidate
+                shrunk = True
+                break
+    return program
+
+def _check_seed(seed: int, outline: bool, level: str) -> tuple:
+    """
+    Generate the program of a seed and check it.
+
+    Parameters:
+        @param seed:    the seed of the program
+        @param outline: whether the optimized program shares the code of repeated templates
+        @param level:   the optimization level of the optimized program
+
+        @type seed:    int
+        @type outline: bool
+        @type level:   str
+
+    @return: the seed and the failure as returned by checkProgram
+    @rtype: tuple
+    """
+    return seed, checkProgram(generateProgram(Random(seed)), outline, level)
+
+def _shrink_seed(seed: int, failure: str, outline: bool, level: str) -> dict:
+    """
+    Generate the failing program of a seed and shrink it.
+
+    Parameters:
+        @param seed:    the seed of the program
+        @param failure: how it fails as returned by checkProgram
+        @param outline: whether the optimized program shares the code of repeated templates
+        @param level:   the optimization level of the optimized program
+
+        @type seed:    int
+        @type failure: str
+        @type outline: bool
+        @type level:   str
+
+    @return: the shrunk program
+    @rtype: dict
+    """
+    return shrinkProgram(generateProgram(Random(seed)), failure, outline, level)
+
+def main():
+    """Parse command line arguments, fuzz the compiler and report the failures."""
+    parser = argparse.ArgumentParser(description="Check the optimizations of Py2Bon against random programs.")
+    parser.add_argument("-n", "--count", metavar="N", type=int, default=1000, help="the number of programs to check")
+    parser.add_argument("-s", "--seed", metavar="N", type=int, default=0, help="the seed of the first program")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=os.cpu_count(),
+                        help="the number of processes, defaults to the number of cores")
+    parser.add_argument("-o", "--out", metavar="DIR", help="save the shrunk failing programs in this directory")
+    parser.add_argument("-O", dest="level", choices=list(LEVELS), default="2",
+                        help="the optimization level of the optimized programs, defaults to 2")
+    parser.add_argument("--outline", action="store_true",
+                        help="share the code of repeated templates in the optimized programs")
+    args = parser.parse_args()
+    start = perf_counter()
+    failures = []
+    with ProcessPoolExecutor(args.jobs) as executor:
+        seeds = range(args.seed, args.seed+args.count)
+        for seed, failure in executor.map(_check_seed, seeds, [args.outline]*len(seeds), [args.level]*len(seeds),
+                                          chunksize=16):
+            if failure:
+                failures.append((seed, failure))
+                print("Program {} fails: {}".format(seed, failure), file=sys.stderr)
+        elapsed = perf_counter()-start
+        print("Checked {} programs in {:.1f}s ({:.0f} per minute), {} failed.".format(
+            args.count, elapsed, 60*args.count/elapsed, len(failures)))
+        shrunk = list(executor.map(_shrink_seed, *zip(*failures), [args.outline]*len(failures),
+                                          [args.level]*len(failures))) if failures else []
+    for (seed, failure), program in zip(failures, shrunk):
+        source = renderProgram(program)
+        print("\nProgram {} shrunk, {}:\n{}".format(seed, checkProgram(program, args.outline, args.level), source), end="")
+        if args.out:
+            os.makedirs(args.out, exist_ok=True)
+            with open(os.path.join(args.out, "fuzz_{}.py".format(seed)), "w") as file:
+                file.write(source)
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,26 @@ actual Bonsai code.
 It is also the representation of the code on which optimizations are applied.
 
 Exports:
-    IntermediateCode: class - assembly-like representation of the code
-    Instruction: class      - a single instruction used in the intermediate code
-    Operand: class          - a single operand for an instruction
+    IntermediateCode: class  - assembly-like representation of the code
+    Instruction: class       - a single instruction used in the intermediate code
+    Operand: class           - a single operand for an instruction
+    InstructionStream: class - Bonsai instructions in parallel arrays as generated by compile
+    TEMPLATES: dict          - the Bonsai code templates for the fewest steps and lines
+    TARGETS: dict            - the address widths of the machines to compile for
+    OBJECT_VERSION: int      - the version of the relocatable objects compiled for the linker
+    fitTarget: func          - return the address width of a program or raise a SizeError
+    CompilerError: class     - a generic error of the code generator and compiler
+    SizeError: class         - an error if a program does not fit the target
 """
 
+import json
+import os
+import re
+from array import array
 from collections import namedtuple
-from itertools import chain
+from itertools import accumulate, chain, compress
+
+from binary_format import pack, OPCODES
 
 class IntermediateCode(object):
 
@@ -25,17 +38,51 @@ class IntermediateCode(object):
     methods to fill them with data, such as fromSyntaxTree(ast).
 
     Properties:
-        instructions - a list of Instructions
-        symbolTable  - a table resolving all used identifiers
-        registers    - a list containing the start values for manually set registers
-        comments     - a list containing all the used docstrings
+        instructions   - a list of Instructions
+        symbolTable    - a table resolving all used identifiers
+        registers      - a list containing the start values for manually set registers
+        comments       - a list containing all the used docstrings
+        unrollLimit    - the largest constant comparisons and divisions are unrolled for;
+                         larger constants are read from a constant pool register, as
+                         are smaller ones where that is shorter with the templates for size
+        profile        - the execution counts of labels as recorded by profilePB; used to
+                         lay out branches and to choose the lowering of hot and cold
+                         instructions, None if there is no profile
+        bonLines       - the first Bonsai line of every instruction and the number of Bonsai
+                         lines at the end, available after compiling
+        sourceMap      - the source line of every Bonsai line, starting at 0, or None for
+                         lines not generated for a statement; available after compiling
+        costs          - the static cost of every source line as a dict of the steps it
+                         takes when executed once, mapping terms such as the product of
+                         register values to their coefficients and "" to the constant part,
+                         whether these are approximate and the number of help registers
+                         it uses; steps of lines changed by the Bonsai passes are upper
+                         bounds marked approximate; available after compiling
+        optimizerStats - the number of rounds of the optimizer and how often every
+                         optimization changed the code; available after optimizing
+        templates      - the Bonsai code templates add, sub, mov and cmp are compiled to,
+                         one of TEMPLATES; defaults to those taking the fewest steps
+        outline        - whether templates called several times for the same registers
+                         may share a single copy to save lines at the cost of some steps
+        target         - the name of the machine in TARGETS to compile for
+        maxLines       - the largest number of Bonsai lines the program may have or None;
+                         the target may allow fewer
+        passManager    - the PassManager running the optimizations of the Bonsai code
+                         or None to run none of them
+        relocatable    - whether to compile to a relocatable object for the linker, in
+                         which gotos to labels not defined in the program are external
+        userLabels     - the names of the labels defined in the source in order, which
+                         other objects may jump to
 
     Methods:
-        fromSyntaxTree(ast) - fills the data structures with the data provided
-                              in the ast and compiles Python Bonsai to the
-                              intermediate code
-        compile()           - compile the intermediate code and return the
-                              equivalent Bonsai code
+        fromSyntaxTree(ast)   - fills the data structures with the data provided
+                                in the ast and compiles Python Bonsai to the
+                                intermediate code
+        copy()                - return a copy that can be optimized and compiled
+                                without changing the original
+        compile(sink, binary) - compile the intermediate code and return the
+                                equivalent Bonsai code or write it to a sink, or
+                                return a relocatable object
     """
 
     def __init__(self):
@@ -53,6 +100,36 @@ class IntermediateCode(object):
         """@type: int"""
         self.ifCount = 0
         """@type: int"""
+        self.loopCount = 0
+        """@type: int"""
+        self.conditionCount = 0
+        """@type: int"""
+        self.unrollLimit = 8
+        """@type: int"""
+        self.profile = None
+        """@type: dict"""
+        self.bonLines = []
+        """@type: list"""
+        self.sourceMap = []
+        """@type: list"""
+        self.costs = {}
+        """@type: dict"""
+        self.optimizerStats = {}
+        """@type: dict"""
+        self.templates = TEMPLATES["steps"]
+        """@type: dict"""
+        self.outline = False
+        """@type: bool"""
+        self.target = "extended"
+        """@type: str"""
+        self.maxLines = None
+        """@type: int"""
+        self.passManager = None
+        """@type: PassManager"""
+        self.relocatable = False
+        """@type: bool"""
+        self.userLabels = []
+        """@type: list"""
 
     def fromSyntaxTree(self, syntaxTree):
 
@@ -86,13 +163,79 @@ class IntermediateCode(object):
             """
             if node.typ in ["CONSTANT", "REGISTER"]:
                 self.instructions.append(Instruction(mode[0], baseOperand, Operand(node.typ, node.val)))
+            elif node.val in TERM_OPCODES:
+                addTerm(node, baseOperand, mode[0])
             else:
-                for child in node.children:
+                for child in sorted(node.children, key=lambda child: (child.val == "-") == (mode[0] == "add")):
+                    # when subtracting, the subtrahends of the expression are added first,
+                    # so that the register never drops below its final value
                     if child.val == "-":
-                        self.instructions.append(Instruction(mode[1], baseOperand, Operand(child.children[0].typ, child.children[0].val)))
+                        if child.children[0].val in TERM_OPCODES:
+                            addTerm(child.children[0], baseOperand, mode[1])
+                        else:
+                            self.instructions.append(Instruction(mode[1], baseOperand, Operand(child.children[0].typ, child.children[0].val)))
+                    elif child.val in TERM_OPCODES:
+                        addTerm(child, baseOperand, mode[0])
                     else:
                         self.instructions.append(Instruction(mode[0], baseOperand, Operand(child.typ, child.val)))
 
+        def calculateTerm(node, helpRegister: Operand):
+            """
+            Calculate a product, quotient or remainder in place in a help register.
+
+            The left operand is added to the help register, which is then
+            multiplied or divided by the right operand.
+
+            Parameters:
+                @param node:         the term to calculate
+                @param helpRegister: the help register to calculate the term in;
+                                     must be zero
+
+                @type node:         ASTNode
+                @type helpRegister: Operand
+            """
+            left, right = node.children
+            if left.val in TERM_OPCODES:
+                calculateTerm(left, helpRegister)
+            else:
+                self.instructions.append(Instruction("add", helpRegister, Operand(left.typ, left.val)))
+            self.instructions.append(Instruction(TERM_OPCODES[node.val], helpRegister, Operand(right.typ, right.val)))
+
+        def addTerm(node, baseOperand: Operand, opcode: str):
+            """
+            Add/subtract a product, quotient or remainder to/from baseOperand.
+
+            Parameters:
+                @param node:        the term to add or subtract
+                @param baseOperand: the register to add the term to
+                @param opcode:      either add or sub
+
+                @type node:        ASTNode
+                @type baseOperand: Operand
+                @type opcode:      str
+            """
+            helpRegister = getHelpRegister()
+            calculateTerm(node, helpRegister)
+            self.instructions.append(Instruction(opcode, baseOperand, helpRegister))
+            resetHelpRegister(helpRegister)
+
+        def calculateInHelpRegister(node, helpRegister: Operand):
+            """
+            Calculate the arithmetic expression in node in the given help register.
+
+            Parameters:
+                @param node:         an arithmetic expression node
+                @param helpRegister: the help register to calculate the expression in;
+                                     must be zero
+
+                @type node:         ASTNode
+                @type helpRegister: Operand
+            """
+            if node.val in TERM_OPCODES:
+                calculateTerm(node, helpRegister)
+            else:
+                calculateArithmeticExpression(node, helpRegister)
+
         def getArithmeticOperand(node) -> Operand:
             """
             Return an operand for the given arithmetic expression.
@@ -113,11 +256,267 @@ class IntermediateCode(object):
             if node.typ in ["CONSTANT", "REGISTER"]:
                 return Operand(node.typ, node.val)
             else:
-                helpRegister = Operand("HELP_REGISTER", self.helpRegisterCount)
-                self.helpRegisterCount += 1
-                calculateArithmeticExpression(node, helpRegister)
+                helpRegister = getHelpRegister()
+                calculateInHelpRegister(node, helpRegister)
                 return helpRegister
 
+        def getHelpRegister() -> Operand:
+            """
+            Return a new help register.
+
+            Please remember to set it to zero once it is no longer needed.
+
+            @return: the new help register
+            @rtype: Operand
+            """
+            helpRegister = Operand("HELP_REGISTER", self.helpRegisterCount)
+            self.helpRegisterCount += 1
+            return helpRegister
+
+        def resetHelpRegister(op: Operand):
+            """
+            Set the given operand to zero if it is a help register, so it can be reused.
+
+            Parameters:
+                @param op: the operand that is no longer needed
+
+                @type op: Operand
+            """
+            if op.typ == "HELP_REGISTER":
+                self.instructions.append(Instruction("mov", op, Operand("CONSTANT", "0")))
+                self.helpRegisterScopes[op.val] = len(self.instructions)
+
+        def getSwitchCases(node) -> tuple:
+            """
+            Return the cases of a chain of branches testing a register for equality with constants.
+
+            The chain is continued into else blocks consisting of a single branch only,
+            as constructed for elif, as long as the same register is tested.
+
+            Parameters:
+                @param node: the first branch of the chain
+
+                @type node: ASTNode
+
+            @return: the tested register, a list of constants and blocks in the order
+                     they are tested and the remaining else block
+            @rtype: tuple
+            """
+            register = None
+            cases = []
+            while node.children[0].val == "==":
+                operands = sorted(node.children[0].children, key=lambda child: child.typ != "REGISTER")
+                if ([child.typ for child in operands] != ["REGISTER", "CONSTANT"] or
+                    (register is not None and register.val != operands[0].val)):
+                    break
+                register = Operand("REGISTER", operands[0].val)
+                cases.append((Operand("CONSTANT", operands[1].val), node.children[1]))
+                if len(node.children[2].children) != 1 or node.children[2].children[0].typ != "BRANCH":
+                    return register, cases, node.children[2]
+                node = node.children[2].children[0]
+            return register, cases, node.parent if cases else None
+
+        def getConditionOperands(node, operands: dict) -> dict:
+            """
+            Return the operands of all comparisons in a condition.
+
+            Help registers are only allocated, their sums are calculated
+            when the comparison is reached.
+
+            Parameters:
+                @param node:     the condition, either a comparison or a boolean operator
+                @param operands: the dict to add the operands to
+
+                @type node:     ASTNode
+                @type operands: dict
+
+            @return: the operands of every comparison in the condition
+            @rtype: dict
+            """
+            if node.typ == "COMPARISON":
+                operands[node] = [Operand(child.typ, child.val) if child.typ in ["CONSTANT", "REGISTER"] else getHelpRegister()
+                                  for child in node.children]
+            else:
+                for child in node.children:
+                    getConditionOperands(child, operands)
+            return operands
+
+        def getConditionCost(node) -> int:
+            """
+            Return a rough estimate of the cost of evaluating a condition.
+
+            Tests against zero are cheapest, followed by comparisons with
+            constants, registers and finally calculated sums.
+
+            Parameters:
+                @param node: the condition, either a comparison or a boolean operator
+
+                @type node: ASTNode
+
+            @return: the estimated cost
+            @rtype: int
+            """
+            if node.typ == "COMPARISON":
+                return sum((0 if child.val == "0" else 1) if child.typ == "CONSTANT" else
+                           2 if child.typ == "REGISTER" else 4
+                           for child in node.children)
+            return sum(getConditionCost(child) for child in node.children)
+
+        def isTotal(node) -> bool:
+            """
+            Return whether evaluating a condition or expression never halts the program.
+
+            A subtraction may drop below zero and a quotient or remainder by a
+            register may divide by zero, both of which halt the program.
+
+            Parameters:
+                @param node: the condition or expression
+
+                @type node: ASTNode
+
+            @return: whether it can be evaluated for any values of the registers
+            @rtype: bool
+            """
+            if node.val == "-":
+                return False
+            elif node.val in ["//", "%"] and (node.children[1].typ != "CONSTANT" or node.children[1].val == "0"):
+                return False
+            return all(isTotal(child) for child in node.children)
+
+        def evaluationOrder(node) -> list:
+            """
+            Return the operands of an and/or in the order to evaluate them in.
+
+            Parameters:
+                @param node: the boolean operator
+
+                @type node: ASTNode
+
+            @return: the operands, cheapest first if none of them may halt the program
+            @rtype: list
+            """
+            if all(isTotal(child) for child in node.children):
+                return sorted(node.children, key=getConditionCost)
+            return node.children
+
+        def jumpIf(node, label: str, sense: bool, operands: dict):
+            """
+            Jump to label if the condition evaluates to sense and continue otherwise.
+
+            Composite conditions are short-circuited by a chain of comparisons
+            and jumps without any boolean temporaries. The operands of and/or are
+            evaluated cheapest first as comparisons do not have any side effects,
+            unless one of them may halt the program; then they are evaluated in
+            the order of the source, so that it is only evaluated where Python
+            evaluates it.
+
+            Parameters:
+                @param node:     the condition, either a comparison or a boolean operator
+                @param label:    the label to jump to
+                @param sense:    whether to jump if the condition is true or false
+                @param operands: the operands of the comparisons as returned by
+                                 getConditionOperands
+
+                @type node:     ASTNode
+                @type label:    str
+                @type sense:    bool
+                @type operands: dict
+            """
+            if node.typ == "COMPARISON":
+                opcode = {">": "jg", ">=": "jge", "<": "jl", "<=": "jle", "==": "je", "!=": "jne"}[node.val]
+                if not sense:
+                    opcode = {"jg": "jle", "jge": "jl", "jl": "jge", "jle": "jg", "je": "jne", "jne": "je"}[opcode]
+                if ((opcode, node.children[1].typ, node.children[1].val) == ("jl", "CONSTANT", "0") or
+                    (opcode, node.children[0].typ, node.children[0].val) == ("jg", "CONSTANT", "0")):
+                    return
+                    # a register can never be smaller than 0, so there is nothing to jump on
+                for op, child in zip(operands[node], node.children):
+                    if op.typ == "HELP_REGISTER":
+                        calculateInHelpRegister(child, op)
+                self.instructions.append(Instruction("cmp", operands[node][0], operands[node][1]))
+                self.instructions.append(Instruction(opcode, Operand("LABEL_IDENTIFIER", label), None))
+            elif node.val == "not":
+                jumpIf(node.children[0], label, not sense, operands)
+            elif (node.val == "and") == sense:
+                # all operands must evaluate to sense
+                skipLabel = ".COND_{}".format(self.conditionCount)
+                self.conditionCount += 1
+                children = evaluationOrder(node)
+                for child in children[:-1]:
+                    jumpIf(child, skipLabel, not sense, operands)
+                jumpIf(children[-1], label, sense, operands)
+                self.symbolTable[skipLabel] = len(self.instructions)
+            else:
+                # any operand evaluating to sense suffices
+                for child in evaluationOrder(node):
+                    jumpIf(child, label, sense, operands)
+
+        def leavesBlock(node) -> bool:
+            """
+            Return whether the execution never continues behind the given statement.
+
+            Parameters:
+                @param node: the statement or block to check
+
+                @type node: ASTNode
+
+            @return: whether the statement always ends in a goto or halt
+            @rtype: bool
+            """
+            if node.typ in ["GOTO", "HALT"]:
+                return True
+            elif node.typ == "BLOCK":
+                return bool(node.children) and leavesBlock(node.children[-1])
+            elif node.typ == "BRANCH":
+                return leavesBlock(node.children[1]) and leavesBlock(node.children[2])
+            return False
+
+        def appendUnconditional(instruction: Instruction):
+            """
+            Append an instruction that is never followed by the next line, i.e. a jmp or hlt.
+
+            Blocks laid out of line are appended right after it, so that they
+            are placed close to the code jumping to them. The innermost block
+            is appended first, so that the block of an outer branch may fall
+            through to its .ENDIF.
+
+            Parameters:
+                @param instruction: the jmp or hlt instruction
+
+                @type instruction: Instruction
+            """
+            self.instructions.append(instruction)
+            while outOfLineBlocks:
+                label, operands, block, endLabel, line = outOfLineBlocks.pop()
+                start = len(self.instructions)
+                self.symbolTable[label] = start
+                for op in operands:
+                    resetHelpRegister(op)
+                # the help registers of the condition are reset before returning
+                if block is not None:
+                    traverseTree(block)
+                if block is None or not leavesBlock(block):
+                    self.instructions.append(Instruction("jmp", Operand("LABEL_IDENTIFIER", endLabel), None))
+                attributeLines(start, line)
+                # the block belongs to its branch, not to the statement it follows
+
+        def attributeLines(start: int, line: int):
+            """
+            Attribute the instructions appended since start to a source line.
+
+            Instructions already attributed to a nested statement keep their line.
+
+            Parameters:
+                @param start: the index of the first instruction to attribute
+                @param line:  the source line of the statement the instructions were generated for
+
+                @type start: int
+                @type line:  int
+            """
+            for i in range(start, len(self.instructions)):
+                if self.instructions[i].line is None:
+                    self.instructions[i] = self.instructions[i]._replace(line=line)
+
         def traverseTree(node):
             """
             Traverse the syntax tree using recursion and compile the nodes.
@@ -127,275 +526,1055 @@ class IntermediateCode(object):
 
                 @type node: ASTNode
             """
+            start = len(self.instructions)
             if node.typ == "BLOCK":
                 for child in node.children:
                     traverseTree(child)
             elif node.typ == "LABEL":
                 self.symbolTable[node.children[0].val] = len(self.instructions)
+                self.userLabels.append(node.children[0].val)
             elif node.typ == "GOTO":
-                self.instructions.append(Instruction("jmp", Operand("LABEL_IDENTIFIER", node.children[0].val), None))
+                for loop, counter in loopCounters:
+                    if not containsLabel(loop, node.children[0].val):
+                        self.instructions.append(Instruction("mov", counter, Operand("CONSTANT", "0")))
+                        # the counters of the loops left by the jump must be reset
+                appendUnconditional(Instruction("jmp", Operand("LABEL_IDENTIFIER", node.children[0].val), None))
             elif node.typ == "HALT":
-                self.instructions.append(Instruction("hlt", None, None))
+                appendUnconditional(Instruction("hlt", None, None))
             elif node.typ == "ASSIGNMENT" and "DYNAMIC_ASSIGNMENT" in node.decorators:
                 op = getArithmeticOperand(node.children[1])
                 self.instructions.append(Instruction("mov", Operand("REGISTER", node.children[0].val), op))
-                if op.typ == "HELP_REGISTER":
-                    self.instructions.append(Instruction("mov", op, Operand("CONSTANT", "0")))
-                    self.helpRegisterScopes[op.val] = len(self.instructions)
+                resetHelpRegister(op)
                 # help registers must be reset after using them so they can be reused
+            elif node.typ == "ASSIGNMENT" and "SELF_REFERENCE" in node.decorators:
+                op = getArithmeticOperand(node.children[1])
+                self.instructions.append(Instruction({"+=": "add", "-=": "sub"}[node.val], Operand("REGISTER", node.children[0].val), op))
+                resetHelpRegister(op)
+                # the right side reads the variable, so it is calculated before the variable is changed
             elif node.typ == "ASSIGNMENT" and "AUGMENTED_ASSIGNMENT" in node.decorators:
                 calculateArithmeticExpression(node.children[1], Operand("REGISTER", node.children[0].val), {"+=": ("add", "sub"), "-=": ("sub", "add")}[node.val])
             elif node.typ == "DOCSTRING":
                 self.comments.append(node.val.replace("\r\n", "\n").replace("\n", ";"))
+            elif node.typ == "BRANCH" and len(getSwitchCases(node)[1]) > 1:
+                # a chain of branches testing the same register for equality
+                # with constants is compiled as:
+                #          cmp reg, $c0
+                #          je .CASE_0
+                #          cmp reg, $c1
+                #          je .CASE_1
+                #          ...
+                #          (else instructions)
+                #          ...
+                #          jmp .ENDIF
+                #  .CASE_0 (instructions of the first case)
+                #          ...
+                #          jmp .ENDIF
+                #  .CASE_1 (instructions of the second case)
+                #          ...
+                #   .ENDIF (next instructions)
+                #
+                # so that the comparisons can be compiled to a single ladder
+                ifCount = numbers[node]
+                register, cases, elseBlock = getSwitchCases(node)
+                self.symbolTable[".BRANCH_{}".format(ifCount)] = len(self.instructions)
+                for i, (constant, block) in enumerate(cases):
+                    self.instructions.append(Instruction("cmp", register, constant))
+                    self.instructions.append(Instruction("je", Operand("LABEL_IDENTIFIER", ".CASE_{}_{}".format(ifCount, i)), None))
+                self.symbolTable[".ELSE_{}".format(ifCount)] = len(self.instructions)
+                traverseTree(elseBlock)
+                for i, (constant, block) in enumerate(cases):
+                    appendUnconditional(Instruction("jmp", Operand("LABEL_IDENTIFIER", ".ENDIF_{}".format(ifCount)), None))
+                    self.symbolTable[".CASE_{}_{}".format(ifCount, i)] = len(self.instructions)
+                    traverseTree(block)
+                self.symbolTable[".ENDIF_{}".format(ifCount)] = len(self.instructions)
             elif node.typ == "BRANCH":
                 # a branch is compiled as:
                 #        cmp op1, op2
                 #        ji .IF
+                #        mov op1, $0 (if op1 is a help register)
+                #        mov op2, $0 (if op2 is a help register)
                 #        (else instructions)
                 #        ...
                 #        jmp .ENDIF
-                #    .IF (if instructions)
+                #    .IF mov op1, $0 (if op1 is a help register)
+                #        mov op2, $0 (if op2 is a help register)
+                #        (if instructions)
                 #        ...
                 # .ENDIF (next instructions)
                 #
                 # where op1, op2 can be registers or constants
-                # please note that constants are moved into help registers first
                 # ji being jg, jge, jl, jle, je or jne depending on the condition
-                ifCount = self.ifCount
-                self.ifCount += 1
-                op1 = getArithmeticOperand(node.children[0].children[0])
-                op2 = getArithmeticOperand(node.children[0].children[1])
-                self.instructions.append(Instruction("cmp", op1, op2))
-                self.instructions.append(Instruction({">": "jg", ">=": "jge", "<": "jl", "<=": "jle", "==": "je", "!=": "jne"}[node.children[0].val], Operand("LABEL_IDENTIFIER", ".IF_{}".format(ifCount)), None))
-                traverseTree(node.children[2])
-                self.instructions.append(Instruction("jmp", Operand("LABEL_IDENTIFIER", ".ENDIF_{}".format(ifCount)), None))
-                self.symbolTable[".IF_{}".format(ifCount)] = len(self.instructions)
+                # composite conditions use a chain of comparisons instead
+                #
+                # the condition is inverted and the if instructions are placed first
+                # if the else block is empty or only the if block ends with a jump,
+                # so that the jmp .ENDIF is not needed:
+                #        cmp op1, op2
+                #        jni .ELSE
+                #        mov op1, $0 (if op1 is a help register)
+                #        mov op2, $0 (if op2 is a help register)
+                #        (if instructions)
+                #        ...
+                #  .ELSE mov op1, $0 (if op1 is a help register)
+                #        mov op2, $0 (if op2 is a help register)
+                #        (else instructions)
+                #        ...
+                # .ENDIF (next instructions)
+                #
+                # an empty else block only resetting help registers is laid out of line
+                # behind the next jmp or hlt and jumps back to .ENDIF
+                #
+                # if a profile is available, the block executed more often is placed
+                # first, so that it is reached without a jump; a rarely executed if block
+                # without else block is laid out of line itself
+                ifCount = numbers[node]
+                labels = dict((name, ".{}_{}".format(name, ifCount)) for name in ["BRANCH", "IF", "ELSE", "ENDIF"])
+                operands = getConditionOperands(node.children[0], {})
+                helpRegisters = [op for op in chain.from_iterable(operands.values()) if op.typ == "HELP_REGISTER"]
+                ifBlock, elseBlock = node.children[1:]
+                self.symbolTable[labels["BRANCH"]] = len(self.instructions)
+                if self.profile is not None and labels["BRANCH"] in self.profile["labels"]:
+                    ifFirst = 2*self.profile["labels"].get(labels["IF"], 0) >= self.profile["labels"][labels["BRANCH"]]
+                    # the if block was executed at least as often as the else block
+                else:
+                    ifFirst = not elseBlock.children or (leavesBlock(ifBlock) and not leavesBlock(elseBlock))
+                if not elseBlock.children and not ifFirst:
+                    jumpIf(node.children[0], labels["IF"], True, operands)
+                    outOfLineBlocks.append((labels["IF"], helpRegisters, ifBlock, labels["ENDIF"], node.line))
+                    self.symbolTable[labels["ELSE"]] = len(self.instructions)
+                    for op in helpRegisters:
+                        resetHelpRegister(op)
+                elif ifFirst:
+                    jumpIf(node.children[0], labels["ELSE"], False, operands)
+                    outOfLine = not elseBlock.children and helpRegisters
+                    if outOfLine:
+                        outOfLineBlocks.append((labels["ELSE"], helpRegisters, None, labels["ENDIF"], node.line))
+                    self.symbolTable[labels["IF"]] = len(self.instructions)
+                    for op in helpRegisters:
+                        resetHelpRegister(op)
+                    traverseTree(ifBlock)
+                    if not outOfLine:
+                        if elseBlock.children and not leavesBlock(ifBlock):
+                            appendUnconditional(Instruction("jmp", Operand("LABEL_IDENTIFIER", labels["ENDIF"]), None))
+                        self.symbolTable[labels["ELSE"]] = len(self.instructions)
+                        for op in helpRegisters:
+                            resetHelpRegister(op)
+                        traverseTree(elseBlock)
+                else:
+                    jumpIf(node.children[0], labels["IF"], True, operands)
+                    self.symbolTable[labels["ELSE"]] = len(self.instructions)
+                    for op in helpRegisters:
+                        resetHelpRegister(op)
+                    traverseTree(elseBlock)
+                    if not leavesBlock(elseBlock):
+                        appendUnconditional(Instruction("jmp", Operand("LABEL_IDENTIFIER", labels["ENDIF"]), None))
+                    self.symbolTable[labels["IF"]] = len(self.instructions)
+                    for op in helpRegisters:
+                        resetHelpRegister(op)
+                    traverseTree(ifBlock)
+                self.symbolTable[labels["ENDIF"]] = len(self.instructions)
+                # help registers are reset at the start of both blocks, so that they
+                # are zero again even if a block is left by a goto
+            elif node.typ == "CONDITIONAL_LOOP":
+                # a while loop is compiled as:
+                #             jmp .WHILE_COND
+                #      .WHILE mov op1, $0 (if op1 is a help register)
+                #             mov op2, $0 (if op2 is a help register)
+                #             (loop instructions)
+                #             ...
+                # .WHILE_COND cmp op1, op2
+                #             ji .WHILE
+                #             mov op1, $0 (if op1 is a help register)
+                #             mov op2, $0 (if op2 is a help register)
+                #
+                # so that an iteration only costs the loop instructions
+                # and a single comparison with its conditional jump
+                loopCount = numbers[node]
+                operands = getConditionOperands(node.children[0], {})
+                # help registers are needed before their sums are calculated
+                appendUnconditional(Instruction("jmp", Operand("LABEL_IDENTIFIER", ".WHILE_COND_{}".format(loopCount)), None))
+                self.symbolTable[".WHILE_{}".format(loopCount)] = len(self.instructions)
+                for op in chain.from_iterable(operands.values()):
+                    if op.typ == "HELP_REGISTER":
+                        self.instructions.append(Instruction("mov", op, Operand("CONSTANT", "0")))
+                # help registers still contain the sums of the previous comparison
                 traverseTree(node.children[1])
-                self.symbolTable[".ENDIF_{}".format(ifCount)] = len(self.instructions)
-                if op1.typ == "HELP_REGISTER":
-                    self.instructions.append(Instruction("mov", op1, Operand("CONSTANT", "0")))
-                    self.helpRegisterScopes[op1.val] = len(self.instructions)
-                if op2.typ == "HELP_REGISTER":
-                    self.instructions.append(Instruction("mov", op2, Operand("CONSTANT", "0")))
-                    self.helpRegisterScopes[op2.val] = len(self.instructions)
+                self.symbolTable[".WHILE_COND_{}".format(loopCount)] = len(self.instructions)
+                jumpIf(node.children[0], ".WHILE_{}".format(loopCount), True, operands)
+                self.symbolTable[".ENDWHILE_{}".format(loopCount)] = len(self.instructions)
+                for op in chain.from_iterable(operands.values()):
+                    resetHelpRegister(op)
                 # help registers must be reset after using them so they can be reused
+            elif node.typ == "COUNTED_LOOP":
+                # a for loop is compiled as:
+                #           add h, count
+                #           jmp .FOR_COND
+                #      .FOR sub h, $1
+                #           (loop instructions)
+                #           ...
+                # .FOR_COND cmp h, $0
+                #           jne .FOR
+                #
+                # where h is a help register counting down the remaining iterations,
+                # so an iteration costs a single TST, DEC and JMP
+                # h is zero once the loop is left and needn't be reset,
+                # unless the loop is left by a goto, which resets it
+                loopCount = numbers[node]
+                counter = getHelpRegister()
+                calculateInHelpRegister(node.children[1], counter)
+                appendUnconditional(Instruction("jmp", Operand("LABEL_IDENTIFIER", ".FOR_COND_{}".format(loopCount)), None))
+                self.symbolTable[".FOR_{}".format(loopCount)] = len(self.instructions)
+                self.instructions.append(Instruction("sub", counter, Operand("CONSTANT", "1")))
+                loopCounters.append((node, counter))
+                traverseTree(node.children[2])
+                loopCounters.pop()
+                self.symbolTable[".FOR_COND_{}".format(loopCount)] = len(self.instructions)
+                self.instructions.append(Instruction("cmp", counter, Operand("CONSTANT", "0")))
+                self.instructions.append(Instruction("jne", Operand("LABEL_IDENTIFIER", ".FOR_{}".format(loopCount)), None))
+                self.symbolTable[".ENDFOR_{}".format(loopCount)] = len(self.instructions)
+                self.helpRegisterScopes[counter.val] = len(self.instructions)
+            if node.line is not None:
+                attributeLines(start, node.line)
+
+        def containsLabel(node, name: str) -> bool:
+            """
+            Return whether the given label is placed anywhere within the given node.
+
+            Parameters:
+                @param node: the node to search
+                @param name: the name of the label
+
+                @type node: ASTNode
+                @type name: str
+
+            @return: True if the label is found
+            @rtype: bool
+            """
+            return ((node.typ == "LABEL" and node.children[0].val == name) or
+                    any(containsLabel(child, name) for child in node.children))
+
+        def numberStatements(node):
+            """
+            Number all branches and loops in the order of the source code.
+
+            The numbers are used in the labels of the statements, so that they
+            do not depend on the chosen layout and can be looked up in a profile.
+
+            Parameters:
+                @param node: the node whose statements to number
 
+                @type node: ASTNode
+            """
+            if node.typ == "BRANCH":
+                numbers[node] = self.ifCount
+                self.ifCount += 1
+            elif node.typ in ["CONDITIONAL_LOOP", "COUNTED_LOOP"]:
+                numbers[node] = self.loopCount
+                self.loopCount += 1
+            for child in node.children:
+                numberStatements(child)
+
+        outOfLineBlocks = []
+        loopCounters = []
+        numbers = {}
+        numberStatements(syntaxTree.root)
         self.symbolTable = syntaxTree.symbolTable
         self.registers = syntaxTree.registers
         # start with the symbol table and the registers from the ast
         traverseTree(syntaxTree.root)
-        self.instructions.append(Instruction("hlt", None, None))
+        appendUnconditional(Instruction("hlt", None, None))
         # a 'hlt' is needed at the end of file to end the execution
+        for label in dict.fromkeys(instruction.op1.val for instruction in self.instructions
+                                   if instruction.opcode == "jmp" and instruction.op1.val not in self.symbolTable):
+            if not self.relocatable:
+                raise CompilerError("The label {} is not defined.".format(label))
+            self.symbolTable[label] = len(self.instructions)
+            self.instructions.append(Instruction("ext", Operand("LABEL_IDENTIFIER", label), None))
+            # every external label is jumped to through a stub left unresolved for the linker
+
+    def copy(self):
+        """
+        Return a copy that can be optimized and compiled without changing the original.
 
-    def compile(self) -> str:
+        Instructions and operands are immutable and the profile and templates are
+        only read, so they are shared; the lists and tables are copied.
 
+        @return: the copy
+        @rtype: IntermediateCode
         """
-        Compile the intermediate code and return the Bonsai code.
+        code = IntermediateCode.__new__(IntermediateCode)
+        code.__dict__.update(self.__dict__)
+        for name in ["instructions", "symbolTable", "registers", "comments", "helpRegisterScopes", "bonLines",
+                     "sourceMap", "costs", "optimizerStats", "userLabels"]:
+            setattr(code, name, getattr(self, name).copy())
+        return code
+
+    def compile(self, sink=None, binary=False) -> str:
+
+        """
+        Compile the intermediate code and return the Bonsai code or write it to a sink.
 
         Contains helper functions for every intermediate instruction, that
         compile them to a series of equivalent Bonsai instructions.
         First compiles every instruction one after another and translates
         the intermediate code lines into Bonsai lines, e.g. for labels.
         It then replaces labels and relative addressing by absolute addresses
-        and proceeds to substitute help registers by actual registers.
+        and proceeds to assign actual registers to help registers.
         A list of free help registers is always kept so that they can be reused
         in order to keep the number of help registers minimal.
+        Addresses are written as wide as the target allows, and a SizeError is
+        raised if the lines or registers do not fit it or maxLines.
+        With a sink, every line is formatted and written when it is reached
+        instead of joining the whole program into one string first; nothing is
+        written to it if a SizeError is raised. A binary program, see
+        binary_format, is packed at once and written to a binary sink.
+        Relocatable code is returned as an object for the linker instead,
+        without optimizing the Bonsai code or checking its size, as both
+        depend on the other objects; the sink and format are ignored then.
+
+        Parameters:
+            @param sink:   a file-like object the Bonsai code is written to or None
+            @param binary: whether to return the program in the binary format
+
+            @type sink:   TextIO
+            @type binary: bool
 
-        @return: actual Bonsai code
+        @return: actual Bonsai code, a binary program, a relocatable object as a dict
+                 or None if it was written to the sink
         @rtype: str
         """
 
         storage = type("Storage", (object, ), {
             "helpRegisterCount": self.helpRegisterCount,
-            "head": 0
+            "head": 0,
+            "line": None,
+            "costFactor": 1
         })()
-        bonInstructions = []
+        bonInstructions = InstructionStream()
+        JMP, TST, HLT = (InstructionStream.NUMBERS[opcode] for opcode in ["JMP", "TST", "HLT"])
+        self.bonLines = []
+        self.costs = {}
+        values = {}
         helpRegisterScopes = {}
+        constantRegisters = {}
+        calls = []
+        reservedHelpRegisters = []
+        forSize = self.templates is TEMPLATES["size"]
+        # the templates for size make every instruction use its shorter code
+
+        def isCold() -> bool:
+            # return whether the current instruction was never executed in the runs of the profile
+            return self.profile is not None and lineCounts[storage.head] == 0
+
+        def getUnrollLimit() -> int:
+            # return the largest constant to unroll the current instruction for
+            # instructions executed more than once per run of the profile are hot
+            # and unrolled further, those never executed are kept small
+            if self.profile is None:
+                return self.unrollLimit
+            elif isCold():
+                return 0
+            elif lineCounts[storage.head] > self.profile["runs"]:
+                return self.unrollLimit*4
+            return self.unrollLimit
+
+        def shorterUnrolled(code: list, length: int) -> bool:
+            # return whether the unrolled code of an instruction is kept instead of code reading
+            # the constant from a register, which takes the given number of lines; with the
+            # templates for size only code taking no more lines than that is unrolled
+            return not forSize or sum(1 for opcode, operand in code if opcode is not None) <= length
+
+        def valueOf(op):
+            # return the value of an operand for a cost: the constant, the name of the register
+            # or the expression calculated in the help register
+            if op.typ == "HELP_REGISTER":
+                return values.get(op.val, 0)
+            elif op.typ == "CONSTANT" or op.val[0] == "$":
+                return int(op.val.lstrip("$"))
+            return op.val
+
+        def factor(value) -> str:
+            # return a value as factor of a product
+            return value if type(value) == int or re.fullmatch(r"\w+|min\(.*\)", value) else "({})".format(value)
+
+        def addCost(constant: int, *terms, approximate=False):
+            # add the steps the current instruction takes when executed once to the cost of
+            # its source line; every term is a coefficient followed by the values it is multiplied
+            # with, constant values are folded into the coefficient
+            cost = self.costs.setdefault(storage.line, {"steps": {}, "approximate": False, "helpRegisters": 0})
+            for coefficient, *factors in ((constant, ), ) + terms:
+                products = [(coefficient, [])]
+                for value in factors + [storage.costFactor]:
+                    if type(value) == str and re.fullmatch(r"\w+(?:[·+]\w+)*", value):
+                        summands = [summand.split("·") for summand in value.split("+")]
+                    else:
+                        summands = [[value]]
+                    # sums of products are multiplied out so that equal terms are summed up
+                    expanded = []
+                    for product, names in products:
+                        for summand in summands:
+                            product2, names2 = product, list(names)
+                            for part in summand:
+                                if type(part) == int or part.isdigit():
+                                    product2 *= int(part)
+                                else:
+                                    names2.append(factor(part))
+                            expanded.append((product2, names2))
+                    products = expanded
+                for product, names in products:
+                    if product:
+                        term = "·".join(sorted(names))
+                        cost["steps"][term] = cost["steps"].get(term, 0)+product
+            cost["approximate"] = cost["approximate"] or approximate
+
+        def trackValue(instruction: Instruction):
+            # follow the expression calculated in a help register
+            # so that costs can be stated in terms of the source
+            if instruction.opcode not in TERM_OPCODES.values() and instruction.opcode not in ["add", "sub", "mov"]:
+                return
+            elif instruction.op1.typ != "HELP_REGISTER":
+                return
+            old = values.get(instruction.op1.val, 0)
+            value = valueOf(instruction.op2)
+            if instruction.opcode == "mov" or (instruction.opcode == "add" and old == 0):
+                values[instruction.op1.val] = value
+            elif type(old) == int and type(value) == int:
+                values[instruction.op1.val] = {
+                    "add": lambda: old+value,
+                    "sub": lambda: max(old-value, 0),
+                    "mul": lambda: old*value,
+                    "div": lambda: old//value if value else 0,
+                    "mod": lambda: old%value if value else 0
+                }[instruction.opcode]()
+            elif instruction.opcode in ["add", "sub"]:
+                values[instruction.op1.val] = "{}{}{}".format(old, "+" if instruction.opcode == "add" else "-",
+                                                              factor(value) if instruction.opcode == "sub" else value)
+            else:
+                values[instruction.op1.val] = "{}{}{}".format(factor(old), {"mul": "·", "div": "//", "mod": "%"}[
+                                                              instruction.opcode], factor(value))
 
         # helper functions for compiling single instructions
         def compile_add(op1, op2):
-            if op2.typ == "CONSTANT":
+            if op2.typ == "CONSTANT" and int(op2.val) > len(self.templates["add"]["code"]) and (isCold() or forSize):
+                compile_add(op1, Operand("REGISTER", getConstantRegister(op2.val)))
+                # a never executed or size-first addition of a constant is shorter using the constant
+                # pool once it takes more INC instructions than the template adding a register
+            elif op2.typ == "CONSTANT":
                 bonInstructions.extend([("INC", op1.val)]*int(op2.val))
+                addCost(int(op2.val))
                 # adding n is done by n INC instructions
             elif op2.typ in ["REGISTER", "HELP_REGISTER"]:
-                op1 = op1.val
-                op2 = op2.val
-                bonInstructions.extend([
-                    ("TST", op2),
-                    ("JMP", "@+8"),
-                    ("TST", storage.helpRegisterCount),
-                    ("JMP", "@+2"),
-                    ("JMP", "@+8"),
-                    ("DEC", storage.helpRegisterCount),
-                    ("INC", op1),
-                    ("INC", op2),
-                    ("JMP", "@-6"),
-                    ("DEC", op2),
-                    ("INC", storage.helpRegisterCount),
-                    ("JMP", "@-11"),
-                ])
-                # works by first moving the register to be added into a help register
-                # and moving it back to the source and adding it to the destination
-                helpRegisterScopes[storage.helpRegisterCount] = len(bonInstructions)
-                storage.helpRegisterCount += 1
+                extendWithTemplate("add", {"x": op1.val, "y": op2.val}, {"y": valueOf(op2)})
+                # works by moving the register to be added into a help register
+                # and moving it back to the source while adding it to the destination
 
         def compile_sub(op1, op2):
-            if op2.typ == "CONSTANT":
+            if op2.typ == "CONSTANT" and int(op2.val) > len(self.templates["sub"]["code"]) and (isCold() or forSize):
+                compile_sub(op1, Operand("REGISTER", getConstantRegister(op2.val)))
+            elif op2.typ == "CONSTANT":
                 bonInstructions.extend([("DEC", op1.val)]*int(op2.val))
+                addCost(int(op2.val))
                 # subtracting n is done by n DEC instructions
+            elif op2 == op1:
+                compile_mov(op1, Operand("CONSTANT", "0"))
+                # subtracting a register from itself clears it
             elif op2.typ in ["REGISTER", "HELP_REGISTER"]:
-                op1 = op1.val
-                op2 = op2.val
-                bonInstructions.extend([
-                    ("TST", op2),
-                    ("JMP", "@+8"),
-                    ("TST", storage.helpRegisterCount),
-                    ("JMP", "@+2"),
-                    ("JMP", "@+8"),
-                    ("DEC", storage.helpRegisterCount),
-                    ("DEC", op1),
-                    ("INC", op2),
-                    ("JMP", "@-6"),
-                    ("DEC", op2),
-                    ("INC", storage.helpRegisterCount),
-                    ("JMP", "@-11"),
-                ])
-                # works by first moving the register to be subtracted into a help register
-                # and moving it back to the source and subtracting it from the destination
-                helpRegisterScopes[storage.helpRegisterCount] = len(bonInstructions)
-                storage.helpRegisterCount += 1
+                extendWithTemplate("sub", {"x": op1.val, "y": op2.val}, {"y": valueOf(op2)})
+                # works by moving the register to be subtracted into a help register
+                # and moving it back to the source while subtracting it from the destination
 
         def compile_mov(op1, op2):
             if op2.typ == "CONSTANT":
-                bonInstructions.extend([
-                    ("TST", op1.val),
-                    ("JMP", "@+2"),
-                    ("JMP", "@+3"),
-                    ("DEC", op1.val),
-                    ("JMP", "@-4")
-                ])
+                extendWithTemplate("clear", {"x": op1.val}, {"x": valueOf(op1)})
                 compile_add(op1, op2)
                 # moving a constant works by setting the register to 0
                 # and adding the constant
+            elif op2 == op1:
+                pass
+                # moving a register to itself does nothing
+            elif (storage.head+1 < len(self.instructions) and storage.head+1 not in labelLines and
+                  self.instructions[storage.head+1][:3] == ("mov", op2, Operand("CONSTANT", "0"))):
+                extendWithTemplate("mov_reset", {"x": op1.val, "y": op2.val}, {"x": valueOf(op1), "y": valueOf(op2)})
+                storage.head += 1
+                trackValue(self.instructions[storage.head])
+                # the source is reset right after the move, typically a help register holding
+                # a calculated value, so the value is moved without restoring the source
             elif op2.typ in ["REGISTER", "HELP_REGISTER"]:
-                compile_mov(op1, Operand("CONSTANT", "0"))
-                # the register is set to 0
-                compile_add(op1, op2)
-                # and the register added
+                extendWithTemplate("mov", {"x": op1.val, "y": op2.val}, {"x": valueOf(op1), "y": valueOf(op2)})
+                # the register is set to 0 and the source added
 
         def compile_hlt(op1, op2):
             bonInstructions.append(("HLT", None))
+            addCost(1)
 
         def compile_jmp(op1, op2):
             bonInstructions.append(("JMP", op1.val))
+            addCost(1)
+
+        def compile_ext(op1, op2):
+            bonInstructions.append(("JMP", op1.val))
+            # the jump to the external label keeps its name until the objects are linked
 
         def compile_cmp(op1, op2):
             storage.head += 1
             # this function also consumes the following jmp instruction
             # to determine what kind of condition needs to be checked
             branch = self.instructions[storage.head]
+            opcode = branch.opcode
+            if op1.typ == "CONSTANT" and op2.typ == "CONSTANT":
+                # a comparison of two constants is decided at compile time
+                if {
+                    "jg": int(op1.val) > int(op2.val),
+                    "jge": int(op1.val) >= int(op2.val),
+                    "jl": int(op1.val) < int(op2.val),
+                    "jle": int(op1.val) <= int(op2.val),
+                    "je": int(op1.val) == int(op2.val),
+                    "jne": int(op1.val) != int(op2.val)
+                }[opcode]:
+                    bonInstructions.append(("JMP", branch.op1.val))
+                    addCost(1)
+                return
+            if op1 == op2:
+                # an operand compared with itself is always equal
+                if opcode in ["jge", "jle", "je"]:
+                    bonInstructions.append(("JMP", branch.op1.val))
+                    addCost(1)
+                return
+            if op1.typ == "CONSTANT":
+                op1, op2 = op2, op1
+                opcode = {"jg": "jl", "jge": "jle", "jl": "jg", "jle": "jge"}.get(opcode, opcode)
+                # mirror the condition so that the constant is always the second operand
+            if opcode == "je" and op1.typ == "REGISTER" and op2.typ == "CONSTANT":
+                cases = [(int(op2.val), branch.op1.val)]
+                head = storage.head
+                while (head+2 < len(self.instructions) and
+                       self.instructions[head+1].opcode == "cmp" and
+                       self.instructions[head+1].op1 == op1 and
+                       self.instructions[head+1].op2.typ == "CONSTANT" and
+                       self.instructions[head+2].opcode == "je" and
+                       head+1 not in labelLines and head+2 not in labelLines):
+                    cases.append((int(self.instructions[head+1].op2.val), self.instructions[head+2].op1.val))
+                    head += 2
+                    # consecutive tests of the same register for equality with constants
+                    # can be decided together
+                constants = set(constant for constant, target in cases)
+                if len(constants) > 1 and max(constants) <= getUnrollLimit()*len(constants):
+                    switch = switchLadder(op1.val, cases)
+                    if shorterUnrolled(switch, sum(3 if constant == 0 else len(self.templates["cmp_je"]["code"])
+                                                   for constant, target in cases)):
+                        storage.head = head
+                        extendWithLocalLabels(switch)
+                        addCost(4*max(constants)+3)
+                        return
+                    # with the templates for size, a switch is only kept if it is no longer than
+                    # the comparisons with 0 and the templates it replaces
             if op2.val == "0":
+                addCost(1 if opcode == "jge" else 2)
                 # any comparison with 0 is fast
-                if branch.opcode in ["jg", "jne"]:
+                if opcode in ["jg", "jne"]:
                     bonInstructions.extend([
                         ("TST", op1.val),
                         ("JMP", branch.op1.val)
                     ])
-                elif branch.opcode == "jge":
+                elif opcode == "jge":
                     bonInstructions.extend([
                         ("JMP", branch.op1.val)
                     ])
-                elif branch.opcode == "jl":
+                elif opcode == "jl":
                     raise CompilerError("Register can never be smaller than 0.")
-                elif branch.opcode in ["jle", "je"]:
+                elif opcode in ["jle", "je"]:
                     bonInstructions.extend([
                         ("TST", op1.val),
                         ("JMP", "@+2"),
                         ("JMP", branch.op1.val)
                     ])
+            elif (op2.typ == "CONSTANT" and int(op2.val) <= getUnrollLimit() and
+                  shorterUnrolled(comparisonLadder(op1.val, int(op2.val), opcode, branch.op1.val),
+                                  len(self.templates["cmp_"+opcode]["code"]))):
+                bonInstructions.extend(comparisonLadder(op1.val, int(op2.val), opcode, branch.op1.val))
+                addCost(4*int(op2.val)+4)
             else:
-                # these are the relative position of the true and false
-                # branches from the various possible jump points
-                # whether true or false is chosen during compilation
-                # depends on the kind of condition
-                LABEL1_TRUE = 9; LABEL1_FALSE = 14
-                LABEL2_TRUE = 8; LABEL2_FALSE = 13
-                LABEL3_TRUE = 5; LABEL3_FALSE = 10
-                LABEL_RESTORE_BACK = 4
-                LABEL_ELSE = 3
-                register_sequence = []
-                # will contain a list of instructions to increment the registers
-                if op1.typ == "CONSTANT":
-                    hr = storage.helpRegisterCount
-                    storage.helpRegisterCount += 1
-                    compile_add(Operand("HELP_REGISTER", hr), op1)
-                    op1 = hr
-                else:
-                    op1 = op1.val
-                    register_sequence.append(("INC", op1))
+                values1, values2 = valueOf(op1), valueOf(op2)
                 if op2.typ == "CONSTANT":
-                    hr = storage.helpRegisterCount
-                    storage.helpRegisterCount += 1
-                    compile_add(Operand("HELP_REGISTER", hr), op2)
-                    op2 = hr
+                    op2 = Operand("REGISTER", getConstantRegister(op2.val))
+                # large constants are read from a preset register of the constant pool,
+                # which is restored like any other register after the comparison
+                extendWithTemplate("cmp_"+opcode, {"x": op1.val, "y": op2.val, "target": branch.op1.val}, {
+                    "min(x,y)": min(values1, values2) if type(values1) == type(values2) == int else
+                                "min({},{})".format(values1, values2)})
+                # both registers are counted down to the smaller one in a help register,
+                # which tells the relation of the registers, and then restored
+
+        def switchLadder(register, cases: list) -> list:
+            # return the code of a chain of tests for equality with constants c_i, which is:
+            #          TST x         (these four lines are repeated max(c_i) times)
+            #          JMP @+2
+            #          JMP CASE_v    x was v, jump to the case of v or the default
+            #          DEC x
+            #          TST x
+            #          JMP DEFAULT
+            #   CASE_v INC x         (v times for every case v, largest first)
+            #          JMP target_v
+            #  DEFAULT INC x         (max(c_i) times)
+            #
+            # a default entry restores v decrements by entering the ladder
+            # of the default case v lines before its end
+            targets = {}
+            for constant, target in cases:
+                targets.setdefault(constant, target)
+                # the first test for a constant takes precedence
+            largest = max(targets)
+            switch = []
+            for value in range(largest):
+                if value not in targets:
+                    target = ("@", "DEFAULT_{}".format(largest-value))
+                elif value == 0:
+                    target = targets[value]
                 else:
-                    op2 = op2.val
-                    register_sequence.append(("INC", op2))
-                # constants are moved into help registers before the actual comparison
-                # as this may cause code bloat please avoid that as much as possible
-                LABEL1_TRUE = "@+{}".format(LABEL1_TRUE)
-                LABEL2_TRUE = "@+{}".format(LABEL2_TRUE)
-                LABEL3_TRUE = "@+{}".format(LABEL3_TRUE)
-                LABEL1_FALSE = "@+{}".format(LABEL1_FALSE+len(register_sequence))
-                LABEL2_FALSE = "@+{}".format(LABEL2_FALSE+len(register_sequence))
-                LABEL3_FALSE = "@+{}".format(LABEL3_FALSE+len(register_sequence))
-                LABEL_RESTORE_BACK = "@-{}".format(LABEL_RESTORE_BACK+len(register_sequence))
-                LABEL_ELSE = "@+{}".format(LABEL_ELSE+len(register_sequence))
-                # depending on how many help registers are needed the places to jump vary
-                LABEL1, LABEL2, LABEL3 = {
-                    "je": (LABEL1_FALSE, LABEL2_TRUE, LABEL3_FALSE),
-                    "jne": (LABEL1_TRUE, LABEL2_FALSE, LABEL3_TRUE),
-                    "jg": (LABEL1_FALSE, LABEL2_FALSE, LABEL3_TRUE),
-                    "jge": (LABEL1_FALSE, LABEL2_TRUE, LABEL3_TRUE),
-                    "jl": (LABEL1_TRUE, LABEL2_FALSE, LABEL3_FALSE),
-                    "jle": (LABEL1_TRUE, LABEL2_TRUE, LABEL3_FALSE)
-                }[branch.opcode]
-                # this is a jump table for the various possible conditions
-                bonInstructions.extend([
-                    ("TST", op1),
-                    ("JMP", "@+4"),
-                    ("TST", op2),
-                    ("JMP", LABEL1),
-                    ("JMP", LABEL2),
-                    ("TST", op2),
+                    target = ("@", "CASE_{}".format(value))
+                switch.extend([
+                    ("TST", register),
                     ("JMP", "@+2"),
-                    ("JMP", LABEL3),
-                    ("DEC", op1),
-                    ("DEC", op2),
-                    ("INC", storage.helpRegisterCount),
-                    ("JMP", "@-11"),
-                    ("TST", storage.helpRegisterCount),
+                    ("JMP", target),
+                    ("DEC", register)
+                ])
+            switch.extend([
+                ("TST", register),
+                ("JMP", ("@", "DEFAULT_0"))
+            ])
+            for value in sorted(targets, reverse=True):
+                if value:
+                    switch.extend([(None, "CASE_{}".format(value))] + [("INC", register)]*value + [("JMP", targets[value])])
+                    # the largest case directly follows the last test
+            for i in range(largest):
+                switch.extend([(None, "DEFAULT_{}".format(i)), ("INC", register)])
+            switch.append((None, "DEFAULT_{}".format(largest)))
+            return switch
+
+        def comparisonLadder(register, constant: int, opcode: str, target: str) -> list:
+            # return the code of a comparison against a small constant k, which is:
+            #        TST x         (these four lines are repeated k times)
+            #        JMP @+2
+            #        JMP LESS      x was smaller than k
+            #        DEC x
+            #        TST x         (only if x == k and x > k branch differently)
+            #        JMP GREATER
+            #        JMP EQUAL
+            #  TRUE  INC x         (k times)
+            #        JMP target
+            # FALSE  INC x         (k times)
+            #
+            # every exit enters a restore ladder k-i lines below its start
+            # so that exactly the i decrements done so far are undone
+            less, equal, greater = {
+                "je": (False, True, False),
+                "jne": (True, False, True),
+                "jg": (False, False, True),
+                "jge": (False, True, True),
+                "jl": (True, False, False),
+                "jle": (True, True, False)
+            }[opcode]
+            # this is a jump table for the various possible conditions
+            chain = []
+            for i in range(constant):
+                chain.extend([
+                    ("TST", register),
                     ("JMP", "@+2"),
-                    ("JMP", branch.op1.val),
-                    ("DEC", storage.helpRegisterCount)] +
-                    register_sequence + [
-                    ("JMP", LABEL_RESTORE_BACK),
-                    ("TST", storage.helpRegisterCount),
+                    ("JMP", target if less and i == 0 else (less, constant-i)),
+                    ("DEC", register)
+                ])
+            if equal != greater:
+                chain.extend([
+                    ("TST", register),
+                    ("JMP", (greater, 0))
+                ])
+            if not equal:
+                chain.append(("JMP", (False, 0)))
+            # the true ladder directly follows, so it needn't be jumped to
+            ladders = {True: len(chain), False: len(chain)+constant+1}
+            for line, (bonOpcode, operand) in enumerate(chain):
+                if type(operand) == tuple:
+                    chain[line] = (bonOpcode, "@{:+d}".format(ladders[operand[0]]+operand[1]-line))
+                    # resolve the ladder entries to relative addresses
+            return chain + [("INC", register)]*constant + [("JMP", target)] + [("INC", register)]*constant
+
+        def compile_mul(op1, op2):
+            # op1 is multiplied in place by first moving it into a help register
+            # and then draining the help register while adding op2 to op1 for each unit
+            helpRegister = storage.helpRegisterCount
+            storage.helpRegisterCount += 1
+            compile_drain(op1.val, helpRegister)
+            addCost(4, (7, valueOf(op1)))
+            # draining op1 and looping over its units
+            if op2.typ == "CONSTANT":
+                addCost(0, (int(op2.val), valueOf(op1)))
+                bonInstructions.extend(
+                    [("JMP", "@+{}".format(int(op2.val)+2)),
+                     ("DEC", helpRegister)] +
+                    [("INC", op1.val)]*int(op2.val) + [
+                     ("TST", helpRegister),
+                     ("JMP", "@-{}".format(int(op2.val)+2))
+                ])
+                # multiplying by n adds n for every unit
+            elif op2.typ in ["REGISTER", "HELP_REGISTER"]:
+                loop = ".MUL_{}".format(helpRegister)
+                bonInstructions.append(("JMP", loop+"_TEST"))
+                labels[loop] = len(bonInstructions)
+                bonInstructions.append(("DEC", helpRegister))
+                costFactor, storage.costFactor = storage.costFactor, valueOf(op1)
+                compile_add(op1, op2)
+                storage.costFactor = costFactor
+                # the addition is executed once for every unit of op1
+                labels[loop+"_TEST"] = len(bonInstructions)
+                bonInstructions.extend([
+                    ("TST", helpRegister),
+                    ("JMP", loop)
+                ])
+                # the register is added for every unit; the length of the addition depends
+                # on the templates and on whether it is outlined, so the loop jumps to labels
+            helpRegisterScopes[helpRegister] = len(bonInstructions)
+
+        def compile_div(op1, op2):
+            compile_divmod(op1, op2, False)
+
+        def compile_mod(op1, op2):
+            compile_divmod(op1, op2, True)
+
+        def compile_divmod(op1, op2, remainder: bool):
+            # op1 is divided in place by first moving it into a help register
+            # and then repeatedly subtracting op2 from it until it is exhausted
+            # op1 counts the complete subtractions for a quotient or
+            # receives the units of the incomplete one for a remainder
+            helpRegister = storage.helpRegisterCount
+            storage.helpRegisterCount += 1
+            dividend = valueOf(op1)
+            ladder = None
+            if op2.typ == "CONSTANT" and int(op2.val) <= getUnrollLimit():
+                ladder = divisionLadder(op1.val, int(op2.val), helpRegister, remainder)
+                loop = divisionLoop(op1.val, None, helpRegister, None, remainder)
+                if not shorterUnrolled(ladder, sum(1 for opcode, operand in loop if opcode is not None)):
+                    ladder = None
+            if ladder is not None:
+                constant = int(op2.val)
+                quotient = dividend//max(constant, 1) if type(dividend) == int else "{}//{}".format(factor(dividend), constant)
+                addCost(4*constant+4, (7, dividend), (2, quotient), approximate=True)
+                # every unit is drained and tested once, every complete subtraction loops back
+                extendWithLocalLabels(ladder)
+            else:
+                divisor = getConstantRegister(op2.val) if op2.typ == "CONSTANT" else op2.val
+                quotient = valueOf(op2)
+                quotient = (dividend//max(quotient, 1) if type(dividend) == type(quotient) == int else
+                            "{}//{}".format(factor(dividend), factor(quotient)))
+                addCost(10, (18, dividend), (5, quotient), approximate=True)
+                # every unit is drained, subtracted and restored, every subtraction is completed
+                counter = storage.helpRegisterCount
+                storage.helpRegisterCount += 1
+                extendWithLocalLabels(divisionLoop(op1.val, divisor, helpRegister, counter, remainder))
+                helpRegisterScopes[counter] = len(bonInstructions)
+            helpRegisterScopes[helpRegister] = len(bonInstructions)
+
+        def divisionLadder(register, constant: int, helpRegister, remainder: bool) -> list:
+            # return the code of a repeated subtraction of a small constant, which is unrolled
+            # to a ladder where every step tests and decrements the help register once
+            ladder = []
+            for i in range(constant):
+                ladder.extend([
+                    ("TST", helpRegister),
                     ("JMP", "@+2"),
-                    ("JMP", LABEL_ELSE),
-                    ("DEC", storage.helpRegisterCount)] +
-                    register_sequence + [
-                    ("JMP", LABEL_RESTORE_BACK)
+                    ("JMP", ("@", "REMAINDER_{}".format(i) if remainder else "END")),
+                    ("DEC", helpRegister)
                 ])
-                helpRegisterScopes[storage.helpRegisterCount] = len(bonInstructions)
+            ladder.extend(
+                ([] if remainder else [("INC", register)]) +
+                [("JMP", "@-{}".format(len(ladder)+(0 if remainder else 1)))])
+            if remainder:
+                for i in reversed(range(constant)):
+                    ladder.extend([(None, "REMAINDER_{}".format(i)), ("INC", register)])
+                ladder.pop()
+                # the remainder i is restored by entering a ladder of increments
+                # i lines before its end
+            ladder.append((None, "END"))
+            return drainCode(register, helpRegister) + ladder
+
+        def divisionLoop(register, divisor, helpRegister, counter, remainder: bool) -> list:
+            # return the code of a repeated subtraction of a register
+            # the divisor is counted down while it is subtracted
+            # and restored from the counter after every subtraction
+            return [
+                ("TST", divisor),
+                ("JMP", "@+2"),
+                ("HLT", None)] + drainCode(register, helpRegister) + [
+                # a division by zero halts the program
+                (None, "SUBTRACT"),
+                ("TST", divisor),
+                ("JMP", "@+2"),
+                ("JMP", ("@", "COMPLETE")),
+                ("TST", helpRegister),
+                ("JMP", "@+2"),
+                ("JMP", ("@", "INCOMPLETE")),
+                ("DEC", divisor),
+                ("DEC", helpRegister),
+                ("INC", counter),
+                ("JMP", ("@", "SUBTRACT")),
+                (None, "COMPLETE"),
+                ("TST", counter),
+                ("JMP", "@+2"),
+                ("JMP", ("@", "NEXT")),
+                ("DEC", counter),
+                ("INC", divisor),
+                ("JMP", ("@", "COMPLETE")),
+                (None, "NEXT")] + (
+                [] if remainder else [("INC", register)]) + [
+                ("JMP", ("@", "SUBTRACT")),
+                (None, "INCOMPLETE"),
+                ("TST", counter),
+                ("JMP", "@+2"),
+                ("JMP", ("@", "END")),
+                ("DEC", counter),
+                ("INC", divisor)] + (
+                [("INC", register)] if remainder else []) + [
+                ("JMP", ("@", "INCOMPLETE")),
+                (None, "END")
+            ]
+
+        def extendWithTemplate(name: str, operands: dict, terms: dict):
+            # append the template of the given name, replacing its registers x and y and its
+            # target by the given operands, and add its cost for the given values of its terms
+            template = self.templates[name]
+            cost = template["cost"]
+            addCost(cost["constant"], *((factor, terms[term]) for term, factor in cost["terms"].items()),
+                    approximate=cost["approximate"])
+            if self.outline and all(type(operands[register]) == str for register in ["x", "y"] if register in operands):
+                calls.append({"name": name, "operands": operands, "line": storage.line, "costFactor": storage.costFactor,
+                              "count": lineCounts[storage.head] if self.profile is not None else 0})
+                bonInstructions.append(("CALL", len(calls)-1))
+                # a template of registers that are no help registers may be shared by several
+                # calls, which is decided by outlineTemplates once all of them are known
+            else:
+                bonInstructions.extend(instantiateTemplate(name, operands, len(bonInstructions)+len(template["code"])))
+
+        def instantiateTemplate(name: str, operands: dict, end) -> list:
+            # return the code of a template with its registers and target replaced by the given
+            # operands; unless given, the help register h is a new one whose scope ends at end
+            code = self.templates[name]["code"]
+            if "h" not in operands and "h" in (operand for opcode, operand in code):
+                operands = dict(operands, h=storage.helpRegisterCount)
+                helpRegisterScopes[storage.helpRegisterCount] = end
                 storage.helpRegisterCount += 1
-                if type(op1) == int:
-                    compile_mov(Operand("HELP_REGISTER", op1), Operand("CONSTANT", "0"))
-                    helpRegisterScopes[op1] = len(bonInstructions)
-                if type(op2) == int:
-                    compile_mov(Operand("HELP_REGISTER", op2), Operand("CONSTANT", "0"))
-                    helpRegisterScopes[op2] = len(bonInstructions)
-                    # help registers might need to be reset
+            return [(opcode, operands.get(operand, operand)) for opcode, operand in code]
+
+        def outlineTemplates():
+            # replace the calls of templates by their code or by jumps to shared copies of it
+            # appended to the program, whichever is shorter for all calls of a template with
+            # the same registers; a copy returns to the n-th of its callers by counting down
+            # a return register the caller incremented n times:
+            #          INC r         (n times)
+            #          JMP OUTLINE
+            # RETURN_n ...
+            #
+            #  OUTLINE template      (jumping to TRUE instead of its target)
+            #          TST r         (these four lines are repeated for every caller but the last)
+            #          JMP @+2
+            #          JMP RETURN_n
+            #          DEC r
+            #          JMP RETURN_last
+            #     TRUE TST r         (the same ladder jumping to the targets, only for comparisons)
+            #          ...
+            #
+            # several copies are used for many calls as the callers' increments grow quadratically
+
+            def outlinedSize(name: str, calls: int, group: int) -> int:
+                # return the number of lines of the given number of calls of a template
+                # and of its copies when every copy is shared by group calls
+                ladders = 2 if name.startswith("cmp_") else 1
+                counts = [group]*(calls//group) + ([calls%group] if calls%group else [])
+                return sum(len(self.templates[name]["code"])+ladders*(4*count-3)+count*(count+1)//2
+                           for count in counts)
+
+            shapes = {}
+            for index, call in enumerate(calls):
+                shapes.setdefault((call["name"], call["operands"]["x"], call["operands"].get("y")), []).append(index)
+            bodies = []
+            for (name, x, y), indices in shapes.items():
+                group = min(range(2, len(indices)+1), key=lambda group: outlinedSize(name, len(indices), group),
+                            default=None)
+                if (group is not None and
+                    outlinedSize(name, len(indices), group) < len(self.templates[name]["code"])*len(indices)):
+                    indices = sorted(indices, key=lambda index: -calls[index]["count"])
+                    # frequently executed calls return first if there is a profile
+                    bodies.extend(indices[start:start+group] for start in range(0, len(indices), group))
+            positions = {}
+            if bodies:
+                returnRegister, bodyHelpRegister = storage.helpRegisterCount, storage.helpRegisterCount+1
+                storage.helpRegisterCount += 2
+                reservedHelpRegisters.extend([returnRegister, bodyHelpRegister])
+                # a copy may be called while any help register is in use, so the registers
+                # it uses are not shared; all copies share them as they are zero after each call
+                for number, body in enumerate(bodies):
+                    for position, index in enumerate(body):
+                        positions[index] = (number, position, len(body))
+            code = InstructionStream()
+            moved = []
+            returns = {}
+            for line, instruction in enumerate(bonInstructions):
+                moved.append(len(code))
+                if instruction[0] != "CALL":
+                    code.append(instruction)
+                    continue
+                call = calls[instruction[1]]
+                if instruction[1] not in positions:
+                    code.extend(instantiateTemplate(call["name"], call["operands"], line+1))
+                    continue
+                number, position, count = positions[instruction[1]]
+                code.extend([("INC", returnRegister)]*position + [("JMP", ".OUTLINE_{}".format(number))])
+                returns[".RETURN_{}".format(instruction[1])] = len(code)
+                storage.line, storage.costFactor = call["line"], call["costFactor"]
+                addCost(4*position+3 if position < count-1 else 4*position+2)
+                # the increments, the jump and the part of the ladder run before returning
+            moved.append(len(code))
+            for label in labels:
+                labels[label] = moved[labels[label]]
+            for register in helpRegisterScopes:
+                helpRegisterScopes[register] = moved[helpRegisterScopes[register]]
+            self.bonLines = [moved[line] for line in self.bonLines]
+            labels.update(returns)
+            if bodies and code[-1][0] not in ["HLT", "JMP"]:
+                code.append(("HLT", None))
+                # the copies must not be run into from the end of the program
+
+            def extendWithLadder(targets: list):
+                # append a ladder jumping to the n-th target for the return register n
+                for position, target in enumerate(targets):
+                    if position < len(targets)-1:
+                        code.extend([("TST", returnRegister), ("JMP", "@+2"), ("JMP", target), ("DEC", returnRegister)])
+                    else:
+                        code.append(("JMP", target))
+
+            for number, body in enumerate(bodies):
+                call = calls[body[0]]
+                labels[".OUTLINE_{}".format(number)] = len(code)
+                code.extend(instantiateTemplate(call["name"], dict(call["operands"], h=bodyHelpRegister,
+                                                                   target=".OUTLINE_{}_TRUE".format(number)), None))
+                extendWithLadder([".RETURN_{}".format(index) for index in body])
+                if "target" in call["operands"]:
+                    labels[".OUTLINE_{}_TRUE".format(number)] = len(code)
+                    extendWithLadder([calls[index]["operands"]["target"] for index in body])
+            bonInstructions.replace(code)
+
+        def compile_drain(source, destination):
+            # move the value of source to destination leaving source at zero
+            bonInstructions.extend(drainCode(source, destination))
+
+        def drainCode(source, destination) -> list:
+            # return the code of compile_drain
+            return [
+                ("JMP", "@+3"),
+                ("DEC", source),
+                ("INC", destination),
+                ("TST", source),
+                ("JMP", "@-3")
+            ]
+
+        def extendWithLocalLabels(instructions: list):
+            # append instructions that jump to labels local to them
+            # a label is defined by a (None, name) entry and jumped to by
+            # using ("@", name) as operand; it is resolved to a relative address
+            positions = {}
+            lines = []
+            for opcode, operand in instructions:
+                if opcode is None:
+                    positions[operand] = len(lines)
+                else:
+                    lines.append((opcode, operand))
+            for line, (opcode, operand) in enumerate(lines):
+                if type(operand) == tuple:
+                    operand = "@{:+d}".format(positions[operand[1]]-line)
+                bonInstructions.append((opcode, operand))
+
+        def removeBonsaiLines(removals: set):
+            # remove lines from the Bonsai code once its addresses are resolved and move
+            # the jumps, source lines and help register scopes to the lines following them
+            moved = bonInstructions.remove(removals)
+            opcodes, operands = bonInstructions.opcodes, bonInstructions.operands
+            for line in range(len(opcodes)):
+                if opcodes[line] == JMP:
+                    operands[line] = moved[operands[line]-1]+1
+            self.sourceMap = [source for line, source in enumerate(self.sourceMap) if line not in removals]
+            self.bonLines = [moved[line] for line in self.bonLines]
+            for register, line in helpRegisterScopes.items():
+                helpRegisterScopes[register] = moved[line]
+
+        def markApproximate(lines):
+            # the steps of the statements of the given Bonsai lines were changed by a pass
+            # after their costs were added, so their costs are only upper bounds now
+            for line in lines:
+                self.costs.setdefault(self.sourceMap[line], {"steps": {}, "approximate": False, "helpRegisters": 0})[
+                    "approximate"] = True
+
+        def threadBonsaiJumps() -> int:
+            # jump directly to the end of a chain of jumps and halt instead of jumping to a halt
+            hits = 0
+            opcodes, operands = bonInstructions.opcodes, bonInstructions.operands
+            for line in range(len(opcodes)):
+                if opcodes[line] != JMP:
+                    continue
+                target = operands[line]
+                visited = {line+1}
+                while target <= len(opcodes) and opcodes[target-1] == JMP and target not in visited:
+                    visited.add(target)
+                    target = operands[target-1]
+                    # a loop of jumps is left as soon as a jump is visited again
+                if target <= len(opcodes) and opcodes[target-1] == HLT:
+                    bonInstructions.set(line, "HLT", None)
+                    hits += 1
+                elif target != operands[line]:
+                    operands[line] = target
+                    hits += 1
+                else:
+                    continue
+                markApproximate(jump-1 for jump in visited)
+                # the skipped jumps may belong to other statements
+            return hits
+
+        def removeBonsaiJumpsToNextLine() -> int:
+            # a jump to the next line has no effect unless a TST decides whether it is skipped
+            opcodes, operands = bonInstructions.opcodes, bonInstructions.operands
+            removals = set(line for line in range(len(opcodes))
+                           if opcodes[line] == JMP and operands[line] == line+2 and (line == 0 or opcodes[line-1] != TST))
+            if removals:
+                markApproximate(removals)
+                removeBonsaiLines(removals)
+            return len(removals)
+
+        def removeUnreachableBonsaiLines() -> int:
+            # remove the lines that cannot be reached from the first one
+            opcodes, operands = bonInstructions.opcodes, bonInstructions.operands
+            reachable = bytearray(len(opcodes))
+            lines = [0]
+            while lines:
+                line = lines.pop()
+                if line >= len(opcodes) or reachable[line]:
+                    continue
+                reachable[line] = 1
+                opcode = opcodes[line]
+                if opcode == JMP:
+                    lines.append(operands[line]-1)
+                elif opcode == TST:
+                    lines.extend([line+1, line+2])
+                elif opcode != HLT:
+                    lines.append(line+1)
+            removals = set(line for line in range(len(opcodes)) if not reachable[line])
+            if removals:
+                removeBonsaiLines(removals)
+            return len(removals)
+
+        def getConstantRegister(constant: str) -> str:
+            # return the pool register preset to the given constant
+            # registers of the constant pool are never changed permanently
+            name = "${}".format(int(constant))
+            if name not in constantRegisters:
+                constantRegisters[name] = len(self.registers)+len(constantRegisters)
+            return name
 
         compiler_functions = {
             "add": compile_add,
@@ -403,9 +1582,24 @@ class IntermediateCode(object):
             "mov": compile_mov,
             "hlt": compile_hlt,
             "jmp": compile_jmp,
+            "ext": compile_ext,
             "cmp": compile_cmp,
+            "mul": compile_mul,
+            "div": compile_div,
+            "mod": compile_mod,
         }
         orgLabels = [(line, label) for label, line in self.symbolTable.items() if label[0] == "."]
+        labelLines = set(line for line, label in orgLabels)
+        lineCounts = []
+        if self.profile is not None:
+            count = self.profile["runs"]
+            labelCounts = dict((line, self.profile["labels"][label]) for line, label in orgLabels
+                               if label in self.profile["labels"])
+            for line in range(len(self.instructions)):
+                count = labelCounts.get(line, count)
+                lineCounts.append(count)
+            # every instruction is assumed to be executed as often as the
+            # closest label before it that is found in the profile
         orgLabels.sort(key=lambda e: e[0])
         labelHead = 0
         labels = {}
@@ -424,80 +1618,415 @@ class IntermediateCode(object):
                 # it is translated to the current line in the Bonsai code
             instruction = self.instructions[storage.head]
             # the next instruction is fetched
+            while len(self.bonLines) <= storage.head:
+                self.bonLines.append(len(bonInstructions))
+                # instructions consumed by the previous one, such as the jump
+                # following a cmp, start where the next one does
+            storage.line = instruction.line
             compiler_functions[instruction.opcode](instruction.op1, instruction.op2)
             # and the corresponding compilation function called
+            trackValue(instruction)
             storage.head += 1
-            if orgHelpRegisterScopes:
-                while orgHelpRegisterScopes[helpRegisterScopeHead][0] == storage.head:
-                    helpRegisterScopes[orgHelpRegisterScopes[helpRegisterScopeHead][1]] = len(bonInstructions)
-                    if helpRegisterScopeHead < len(orgHelpRegisterScopes)-1:
-                        helpRegisterScopeHead += 1
-                    else:
-                        break
+            while (helpRegisterScopeHead < len(orgHelpRegisterScopes) and
+                   orgHelpRegisterScopes[helpRegisterScopeHead][0] <= storage.head):
+                helpRegisterScopes[orgHelpRegisterScopes[helpRegisterScopeHead][1]] = len(bonInstructions)
+                helpRegisterScopeHead += 1
                 # when a help register was last used, the line must be denoted for
-                # the actual Bonsai code
-        for i, instruction in enumerate(bonInstructions):
-            if type(instruction[1]) == int:
-                bonInstructions[i] = (instruction[0], ("H", instruction[1]))
-                # mark help registers
-            elif type(instruction[1]) == str:
-                if instruction[1][0] == ".":
-                    bonInstructions[i] = (instruction[0], labels[instruction[1]]+1)
-                    # replace label with the actual position
-                elif instruction[1][0] == "@":
-                    bonInstructions[i] = (instruction[0], i+int(instruction[1][1:])+1)
-                    # calculate relative addresses
-                else:
-                    bonInstructions[i] = (instruction[0], self.symbolTable[instruction[1]]+1)
-                    # look up register in symbol table
-        registerCount = len(self.registers)
+                # the actual Bonsai code; instructions consumed by the previous one
+                # may have been skipped
+        while len(self.bonLines) <= len(self.instructions):
+            self.bonLines.append(len(bonInstructions))
+        if calls:
+            outlineTemplates()
+        self.sourceMap = [None]*len(bonInstructions)
+        for i, instruction in enumerate(self.instructions):
+            for line in range(self.bonLines[i], self.bonLines[i+1]):
+                self.sourceMap[line] = instruction.line
+        # every Bonsai line stems from the statement of the instruction it was compiled from
+        externals = set(instruction.op1.val for instruction in self.instructions if instruction.opcode == "ext")
+        bonInstructions.resolve(labels, self.symbolTable, constantRegisters, externals)
+        # labels, relative addresses and registers of the constant pool and the symbol
+        # table are replaced by their addresses, help registers keep their numbers
+        if self.passManager is not None and not self.relocatable:
+            for optimization in [threadBonsaiJumps, removeBonsaiJumpsToNextLine, removeUnreachableBonsaiLines]:
+                self.passManager.register("bonsai", optimization.__name__, optimization)
+            self.passManager.run("bonsai")
+            # the Bonsai code is optimized once its addresses are known
+        registerCount = len(self.registers)+len(constantRegisters)
         helpRegisterScopes = [(line, register) for register, line in helpRegisterScopes.items()]
         helpRegisterScopes.sort(key=lambda e: e[0])
         helpRegisterScopeHead = 0
         freeHelpRegisters = []
         helpRegistersInUse = {}
-        for i, instruction in enumerate(bonInstructions):
-            if type(instruction[1]) == tuple:
+        helpRegistersByLine = {}
+        for helpRegister in reservedHelpRegisters:
+            registerCount += 1
+            helpRegistersInUse[helpRegister] = registerCount
+            # reserved help registers are never shared with others
+        operands, kinds = bonInstructions.operands, bonInstructions.kinds
+        for i in range(len(kinds)):
+            if kinds[i] == InstructionStream.HELP:
                 # the operand is a help register
-                if instruction[1][1] in helpRegistersInUse:
-                    helpRegister = helpRegistersInUse[instruction[1][1]]
+                if operands[i] in helpRegistersInUse:
+                    helpRegister = helpRegistersInUse[operands[i]]
                     # a help register has already been found and is reused
                 elif freeHelpRegisters:
                     helpRegister = freeHelpRegisters.pop()
-                    helpRegistersInUse[instruction[1][1]] = helpRegister
+                    helpRegistersInUse[operands[i]] = helpRegister
                     # there are free help registers that were previously created
                     # use one of them
                 else:
                     registerCount += 1
                     helpRegister = registerCount
-                    helpRegistersInUse[instruction[1][1]] = helpRegister
+                    helpRegistersInUse[operands[i]] = helpRegister
                     # there currently aren't any free help registers
                     # create a new one
-                bonInstructions[i] = (instruction[0], helpRegister)
-            if helpRegisterScopes and i == helpRegisterScopes[helpRegisterScopeHead][0]:
-                freeHelpRegisters.append(helpRegistersInUse[helpRegisterScopes[helpRegisterScopeHead][1]])
-                del helpRegistersInUse[helpRegisterScopes[helpRegisterScopeHead][1]]
-                if helpRegisterScopeHead < len(helpRegisterScopes)-1:
-                    helpRegisterScopeHead += 1
+                operands[i] = helpRegister
+                kinds[i] = InstructionStream.ADDRESS
+                helpRegistersByLine.setdefault(self.sourceMap[i], set()).add(helpRegister)
+            while (helpRegisterScopeHead < len(helpRegisterScopes) and
+                   helpRegisterScopes[helpRegisterScopeHead][0] <= i):
+                if helpRegisterScopes[helpRegisterScopeHead][1] in helpRegistersInUse:
+                    freeHelpRegisters.append(helpRegistersInUse.pop(helpRegisterScopes[helpRegisterScopeHead][1]))
+                helpRegisterScopeHead += 1
                 # a previously used help register is now unused
                 # free it so that it can be reused
+                # several help registers may become unused on the same line
+        for line, helpRegisters in helpRegistersByLine.items():
+            self.costs.setdefault(line, {"steps": {}, "approximate": False, "helpRegisters": 0})[
+                "helpRegisters"] = len(helpRegisters)
+        opcodes, names = bonInstructions.opcodes, InstructionStream.OPCODES
+        if self.relocatable:
+            return {
+                "version": OBJECT_VERSION,
+                "registers": [[name, int(self.registers[index])] for name, index in
+                              sorted(((name, index) for name, index in self.symbolTable.items() if name[0] != "."),
+                                     key=lambda e: e[1])],
+                "constants": [int(constant[1:]) for constant in constantRegisters],
+                "helpRegisters": registerCount-len(self.registers)-len(constantRegisters),
+                "labels": dict((label, labels[label]+1) for label in self.userLabels),
+                "code": [[names[opcodes[i]], bonInstructions.names[operands[i]] if kinds[i] == InstructionStream.LABEL
+                          else operands[i] if kinds[i] != InstructionStream.NONE else None] for i in range(len(opcodes))],
+                "sourceMap": self.sourceMap,
+                "comments": self.comments
+            }
+            # registers are numbered as in a program, jumps to external labels keep their names
+        def statements() -> list:
+            # return the number of lines of every statement
+            lines = {}
+            for line in self.sourceMap:
+                lines[line] = lines.get(line, 0)+1
+            return [("line {}".format(line+1) if line is not None else "shared or not part of a statement", count)
+                    for line, count in lines.items()]
+
+        width = fitTarget(self.target, self.maxLines, len(bonInstructions), registerCount, statements, "statement")
+        if binary:
+            program = pack(width, bonInstructions,
+                           chain((int(register) for register in self.registers),
+                                 (int(constant[1:]) for constant in constantRegisters),
+                                 [0]*(registerCount-len(self.registers)-len(constantRegisters))),
+                           self.comments+[""]*(10-len(self.comments)))
+            # the same parts as in the text, with the same empty comments
+            if sink is None:
+                return program
+            sink.write(program)
+            return
         # join the various parts of the program:
-        return "".join(chain((("{}{:2d}\r\n".format(opcode, oprnd) if oprnd is not None else opcode+"  \r\n") for opcode, oprnd in bonInstructions),
-                              # the instructions
-                              ("#{:5d}\r\n".format(int(register)) for register in self.registers),
-                              # user defined registers
-                              ("#    0\r\n" for register in freeHelpRegisters),
-                              # help registers
-                              (";{}\r\n".format(comment) for comment in self.comments),
-                              # comments
-                              (";\r\n" for i in range(10-len(self.comments)))))
-                              # add empty comments so that there are at least 10
-
-Instruction = namedtuple("Instruction", ["opcode", "op1", "op2"])
+        lines = chain((("{}{:{}d}\r\n".format(names[opcodes[i]], operands[i], width) if kinds[i] != InstructionStream.NONE
+                        else names[opcodes[i]]+" "*width+"\r\n") for i in range(len(opcodes))),
+                      # the instructions
+                      ("#{:5d}\r\n".format(int(register)) for register in self.registers),
+                      # user defined registers
+                      ("#{:5d}\r\n".format(int(constant[1:])) for constant in constantRegisters),
+                      # registers of the constant pool
+                      ("#    0\r\n" for register in range(registerCount-len(self.registers)-len(constantRegisters))),
+                      # help registers
+                      (";{}\r\n".format(comment) for comment in self.comments),
+                      # comments
+                      (";\r\n" for i in range(10-len(self.comments))))
+                      # add empty comments so that there are at least 10
+        if sink is None:
+            return "".join(lines)
+        for line in lines:
+            sink.write(line)
+        # every line is written as soon as it is formatted
+
+def fitTarget(target: str, maxLines, lines: int, registers: int, parts, kind: str) -> int:
+    """
+    Return the width of the addresses of a program or raise a SizeError if it does not fit.
+
+    Parameters:
+        @param target:    the name of the machine in TARGETS the program is for
+        @param maxLines:  the largest number of lines the program may have or None
+        @param lines:     the number of lines of the program
+        @param registers: the number of registers of the program
+        @param parts:     a function returning the name and the number of lines of every
+                          part of the program, only called for the report of a SizeError
+        @param kind:      what the parts are, e.g. statement
+
+        @type target:    str
+        @type maxLines:  int
+        @type lines:     int
+        @type registers: int
+        @type parts:     function
+        @type kind:      str
+
+    @return: the number of digits of every address
+    @rtype: int
+    """
+    width = TARGETS[target]
+    maxAddress = 10**width-1 if width is not None else None
+    maxLines = min(maxAddress or lines, maxLines or lines)
+    if lines > maxLines or registers > (maxAddress or registers):
+        largest = sorted(parts(), key=lambda e: -e[1])
+        report = ["The program needs {} lines and {} registers, but at most {} lines{} fit.".format(
+            lines, registers, maxLines, " and {} registers".format(maxAddress) if maxAddress is not None else ""),
+            "  lines  {}".format(kind)]
+        report.extend("{:>7}  {}".format(count, name) for name, count in largest[:10])
+        if len(largest) > 10:
+            report.append("{:>7}  {} other {}s".format(sum(count for name, count in largest[10:]), len(largest)-10, kind))
+        raise SizeError("\n".join(report), lines, registers, maxLines, maxAddress)
+        # the parts taking the most lines are listed first
+    if width is None:
+        width = max(2, len(str(max(lines, registers))))
+        # addresses are as wide as the largest one but at least as wide as on the Bonsai computer
+    return width
+
+TERM_OPCODES = {"*": "mul", "//": "div", "%": "mod"}
+"""the intermediate instructions calculating products, quotients and remainders in place"""
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates.json"), "r") as file:
+    TEMPLATES = json.load(file)
+    """the Bonsai code templates by name for the objectives steps and size, see superoptimizer.py"""
+
+TARGETS = {
+    "bonsai": 2,
+    "extended": None
+}
+"""the number of digits of addresses by machine, None if they are as wide as needed"""
+
+OBJECT_VERSION = 1
+"""the version of the relocatable objects returned by compile, see linker.py"""
+
+Instruction = namedtuple("Instruction", ["opcode", "op1", "op2", "line"], defaults=[None])
 Operand = namedtuple("Operator", ["typ", "val"])
 
+class InstructionStream(object):
+
+    """
+    Bonsai instructions stored in parallel arrays.
+
+    Every instruction is an opcode number, an operand and the kind of the operand,
+    so a program takes six bytes per instruction and the passes over it compare
+    integers. Instructions are appended as (opcode, operand) tuples as generated,
+    with register names, labels, "@+n" relative addresses, "$n" constants of the
+    pool or help register numbers as operands; names are stored once in a table.
+    Resolving them replaces the operands by addresses in place.
+
+    Properties:
+        opcodes  - the number of the opcode in OPCODES of every instruction
+        operands - the operand of every instruction, its meaning depends on its kind
+        kinds    - the kind of the operand of every instruction
+        names    - the registers, labels and constants operands of these kinds refer to
+
+    Methods:
+        append(instruction)           - append an (opcode, operand) tuple
+        extend(instructions)          - append several (opcode, operand) tuples
+        resolve(labels, symbolTable,
+                constantRegisters,
+                externals)            - replace the operands by 1-based addresses
+                                        and registers, except help registers
+                                        and external labels
+        set(line, opcode, operand)    - replace an instruction by one with an address
+        remove(lines)                 - remove lines and return the new line of every line
+        replace(stream)               - take over the instructions of another stream
+    """
+
+    OPCODES = OPCODES+["CALL"]
+    """the opcodes by number, those of the binary format and calls of outlined templates"""
+
+    NONE, ADDRESS, HELP, CALL, RELATIVE, LABEL, CONSTANT, REGISTER = range(8)
+    """the kinds of operands: none, a resolved address or register, a help register, the number
+    of a call, a relative address and the number of a name of a label, constant or register"""
+
+    NUMBERS = dict((opcode, number) for number, opcode in enumerate(OPCODES))
+    """the numbers of the opcodes by name"""
+
+    def __init__(self):
+        self.opcodes = array("B")
+        """@type: array"""
+        self.operands = array("i")
+        """@type: array"""
+        self.kinds = array("B")
+        """@type: array"""
+        self.names = []
+        """@type: list"""
+        self.numbers = {}
+        # the number of every name in names
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def __getitem__(self, line: int) -> tuple:
+        # return an instruction as the (opcode, operand) tuple it was appended as
+        # or with its resolved address
+        kind, operand = self.kinds[line], self.operands[line]
+        if kind == self.NONE:
+            operand = None
+        elif kind == self.RELATIVE:
+            operand = "@{:+d}".format(operand)
+        elif kind >= self.LABEL:
+            operand = self.names[operand]
+        return self.OPCODES[self.opcodes[line]], operand
+
+    def append(self, instruction: tuple):
+        """
+        Append an instruction as generated.
+
+        @param instruction: the opcode and the operand of the instruction
+        @type instruction:  tuple
+        """
+        opcode, operand = instruction
+        if operand is None:
+            kind, operand = self.NONE, 0
+        elif opcode == "CALL":
+            kind = self.CALL
+        elif type(operand) == int:
+            kind = self.HELP
+        elif operand[0] == "@":
+            kind, operand = self.RELATIVE, int(operand[1:])
+        else:
+            kind = self.LABEL if operand[0] == "." else self.CONSTANT if operand[0] == "$" else self.REGISTER
+            if operand not in self.numbers:
+                self.numbers[operand] = len(self.names)
+                self.names.append(operand)
+            operand = self.numbers[operand]
+        self.opcodes.append(self.NUMBERS[opcode])
+        self.operands.append(operand)
+        self.kinds.append(kind)
+
+    def extend(self, instructions):
+        """
+        Append several instructions as generated.
+
+        @param instructions: the (opcode, operand) tuples of the instructions
+        @type instructions:  iterable
+        """
+        for instruction in instructions:
+            self.append(instruction)
+
+    def resolve(self, labels: dict, symbolTable: dict, constantRegisters: dict, externals=()):
+        """
+        Replace the operands by 1-based addresses and registers in place, except help registers.
+
+        Parameters:
+            @param labels:            the 0-based line of every label
+            @param symbolTable:       the 0-based index of every register
+            @param constantRegisters: the 0-based index of every register of the constant pool
+            @param externals:         the labels of other objects, which are left unresolved
+
+            @type labels:            dict
+            @type symbolTable:       dict
+            @type constantRegisters: dict
+            @type externals:         set
+        """
+        addresses = [None if name in externals else
+                     (labels if name[0] == "." else constantRegisters if name[0] == "$" else symbolTable)[name]+1
+                     for name in self.names]
+        # the address of every name, looked up once for all lines using it
+        operands, kinds = self.operands, self.kinds
+        for line in range(len(kinds)):
+            kind = kinds[line]
+            if kind == self.RELATIVE:
+                operands[line] += line+1
+                kinds[line] = self.ADDRESS
+            elif kind >= self.LABEL and addresses[operands[line]] is not None:
+                operands[line] = addresses[operands[line]]
+                kinds[line] = self.ADDRESS
+
+    def set(self, line: int, opcode: str, operand: int):
+        """
+        Replace an instruction by one with a resolved operand.
+
+        Parameters:
+            @param line:    the 0-based line of the instruction
+            @param opcode:  the new opcode
+            @param operand: the new address or None
+
+            @type line:    int
+            @type opcode:  str
+            @type operand: int
+        """
+        self.opcodes[line] = self.NUMBERS[opcode]
+        self.operands[line] = operand or 0
+        self.kinds[line] = self.NONE if operand is None else self.ADDRESS
+
+    def remove(self, lines: set) -> list:
+        """
+        Remove lines and return the new line of every line.
+
+        @param lines: the 0-based lines to remove
+        @type lines:  set
+
+        @return: the new line of every line and of the end, the line following
+                 a removed line for it
+        @rtype: list
+        """
+        kept = [line not in lines for line in range(len(self.opcodes))]
+        for values in [self.opcodes, self.operands, self.kinds]:
+            values[:] = array(values.typecode, compress(values, kept))
+        return [0]+list(accumulate(kept))
+        # a line moves up by the number of removed lines before it
+
+    def replace(self, stream):
+        """
+        Take over the instructions of another stream.
+
+        @param stream: the stream whose instructions replace these
+        @type stream:  InstructionStream
+        """
+        self.opcodes, self.operands, self.kinds = stream.opcodes, stream.operands, stream.kinds
+        self.names, self.numbers = stream.names, stream.numbers
+
 class CompilerError(Exception):
 
     """A generic error thrown by the intermediate code generator and compiler."""
 
-    pass
\ No newline at end of file
+    pass
+
+class SizeError(CompilerError):
+
+    """
+    An error thrown if the compiled program has more lines or registers than its target allows.
+
+    Properties:
+        lines        - the number of lines the program needs
+        registers    - the number of registers the program needs
+        maxLines     - the largest number of lines that fit
+        maxRegisters - the largest number of registers that fit or None if there are
+                       as many as needed
+
+    Methods:
+        overflow() - return by how many lines and registers the program is too large
+    """
+
+    def __init__(self, message: str, lines=None, registers=None, maxLines=None, maxRegisters=None):
+        super().__init__(message)
+        self.lines = lines
+        """@type: int"""
+        self.registers = registers
+        """@type: int"""
+        self.maxLines = maxLines
+        """@type: int"""
+        self.maxRegisters = maxRegisters
+        """@type: int"""
+
+    def overflow(self) -> tuple:
+        """
+        Return by how many lines and registers the program is too large.
+
+        @return: the lines and the registers that do not fit, 0 for those that do
+        @rtype: tuple
+        """
+        return (max(0, self.lines-self.maxLines),
+                max(0, self.registers-self.maxRegisters) if self.maxRegisters is not None else 0)
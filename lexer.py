@@ -24,14 +24,17 @@ def _wrap_Lexer() -> tuple:
     PB_RULES = [
         ("INDENT",              r"^[ ]+"),
         ("WHITESPACE",          r"[ ]+"),
-        ("KEYWORD",             r"(?:if|label|goto)(?=[ ])|(?:else|halt)"),
+        ("KEYWORD",             r"(?:if|elif|label|goto|while|for|in|and|or|not)(?=[ ])|(?:else|halt)|range(?=[ ]*\()"),
         ("LABEL_IDENTIFIER",    r"\.[_a-zA-Z]?\w*"),
         ("IDENTIFIER",          r"[_a-zA-Z]\w*"),
         ("NUMBER",              r"\d+"),
         ("COMPARISON_OPERATOR", r">=?|<=?|==|!="),
         ("ASSIGNING_OPERATOR",  r"[-+]?="),
         ("ARITHMETIC_OPERATOR", r"[-+]"),
+        ("MULTIPLICATIVE_OPERATOR", r"\*|//|%"),
         ("COLON",               r":"),
+        ("OPENING_PARENTHESIS", r"\("),
+        ("CLOSING_PARENTHESIS", r"\)"),
         ("COMMENT",             r"#.*"),
         ("STRING",               "(?P<BEGIN>(?P<ML>[\"|']{3})|\"|')(?P<RES>(?(ML)(?:.|\\r?\\n)*?|.*?))(?P=BEGIN)"),
         ("SEMICOLON",           r";"),
@@ -39,6 +42,19 @@ def _wrap_Lexer() -> tuple:
     ]
     """RegExp rules for the various tokens that can occur on Python Bonsai"""
 
+    PB_REGEX = re.compile("|".join("(?P<G{GROUP_INDEX}>{RULE})".format(GROUP_INDEX=i, RULE=
+                          re.sub(r"\(\?P((<)|=)(.+?)((?(2)>.*?))\)",
+                                 r"(?P\1G{GROUP_INDEX}_\3\4)".format(GROUP_INDEX=i), rule))
+                          for i, (typ, rule) in enumerate(PB_RULES)), re.MULTILINE)
+    """the rules joined into a single RegExp, compiled once and shared by all Lexers"""
+    # join all RegExp into a single one by alternation
+    # first prefix all group names by unique index to avoid naming conflicts
+
+    PB_TYPES = dict(("G{}".format(i), typ) for i, (typ, rule) in enumerate(PB_RULES))
+    """the token type of every group of the RegExp"""
+    # name all groups by index and store actual names in table, because group names
+    # must be valid Python identifiers
+
     class LexerError(Exception):
 
         """Abstract class for all errors thrown by the Lexer."""
@@ -140,17 +156,10 @@ def _wrap_Lexer() -> tuple:
 
                 @type pyBonCode: str
             """
-            self.regex = re.compile("|".join("(?P<G{GROUP_INDEX}>{RULE})".format(GROUP_INDEX=i, RULE=
-                                    re.sub(r"\(\?P((<)|=)(.+?)((?(2)>.*?))\)",
-                                           r"(?P\1G{GROUP_INDEX}_\3\4)".format(GROUP_INDEX=i), rule))
-                                    for i, (typ, rule) in enumerate(PB_RULES)), re.MULTILINE)
+            self.regex = PB_REGEX
             """@type: SRE_Pattern"""
-            # join all RegExp into a single one by alternation
-            # first prefix all group names by unique index to avoid naming conflicts
-            self.types = dict(("G{}".format(i), typ) for i, (typ, rule) in enumerate(PB_RULES))
+            self.types = PB_TYPES
             """@type: dict"""
-            # name all groups by index and store actual names in table, because group names
-            # must be valid Python identifiers
             self.string = re.sub(r"^([\r?\n](#.*)?)*", "",
                                  re.sub(r"^([ ]*)(\t+)", lambda m: " "*8*(len(m.group(2))+len(m.group(1))//8),
                                         pyBonCode.replace("\f", "")))
@@ -0,0 +1,133 @@
+"""
+The linker of Py2Bon.
+
+Programs can be split into several files that are compiled separately to
+relocatable objects by compileObjectPB, or py2bon.py -c, and linked into a
+single Bonsai program. Files are joined by gotos: a goto to a label that its
+file does not define jumps to the file defining it.
+
+An object is a dict, saved as JSON, holding:
+
+    version       the version of the object format, OBJECT_VERSION
+    registers     the [name, start value] pairs of the registers declared by the file
+    constants     the values of the registers of its constant pool
+    helpRegisters the number of its help registers
+    labels        the 1-based line of every label defined by the file
+    code          the [opcode, operand] pairs of its Bonsai code; registers are
+                  numbered as in a program with the declared registers, the
+                  constant pool and the help registers in this order, jumps
+                  go to 1-based lines of the object or to the name of a label
+                  of another object
+    sourceMap     the 0-based source line of every line of the code or None
+    comments      the docstrings of the file
+
+Registers declared in several files are shared and must start at the same
+value. Help registers are zero between statements, so all objects share the
+same ones. The code of the objects is laid out in the order they are given;
+the first one is the entry of the program and every file ends in a halt.
+
+Exports:
+    link: func       - link relocatable objects into a Bonsai program
+    LinkError: class - an error raised if objects cannot be linked
+"""
+
+from intermediate_code import OBJECT_VERSION, fitTarget
+from binary_format import pack, formatText
+
+def link(objects: list, names=None, target="extended", maxLines=None, binary=False):
+    """
+    Link relocatable objects into a Bonsai program.
+
+    Every register and label is looked up in a table once, so the time taken
+    grows linearly with the size of the objects.
+
+    Parameters:
+        @param objects:  the objects as returned by compileObjectPB, the first one
+                         is executed first
+        @param names:    the names of the objects used in errors, e.g. their files,
+                         or None to number them
+        @param target:   the name of the machine in TARGETS to link for
+        @param maxLines: the largest number of Bonsai lines the program may have or None
+        @param binary:   whether to return the program in the binary format
+
+        @type objects:  list
+        @type names:    list
+        @type target:   str
+        @type maxLines: int
+        @type binary:   bool
+
+    @return: the Bonsai code or the binary program
+    @rtype: str
+    """
+    if not objects:
+        raise LinkError("There are no objects to link.")
+    names = names or ["object {}".format(i+1) for i in range(len(objects))]
+    for name, obj in zip(names, objects):
+        if not isinstance(obj, dict) or obj.get("version") != OBJECT_VERSION:
+            raise LinkError("{} is no relocatable object of version {}.".format(name, OBJECT_VERSION))
+    registers = {}
+    values = []
+    owners = {}
+    for name, obj in zip(names, objects):
+        for register, value in obj["registers"]:
+            if register not in registers:
+                registers[register] = len(values)
+                values.append(value)
+                owners[register] = name
+            elif values[registers[register]] != value:
+                raise LinkError("The register {} starts at {} in {}, but at {} in {}.".format(
+                    register, values[registers[register]], owners[register], value, name))
+    # the declared registers come first, in the order they are declared in
+    constants = {}
+    for obj in objects:
+        for constant in obj["constants"]:
+            constants.setdefault(constant, len(values)+len(constants))
+    values.extend(constants)
+    # followed by a single constant pool
+    helpRegisters = len(values)
+    values.extend([0]*max(obj["helpRegisters"] for obj in objects))
+    # and the help registers, as many as the object using the most needs
+    labels = {}
+    owners = {}
+    bases = []
+    base = 0
+    for name, obj in zip(names, objects):
+        bases.append(base)
+        for label, line in obj["labels"].items():
+            if label in labels:
+                raise LinkError("The label {} is defined in {} and {}.".format(label, owners[label], name))
+            labels[label] = base+line
+            owners[label] = name
+        base += len(obj["code"])
+    # the code of every object starts behind that of the previous one
+    instructions = []
+    for name, obj, base in zip(names, objects, bases):
+        addresses = [registers[register]+1 for register, value in obj["registers"]]
+        addresses.extend(constants[constant]+1 for constant in obj["constants"])
+        addresses.extend(range(helpRegisters+1, helpRegisters+obj["helpRegisters"]+1))
+        # the address in the program of every register of the object
+        for opcode, operand in obj["code"]:
+            if operand is None:
+                instructions.append((opcode, None))
+            elif opcode != "JMP":
+                instructions.append((opcode, addresses[operand-1]))
+            elif isinstance(operand, str):
+                if operand not in labels:
+                    raise LinkError("The label {} used in {} is not defined in any object.".format(operand, name))
+                instructions.append((opcode, labels[operand]))
+            else:
+                instructions.append((opcode, base+operand))
+    width = fitTarget(target, maxLines, len(instructions), len(values),
+                      lambda: [(name, len(obj["code"])) for name, obj in zip(names, objects)], "object")
+    comments = [comment for obj in objects for comment in obj["comments"]]
+    comments.extend([""]*(10-len(comments)))
+    # there are at least 10 comments as in a compiled program
+    if binary:
+        return pack(width, instructions, values, comments)
+    return "".join(formatText(width, instructions, values, comments))
+
+class LinkError(Exception):
+
+    """An error raised if objects cannot be linked, e.g. because of a label defined twice."""
+
+    pass
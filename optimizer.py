@@ -6,66 +6,356 @@ Exports:
 """
 
 from intermediate_code import Instruction, Operand
-from copy import deepcopy
+from passes import PassManager
 
-def Optimizer(ic):
+JUMP_OPCODES = ["jmp", "jg", "jge", "jl", "jle", "je", "jne"]
+"""the intermediate instructions jumping to a label"""
+
+WRITE_OPCODES = ["add", "sub", "mov", "mul", "div", "mod"]
+"""the intermediate instructions changing their first operand"""
+
+def Optimizer(ic, passManager=None):
 
     """
     Optimize intermediate code and return the new code.
 
     This function applies several optimizations to the intermediate code
     that do not change the functionality but make it shorter and faster to
-    execute. All optimizations are in their own wrapped function. They are
-    applied until the code is not changed anymore.
+    execute. All optimizations are in their own wrapped function and return
+    how often they changed the code. They are registered as passes of the
+    stage ir with the pass manager, which applies those enabled until the
+    code is not changed anymore. The number of rounds and the changes by every
+    optimization are stored in the optimizerStats of the returned code.
 
     Arguments:
-        @param ic: the IntermediateCode object to be optimized
+        @param ic:          the IntermediateCode object to be optimized
+        @param passManager: the pass manager running the optimizations,
+                            one for the default level if not given
 
-        @type ic: IntermediateCode
+        @type ic:          IntermediateCode
+        @type passManager: PassManager
 
     @return: the optimized intermediate code
     @rtype: IntermediateCode
     """
 
-    ic = deepcopy(ic)
+    ic = ic.copy()
 
-    def optimizeJmpToJmp():
+    def optimizeJmpToJmp() -> int:
+        hits = 0
         for i, instruction in enumerate(ic.instructions):
-            if (instruction.opcode in ["jmp", "jg", "jge", "jl", "jle", "je", "jne"] and
-                ic.instructions[ic.symbolTable[instruction.op1.val]].opcode == "jmp"):
+            if (instruction.opcode in JUMP_OPCODES and
+                ic.instructions[ic.symbolTable[instruction.op1.val]].opcode == "jmp" and
+                ic.instructions[ic.symbolTable[instruction.op1.val]].op1 != instruction.op1):
                 ic.instructions[i] = instruction._replace(op1=ic.instructions[ic.symbolTable[instruction.op1.val]].op1)
+                hits += 1
                 # if jumping to an unconditional jump one can directly jump to the line
                 # pointed to by the second jump
+        return hits
 
-    def optimizeJmpToHlt():
+    def optimizeJmpToHlt() -> int:
+        hits = 0
         for i, instruction in enumerate(ic.instructions):
             if (instruction.opcode == "jmp" and
                 ic.instructions[ic.symbolTable[instruction.op1.val]].opcode == "hlt"):
-                ic.instructions[i] = Instruction("hlt", None, None)
+                ic.instructions[i] = instruction._replace(opcode="hlt", op1=None)
+                hits += 1
                 # an unconditional jump to a hlt can be replaced by a hlt
+        return hits
 
-    def optimizeJmpToNextLine():
+    def optimizeJmpToNextLine() -> int:
+        hits = 0
         i = 0
         while i < len(ic.instructions):
             instruction = ic.instructions[i]
-            if (instruction.opcode in ["jmp", "jg", "jge", "jl", "jle", "je", "jne"] and
+            if (instruction.opcode in JUMP_OPCODES and
                 ic.symbolTable[instruction.op1.val] == i+1):
-                ic.instructions.pop(i)
+                count = 1
+                if instruction.opcode != "jmp" and i > 0 and ic.instructions[i-1].opcode == "cmp":
+                    i -= 1
+                    count = 2
+                    # a comparison without its conditional jump has no effect
+                    # either and has to go with it
+                del ic.instructions[i:i+count]
+                hits += 1
                 # any jump to the next line is unnecessary and will have no effect
                 # and can therefore be deleted
                 for label in ic.symbolTable:
                     if label[0] == ".":
                         if ic.symbolTable[label] > i:
-                            ic.symbolTable[label] -= 1
+                            ic.symbolTable[label] = max(i, ic.symbolTable[label] - count)
                         # labels need to be adjusted to the new line constellation
+                for register, scope in ic.helpRegisterScopes.items():
+                    if scope > i:
+                        ic.helpRegisterScopes[register] = max(i, scope - count)
+                    # so do the scopes of the help registers
             else:
                 i += 1
+        return hits
+
+    def getSuccessors(line: int) -> list:
+        """
+        Return the lines that may be executed after the given line.
+
+        Parameters:
+            @param line: the line of the instruction
+
+            @type line: int
+
+        @return: the lines of all possible successors
+        @rtype: list
+        """
+        instruction = ic.instructions[line]
+        if instruction.opcode in ["hlt", "ext"]:
+            return []
+            # a jump to an external label leaves the program as far as it is known
+        elif instruction.opcode == "jmp":
+            return [ic.symbolTable[instruction.op1.val]]
+        elif instruction.opcode in JUMP_OPCODES:
+            return [ic.symbolTable[instruction.op1.val], line+1]
+        return [line+1]
+
+    def findLoops() -> tuple:
+        """
+        Find the natural loops of the intermediate code.
+
+        A jump to a line dominating the jumping line, i.e. a line that is
+        executed on every path from the start of the program to it, is a
+        back edge. Its loop consists of the target, the header of the loop,
+        and all lines reaching the back edge without passing the header.
+
+        @return: a dict mapping the header of every loop to the set of its
+                 lines, the successors and the predecessors of every line
+        @rtype: tuple
+        """
+        successors = [getSuccessors(line) for line in range(len(ic.instructions))]
+        predecessors = [[] for line in successors]
+        for line, lines in enumerate(successors):
+            for successor in lines:
+                predecessors[successor].append(line)
+        order = []
+        visited = {0}
+        stack = [(0, iter(successors[0]))]
+        while stack:
+            line, unvisited = stack[-1]
+            for successor in unvisited:
+                if successor not in visited:
+                    visited.add(successor)
+                    stack.append((successor, iter(successors[successor])))
+                    break
+            else:
+                stack.pop()
+                order.append(line)
+        order.reverse()
+        # lines in reverse postorder, unreachable lines are left out
+        position = dict((line, i) for i, line in enumerate(order))
+        dominators = {0: 0}
+        changed = True
+        while changed:
+            changed = False
+            for line in order[1:]:
+                dominator = None
+                for predecessor in predecessors[line]:
+                    if predecessor not in dominators:
+                        continue
+                    elif dominator is None:
+                        dominator = predecessor
+                        continue
+                    while predecessor != dominator:
+                        while position[predecessor] > position[dominator]:
+                            predecessor = dominators[predecessor]
+                        while position[dominator] > position[predecessor]:
+                            dominator = dominators[dominator]
+                if dominators.get(line) != dominator:
+                    dominators[line] = dominator
+                    changed = True
+        # the immediate dominator of every line is the nearest common
+        # dominator of its predecessors
+
+        def dominates(dominator, line):
+            while line != dominator and line != 0:
+                line = dominators[line]
+            return line == dominator
+
+        loops = {}
+        for line in order:
+            for successor in successors[line]:
+                if position[successor] <= position[line] and dominates(successor, line):
+                    body = loops.setdefault(successor, {successor})
+                    stack = [line]
+                    while stack:
+                        line = stack.pop()
+                        if line not in body:
+                            body.add(line)
+                            stack.extend(predecessor for predecessor in predecessors[line] if predecessor in position)
+                    # loops sharing a header are merged
+        return loops, successors, predecessors
+
+    def hoistLoopInvariants() -> int:
+        """
+        Move loop invariant help register calculations out of their loops.
+
+        Help registers are zero outside of their calculation and hold its
+        result wherever they are read. A calculation starting with an add
+        whose operands are not changed inside the loop thus yields the same
+        result in every iteration. It is moved in front of the header, all
+        resets inside the loop are dropped and the help register is reset
+        at the exits of the loop instead.
+        A single calculation is hoisted per loop and only out of loops not
+        overlapping each other, so that they can all be moved at once.
+        In a relocatable object, other objects may jump to every label defined
+        in the source, so loops containing one of them are left alone.
+
+        @return: the number of hoisted calculations
+        @rtype: int
+        """
+        loops, successors, predecessors = findLoops()
+        occurrences = {}
+        for line, instruction in enumerate(ic.instructions):
+            for op in set(instruction[1:3]):
+                if op is not None and op.typ == "HELP_REGISTER":
+                    occurrences.setdefault(op.val, []).append(line)
+        labelLines = set(line for label, line in ic.symbolTable.items() if label[0] == ".")
+        entries = set(ic.symbolTable[label] for label in ic.userLabels) if ic.relocatable else set()
+        insertions = {}
+        headerInsertions = {}
+        removals = set()
+        preheaders = {}
+        hoisted = {}
+        touched = set()
+
+        def isReset(line, op):
+            return ic.instructions[line]._replace(line=None) == Instruction("mov", op, Operand("CONSTANT", "0"))
+
+        def findHoistable(header, body) -> tuple:
+            # return the help register, its calculation, the lines to place it in front of
+            # and the exits of the loop of the first hoistable calculation in the loop
+            written = set(ic.instructions[line].op1 for line in body if ic.instructions[line].opcode in WRITE_OPCODES)
+            for register in sorted(set(op.val for line in body for op in ic.instructions[line][1:3]
+                                       if op is not None and op.typ == "HELP_REGISTER")):
+                op = Operand("HELP_REGISTER", register)
+                lines = occurrences[register]
+                calculation = [line for line in lines if line in body and
+                               ic.instructions[line].opcode in WRITE_OPCODES and
+                               ic.instructions[line].op1 == op and not isReset(line, op)]
+                if (not calculation or
+                    calculation != list(range(calculation[0], calculation[-1]+1)) or
+                    labelLines.intersection(calculation[1:]) or
+                    ic.instructions[calculation[0]].opcode != "add" or
+                    not all(isReset(line, op) for line in lines if line not in body)):
+                    continue
+                    # the calculation must be a single sequence starting at zero
+                    # and the help register unused outside of the loop
+                if not all(ic.instructions[line].opcode != "sub" and
+                           (ic.instructions[line].op2.typ == "CONSTANT" or
+                            (ic.instructions[line].opcode not in ["div", "mod"] and
+                             ic.instructions[line].op2 not in written))
+                           for line in calculation):
+                    continue
+                    # subtractions and divisions by registers are never hoisted as they
+                    # might halt the program on a negative result or a zero divisor
+                    # if the loop would not have calculated them
+                outsidePredecessors = [line for line in predecessors[header] if line not in body]
+                if header > 0 and header-1 in body and ic.instructions[header-1].opcode not in ["jmp", "hlt", "ext"]:
+                    # the loop falls through into its header, e.g. a rotated while loop,
+                    # so the calculation is placed in front of every jump entering it
+                    if not all(ic.instructions[line].opcode == "jmp" for line in outsidePredecessors):
+                        continue
+                    positions = outsidePredecessors
+                else:
+                    positions = [header]
+                if not positions or min(positions) > min(body):
+                    continue
+                    # the help register must be in use on every line of the loop
+                exits = set(successor for line in body for successor in successors[line] if successor not in body)
+                for exitLine in list(exits):
+                    line = exitLine
+                    while (line < len(ic.instructions) and ic.instructions[line].opcode == "mov" and
+                           ic.instructions[line].op1.typ == "HELP_REGISTER" and isReset(line, ic.instructions[line].op1)):
+                        if ic.instructions[line].op1 == op:
+                            exits.discard(exitLine)
+                        line += 1
+                    # there is no need to reset the help register where it is reset already
+                return op, calculation, positions, exits, outsidePredecessors
+            return None
+
+        for header, body in sorted(loops.items(), key=lambda e: len(e[1])):
+            # inner loops first
+            if entries.intersection(body):
+                continue
+                # a jump from another object into the loop would skip the hoisted calculation
+            hoistable = findHoistable(header, body)
+            if hoistable is None:
+                continue
+            op, calculation, positions, exits, outsidePredecessors = hoistable
+            lines = body.union(positions, exits, outsidePredecessors)
+            if touched.intersection(lines):
+                continue
+            touched.update(lines)
+            for line in exits:
+                insertions[line] = [Instruction("mov", op, Operand("CONSTANT", "0"), ic.instructions[calculation[0]].line)]
+            for line in positions:
+                insertions.setdefault(line, []).extend(ic.instructions[calculated] for calculated in calculation)
+            removals.update(line for line in occurrences[op.val] if line in body and
+                            (line in calculation or isReset(line, op)))
+            if positions == [header]:
+                headerInsertions[header] = len(calculation)
+                jumps = [line for line in outsidePredecessors if ic.instructions[line].opcode in JUMP_OPCODES and
+                         ic.symbolTable[ic.instructions[line].op1.val] == header]
+                if jumps:
+                    preheaders[header] = ".PREHEADER_{}".format(ic.loopCount)
+                    ic.loopCount += 1
+                for line in jumps:
+                    ic.instructions[line] = ic.instructions[line]._replace(op1=Operand("LABEL_IDENTIFIER", preheaders[header]))
+                # jumps into the loop from outside have to pass the calculation
+            hoisted[op] = body
+        if not hoisted:
+            return 0
+
+        lineMap = []
+        instructions = []
+        for line, instruction in enumerate(ic.instructions):
+            lineMap.append(len(instructions))
+            instructions.extend(insertions.get(line, []))
+            if line not in removals:
+                instructions.append(instruction)
+        lineMap.append(len(instructions))
+        for label, line in ic.symbolTable.items():
+            if label[0] == ".":
+                ic.symbolTable[label] = lineMap[line]+headerInsertions.get(line, 0)
+                # labels of a header point behind the hoisted calculation
+        for header, preheader in preheaders.items():
+            ic.symbolTable[preheader] = lineMap[header]
+        for helpRegister, scope in ic.helpRegisterScopes.items():
+            ic.helpRegisterScopes[helpRegister] = lineMap[scope]
+        lastLines = {}
+        for line, instruction in enumerate(instructions):
+            for op in instruction[1:3]:
+                if op in hoisted:
+                    lastLines[op] = line
+        for op, body in hoisted.items():
+            ic.helpRegisterScopes[op.val] = max(lastLines[op], max(lineMap[line] for line in body))+1
+            # the help register is in use from the hoisted calculation
+            # to the last line of the loop or the last reset
+        ic.instructions = instructions
+        return len(hoisted)
+
+    def optimizeLoopInvariants() -> int:
+        hits = 0
+        hoisted = hoistLoopInvariants()
+        while hoisted:
+            hits += hoisted
+            hoisted = hoistLoopInvariants()
+            # calculations may be hoisted out of several nested loops
+        return hits
 
-    optimizations = [optimizeJmpToJmp, optimizeJmpToHlt, optimizeJmpToNextLine]
-    old_instructions = None
-    while old_instructions != ic.instructions:
-        # apply optimizations until the intermediate code doesn't change
-        old_instructions = deepcopy(ic.instructions)
-        for optimization in optimizations:
-            optimization()
+    if passManager is None:
+        passManager = PassManager()
+    for optimization in [optimizeJmpToJmp, optimizeJmpToHlt, optimizeJmpToNextLine, optimizeLoopInvariants]:
+        passManager.register("ir", optimization.__name__, optimization)
+    passManager.run("ir")
+    # apply optimizations until the intermediate code doesn't change
+    stats = passManager.stats["ir"]
+    ic.optimizerStats = {"iterations": stats["iterations"],
+                         "hits": dict((name, values["changes"]) for name, values in stats["passes"].items())}
     return ic
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+The pass manager of Py2Bon.
+
+The optimizations of the intermediate code and of the Bonsai code are passes
+registered with a PassManager by the stage running them. The optimization
+level decides which passes run and how the code generator trades the number
+of steps against the number of lines.
+
+Exports:
+    PASSES: dict       - the stage and a description of every pass by name
+    LEVELS: dict       - the passes and code generator settings of every optimization level
+    PassManager: class - runs the enabled passes of a stage and records their statistics
+"""
+
+from time import perf_counter
+
+from intermediate_code import TEMPLATES
+
+PASSES = {
+    "optimizeJmpToJmp": ("ir", "jump directly to the target of a jump to an unconditional jump"),
+    "optimizeJmpToHlt": ("ir", "halt instead of jumping to a halt"),
+    "optimizeJmpToNextLine": ("ir", "remove jumps to the next line"),
+    "optimizeLoopInvariants": ("ir", "move loop invariant calculations out of their loops"),
+    "threadBonsaiJumps": ("bonsai", "jump directly to the target of a JMP to a JMP or halt instead of jumping to a HLT"),
+    "removeBonsaiJumpsToNextLine": ("bonsai", "remove JMP instructions to the next line not skipped by a TST"),
+    "removeUnreachableBonsaiLines": ("bonsai", "remove Bonsai lines that are never executed")
+}
+"""the stage, ir or bonsai, and a description of every pass by name in the order they run in"""
+
+LEVELS = {
+    "0": {"passes": [], "unrollLimit": 8, "templates": "steps", "outline": False},
+    "1": {"passes": ["optimizeJmpToJmp", "optimizeJmpToHlt", "optimizeJmpToNextLine", "threadBonsaiJumps"],
+          "unrollLimit": 8, "templates": "steps", "outline": False},
+    "2": {"passes": list(PASSES), "unrollLimit": 8, "templates": "steps", "outline": False},
+    "3": {"passes": list(PASSES), "unrollLimit": 16, "templates": "steps", "outline": False},
+    "s": {"passes": list(PASSES), "unrollLimit": 8, "templates": "size", "outline": True}
+}
+"""the passes run at every optimization level and the settings of the code generator, the largest
+constant unrolled, the table of templates and whether templates are outlined; with the templates
+for size, a constant is only unrolled where that takes no more lines than reading it from a register"""
+
+class PassManager(object):
+
+    """
+    Runs the passes of a stage until they do not change the code anymore.
+
+    Stages register their passes, which are functions changing the code in place
+    and returning how often they changed it. Only the passes enabled by the
+    optimization level and the flags of the manager are run.
+
+    Properties:
+        level         - the name of the optimization level in LEVELS
+        enabled       - the names of the passes that are run
+        maxIterations - the largest number of rounds the passes of a stage are run for
+                        when running them once, None to run them until nothing changes
+        stats         - by stage, the number of rounds and for every pass how often it
+                        changed the code and the time it took in seconds
+
+    Methods:
+        register(stage, name, function) - register a pass of a stage
+        run(stage)                      - run the enabled passes of a stage and return
+                                          the number of changes
+        configure(ic)                   - apply the settings of the level to intermediate code
+    """
+
+    def __init__(self, level="2", enable=(), disable=(), maxIterations=None):
+        """
+        Create a pass manager for an optimization level.
+
+        Parameters:
+            @param level:         the name of the optimization level in LEVELS
+            @param enable:        the names of passes to run in addition to those of the level
+            @param disable:       the names of passes not to run
+            @param maxIterations: the largest number of rounds or None
+
+            @type level:         str
+            @type enable:        list
+            @type disable:       list
+            @type maxIterations: int
+        """
+        if level not in LEVELS:
+            raise ValueError("There is no optimization level {}.".format(level))
+        for name in list(enable)+list(disable):
+            if name not in PASSES:
+                raise ValueError("There is no pass {}.".format(name))
+        self.level = level
+        """@type: str"""
+        self.enabled = (set(LEVELS[level]["passes"])|set(enable))-set(disable)
+        """@type: set"""
+        self.maxIterations = maxIterations
+        """@type: int"""
+        self.stats = {}
+        """@type: dict"""
+        self.passes = {}
+        # the registered passes by stage and name
+
+    def register(self, stage: str, name: str, function):
+        """
+        Register a pass of a stage, replacing any registered before under its name.
+
+        Parameters:
+            @param stage:    the stage running the pass, ir or bonsai
+            @param name:     the name of the pass in PASSES
+            @param function: the pass, changing the code in place and returning
+                             how often it changed it
+
+            @type stage:    str
+            @type name:     str
+            @type function: func
+        """
+        if PASSES.get(name, (None, ))[0] != stage:
+            raise ValueError("There is no pass {} of stage {}.".format(name, stage))
+        self.passes.setdefault(stage, {})[name] = function
+
+    def run(self, stage: str) -> int:
+        """
+        Run the enabled passes of a stage in order until none of them changes the code.
+
+        @param stage: the stage whose passes are run
+        @type stage:  str
+
+        @return: the number of changes of all passes
+        @rtype: int
+        """
+        passes = [(name, function) for name, function in self.passes.get(stage, {}).items() if name in self.enabled]
+        passes.sort(key=lambda e: list(PASSES).index(e[0]))
+        stats = self.stats.setdefault(stage, {"iterations": 0, "passes": {}})
+        for name, function in passes:
+            stats["passes"].setdefault(name, {"changes": 0, "time": 0.0})
+        total = 0
+        iterations = 0
+        changes = len(passes)
+        while changes and (self.maxIterations is None or iterations < self.maxIterations):
+            changes = 0
+            iterations += 1
+            for name, function in passes:
+                start = perf_counter()
+                hits = function()
+                stats["passes"][name]["time"] += perf_counter()-start
+                stats["passes"][name]["changes"] += hits
+                changes += hits
+            total += changes
+            # a pass may enable others, so all of them are run again after any change
+        stats["iterations"] += iterations
+        return total
+
+    def configure(self, ic):
+        """
+        Apply the code generator settings of the optimization level to intermediate code.
+
+        @param ic: the intermediate code to compile
+        @type ic:  IntermediateCode
+        """
+        settings = LEVELS[self.level]
+        ic.unrollLimit = settings["unrollLimit"]
+        ic.templates = TEMPLATES[settings["templates"]]
+        ic.outline = settings["outline"]
+        ic.passManager = self
@@ -8,9 +8,35 @@ This file provides a CLI to the compiler.
 """
 
 import argparse
+import json
 import os
 import re
-from compile import compilePB
+import sys
+from contextlib import ExitStack
+from compile import compileObjectPB, reportPB, EMIT_STAGES
+from intermediate_code import CompilerError, SizeError, TARGETS
+from binary_format import toText, BinaryFormatError
+from simulator import SimulatorError
+from linker import link, LinkError
+from passes import PassManager, PASSES, LEVELS
+
+def inputValues(text: str) -> dict:
+    """Parse the start values of registers given as NAME=VALUE,... for --input.
+
+    @param text: the assignments separated by commas
+    @type text:  str
+
+    @return: a dict mapping register names to their start values
+    @rtype: dict
+    """
+    values = {}
+    for assignment in text.split(","):
+        name, equals, value = assignment.partition("=")
+        if not equals or not name.strip() or not value.strip().isdigit():
+            raise argparse.ArgumentTypeError("{} is not of the form NAME=VALUE with a value of at least 0".format(
+                assignment.strip()))
+        values[name.strip()] = int(value)
+    return values
 
 def main():
     """Parse command line arguments and invoke compilation."""
@@ -21,24 +47,151 @@ def main():
     out_group = parser.add_mutually_exclusive_group()
     out_group.add_argument("-o", "--out", metavar="PATH", help="output file, defaults to name of input")
     out_group.add_argument("-k", "--keep", action="store_false", help="keep local filesystem; invoke with -p")
-    parser.add_argument("file", help="the file to compile")
+    parser.add_argument("--profile-gen", metavar="PATH", help="run the program in the simulator and save its profile")
+    parser.add_argument("--profile-use", metavar="PATH", help="optimize the program using a saved profile")
+    parser.add_argument("-O", dest="level", choices=list(LEVELS), default="2",
+                        help="the optimization level: 0 does not optimize, 1 runs the cheap passes, 2 all of them, "
+                             "3 also unrolls more and s makes the program as small as possible; defaults to 2")
+    parser.add_argument("--enable-pass", metavar="PASS", choices=list(PASSES), action="append", default=[],
+                        help="run a pass not run at the optimization level; may be repeated, "
+                             "one of {}".format(", ".join(PASSES)))
+    parser.add_argument("--disable-pass", metavar="PASS", choices=list(PASSES), action="append", default=[],
+                        help="do not run a pass; may be repeated")
+    parser.add_argument("--max-iterations", metavar="N", type=int,
+                        help="run the passes of every stage at most N times instead of until nothing changes")
+    parser.add_argument("--outline", action="store_true",
+                        help="share the code of comparisons and additions repeated for the same registers "
+                             "to make the program smaller but slower")
+    parser.add_argument("--format", choices=["text", "bin"], default="text",
+                        help="write the Bonsai code as text or in the binary format to a .bin file; "
+                             "-p always prints text")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="extended",
+                        help="the machine to compile for: the Bonsai computer with two-digit addresses "
+                             "or an extended one with addresses as wide as needed")
+    parser.add_argument("--max-lines", metavar="N", type=int,
+                        help="make the program smaller until it has at most N lines or fail")
+    parser.add_argument("--input", metavar="NAME=VALUE,...", type=inputValues, action="append",
+                        help="start values of registers for a profiling run; may be repeated for several runs")
+    parser.add_argument("--profile-lines", action="store_true",
+                        help="run the program in the simulator and print the source annotated with the executed steps")
+    parser.add_argument("--cost", action="store_true",
+                        help="print the source annotated with the static cost of every line")
+    parser.add_argument("--stats", choices=["json"],
+                        help="print the time and memory taken by every stage of the compiler and the sizes of their results")
+    parser.add_argument("--source-map", action="store_true",
+                        help="save a map from Bonsai lines to source lines next to the output file")
+    parser.add_argument("--emit", metavar="STAGE,...",
+                        help="save the results of the given stages as JSON lines next to the input, "
+                             "one of {} each".format(", ".join(EMIT_STAGES)))
+    link_group = parser.add_mutually_exclusive_group()
+    link_group.add_argument("-c", dest="object", action="store_true",
+                            help="compile to a relocatable object <name>.bo, in which gotos to labels the file "
+                                 "does not define jump to other objects")
+    link_group.add_argument("--link", action="store_true",
+                            help="link the objects given as files into a program named after the first one, "
+                                 "which is executed first")
+    parser.add_argument("file", nargs="+", help="the file to compile or the objects to link")
     args = parser.parse_args()
-    filename = os.path.join(os.getcwd(), args.file)
-    if os.path.isfile(filename):
-        with open(filename, "r") as file:
-            pyProg = file.read()
-        bonProg = compilePB(pyProg, args.verbose)
+    if len(args.file) > 1 and not args.link:
+        parser.error("only --link takes several files")
+    if args.link:
+        objects = []
+        for name in args.file:
+            if not os.path.isfile(name):
+                print("The file {} does not exist.".format(name))
+                return
+            with open(name, "r") as file:
+                objects.append(json.load(file))
+        binary = args.format == "bin"
+        outname = args.out or os.path.splitext(args.file[0])[0]+(".bin" if binary else ".bon")
+        try:
+            bonProg = link(objects, args.file, args.target, args.max_lines, binary)
+        except (LinkError, SizeError, BinaryFormatError) as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
         if args.keep:
-            if args.out:
-                outname = args.out
-            else:
-                outname = os.path.join(os.path.dirname(filename), re.search(r"(?:.*[/\\])?(.+)\..+?$", args.file).group(1)+".bon")
-            with open(outname, "w", newline="") as file:
+            with open(outname, "wb") if binary else open(outname, "w", newline="") as file:
                 file.write(bonProg)
         if args.print:
-            print(bonProg, end="")
+            print(toText(bonProg) if binary else bonProg, end="")
+        return
+    stages = args.emit.split(",") if args.emit else []
+    for stage in stages:
+        if stage not in EMIT_STAGES:
+            parser.error("there is no stage {}".format(stage))
+    filename = os.path.join(os.getcwd(), args.file[0])
+
+    def passes():
+        # return the pass manager of the compilation
+        return PassManager(args.level, args.enable_pass, args.disable_pass, args.max_iterations)
+
+    if os.path.isfile(filename):
+        with open(filename, "r") as file:
+            pyProg = file.read()
+        profile = None
+        if args.profile_use:
+            with open(args.profile_use, "r") as file:
+                profile = json.load(file)
+        if args.object:
+            try:
+                bonObject = compileObjectPB(pyProg, args.verbose, profile, args.outline, passes())
+            except CompilerError as error:
+                print(error, file=sys.stderr)
+                sys.exit(1)
+            if args.keep:
+                with open(args.out or os.path.splitext(filename)[0]+".bo", "w") as file:
+                    json.dump(bonObject, file)
+            if args.print:
+                print(json.dumps(bonObject))
+            return
+        binary = args.format == "bin"
+        if args.out:
+            outname = args.out
+        else:
+            outname = os.path.join(os.path.dirname(filename), re.search(r"(?:.*[/\\])?(.+)\..+?$", args.file[0]).group(1)+
+                                   (".bin" if binary else ".bon"))
+        with ExitStack() as outputs:
+            files = []
+
+            def write(code):
+                # write Bonsai code to the output file and the console while it is produced; the file is
+                # opened with the first line so that a program that does not fit leaves it untouched
+                if args.keep and not files:
+                    files.append(outputs.enter_context(open(outname, "wb") if binary else open(outname, "w", newline="")))
+                for output in files:
+                    output.write(code)
+                if args.print:
+                    sys.stdout.write(toText(code) if binary else code)
+                    # a binary program is written at once
+
+            sink = type("Sink", (object, ), {"write": lambda self, text: write(text)})()
+            reports = [name for name, asked in [("profile", args.profile_gen), ("lines", args.profile_lines),
+                                                ("cost", args.cost), ("stats", args.stats)] if asked]
+            emit = dict((stage, outputs.enter_context(open("{}.{}.jsonl".format(os.path.splitext(filename)[0], stage), "w")))
+                        for stage in stages)
+            try:
+                bonProg, sourceMap, results = reportPB(pyProg, reports, args.input or [], args.verbose, profile,
+                                                       args.outline, args.target, args.max_lines, passes(),
+                                                       sink if args.keep or args.print else None, binary, emit)
+            except (CompilerError, BinaryFormatError, SimulatorError) as error:
+                print(error, file=sys.stderr)
+                sys.exit(1)
+                # a simulator error is e.g. an input for a register the program does not declare
+        # the program and all reports come from a single compilation
+        if args.keep and args.source_map:
+            with open(outname+".map", "w") as file:
+                json.dump({"source": args.file[0], "lines": sourceMap}, file)
+        if args.profile_gen:
+            with open(args.profile_gen, "w") as file:
+                json.dump(results["profile"], file, indent=4, sort_keys=True)
+        if args.profile_lines:
+            print(results["lines"], end="")
+        if args.cost:
+            print(results["cost"], end="")
+        if args.stats:
+            print(json.dumps(results["stats"], sort_keys=True))
     else:
-        print("The file {} does not exist.".format(args.file))
+        print("The file {} does not exist.".format(args.file[0]))
 
 if __name__ == "__main__":
     main()
@@ -54,11 +54,20 @@ def SemanticAnalysis(syntaxTree):
 
                 @type node: ASTNode
             """
-            if node.typ in ["BRANCH", "LABEL"]:
+            if node.typ in ["BRANCH", "LABEL", "CONDITIONAL_LOOP"]:
                 self.hasBranched = True
                 # all assignments are now dynamic
                 for child in node.children:
                     self.analyzeNode(child)
+            elif node.typ == "COUNTED_LOOP":
+                self.hasBranched = True
+                # all assignments are now dynamic
+                if node.children[0].val != "_":
+                    raise SemanticError("The variable of a counted loop must be _ as it cannot be read.")
+                self.checkSum(node.children[1])
+                # optimize constant expressions
+                for child in node.children[1:]:
+                    self.analyzeNode(child)
             elif node.typ == "ASSIGNMENT":
                 self.analyzeNode(node.children[1])
                 # check if the right side contains any undefined identifiers
@@ -88,7 +97,9 @@ def SemanticAnalysis(syntaxTree):
                         if node.children[1].val == "+":
                             # right side is a sum of statements
                             for i, child in enumerate(node.children[1].children):
-                                if child.val == node.children[0].val:
+                                if child.val == node.children[0].val and not any(
+                                        self.readsRegister(other, child.val)
+                                        for other in node.children[1].children[:i]+node.children[1].children[i+1:]):
                                     node.children[1].children.pop(i)
                                     node.val = "+="
                                     node.decorators.append("AUGMENTED_ASSIGNMENT")
@@ -110,6 +121,10 @@ def SemanticAnalysis(syntaxTree):
                         self.checkSum(node.children[1], False)
                         # optimize constant expressions
                         node.decorators.append("AUGMENTED_ASSIGNMENT")
+                    if ("AUGMENTED_ASSIGNMENT" in node.decorators and node.children[1].typ != "REGISTER" and
+                            self.readsRegister(node.children[1], node.children[0].val)):
+                        node.decorators.append("SELF_REFERENCE")
+                        # the right side must be calculated before the variable is changed
             elif node.typ == "IDENTIFIER" and node.val not in syntaxTree.symbolTable:
                 # undefined identifier is used
                 raise NameError("{} has not been declared before.".format(node.val))
@@ -144,6 +159,12 @@ def SemanticAnalysis(syntaxTree):
                 @type node:           ASTNode
                 @type assertPositive: bool
             """
+            for i, child in enumerate(node.children):
+                if child.typ == "SIGN":
+                    child.children[0] = self.foldTerm(child.children[0])
+                else:
+                    node.children[i] = self.foldTerm(child)
+                # fold products, quotients and remainders first
             constant = 0
             indices = []
             for i, child in enumerate(node.children):
@@ -172,11 +193,84 @@ def SemanticAnalysis(syntaxTree):
                 node.children[-1].addChild("CONSTANT", str(-constant))
                 # a negative constant is added last
                 # a new sign is therefore inserted
-            if len(node.children) == 1:
+            if not node.children:
+                node.addChild("CONSTANT", "0")
+                # all addends cancelled each other out
+            if len(node.children) == 1 and node.children[0].typ != "SIGN":
                 node.typ = node.children[0].typ
                 node.val = node.children[0].val
                 node.children = node.children[0].children
-                # remove the sum and only use register or constant if possible
+                # remove the sum and only use register or constant if possible,
+                # a single subtrahend stays in the sum to keep its sign
+
+        def readsRegister(self, node: ASTNode, name: str) -> bool:
+            """
+            Return whether the given arithmetic expression reads the given variable.
+
+            Parameters:
+                @param node: the arithmetic expression to search
+                @param name: the name of the variable
+
+                @type node: ASTNode
+                @type name: str
+
+            @return: True if the variable occurs anywhere in the expression
+            @rtype: bool
+            """
+            if node.typ == "REGISTER":
+                return node.val == name
+            return any(self.readsRegister(child, name) for child in node.children)
+
+        def foldTerm(self, node: ASTNode) -> ASTNode:
+            """
+            Fold a product, quotient or remainder and return the resulting node.
+
+            Constant terms are calculated at compile time and multiplications
+            by, divisions by or remainders of 0 and 1 are replaced by their result.
+            Constant factors are moved to the right and merged where possible.
+            Any other node is returned as is.
+
+            Raises SemanticError if a constant divisor is 0.
+
+            Parameters:
+                @param node: the node to fold
+
+                @type node: ASTNode
+
+            @return: the folded node
+            @rtype: ASTNode
+            """
+            if node.typ != "ARITHMETIC_OPERATOR" or node.val not in ["*", "//", "%"]:
+                return node
+            left = self.foldTerm(node.children[0])
+            right = node.children[1]
+            if node.val != "*" and right.typ == "CONSTANT" and int(right.val) == 0:
+                raise SemanticError("Division by zero.")
+            if node.val == "*" and left.typ == "CONSTANT":
+                left, right = right, left
+                # the constant factor is always the right one
+            if left.typ == "CONSTANT" and right.typ == "CONSTANT":
+                return ASTNode(node.parent, "CONSTANT", str({
+                    "*": lambda a, b: a*b,
+                    "//": lambda a, b: a//b,
+                    "%": lambda a, b: a%b
+                }[node.val](int(left.val), int(right.val))))
+            if ((left.typ == "CONSTANT" and int(left.val) == 0) or
+                (right.typ == "CONSTANT" and (node.val, int(right.val)) in [("*", 0), ("%", 1)])):
+                return ASTNode(node.parent, "CONSTANT", "0")
+            if right.typ == "CONSTANT" and int(right.val) == 1:
+                left.parent = node.parent
+                return left
+            if (node.val == "*" and right.typ == "CONSTANT" and left.val == "*" and
+                left.typ == "ARITHMETIC_OPERATOR" and left.children[1].typ == "CONSTANT"):
+                left.children[1].val = str(int(left.children[1].val)*int(right.val))
+                left.parent = node.parent
+                return left
+                # consecutive constant factors are merged
+            node.children = [left, right]
+            left.parent = node
+            right.parent = node
+            return node
 
 
     Analyzer()
@@ -0,0 +1,150 @@
+"""
+A simulator for Bonsai code.
+
+Runs compiled Bonsai programs and counts how often every line is executed,
+e.g. to record a profile that guides the optimizer.
+
+Exports:
+    Simulator: class      - executes Bonsai code and counts executed lines
+    SimulatorError: class - an error raised if a program cannot be executed
+"""
+
+from binary_format import BinaryProgram
+
+class Simulator(object):
+
+    """
+    Simulator for Bonsai code.
+
+    Parses the Bonsai code once, after which it can be run any number of times.
+    Binary programs are read directly without parsing any text.
+    The execution counts of the lines are accumulated over all completed runs.
+
+    Properties:
+        instructions - a list of (opcode, operand) tuples; operands are 1-based
+                       just like in the Bonsai code
+        registers    - the start values of the registers as set in the code
+        counts       - how often every line was executed in all runs
+        runs         - the number of completed runs
+        steps        - the number of instructions executed in all runs
+
+    Methods:
+        run(registers, maxSteps) - execute the program and return the final values
+                                   of all registers
+        rollUp(lineMap)          - sum up the execution counts of the lines by
+                                   what they are mapped to, e.g. source lines
+    """
+
+    def __init__(self, bonCode: str):
+        """
+        Parse the given Bonsai code.
+
+        Parameters:
+            @param bonCode: the Bonsai code as emitted by the compiler or a binary program
+                            as bytes, another buffer or a BinaryProgram
+
+            @type bonCode: str
+        """
+        self.instructions = []
+        """@type: list"""
+        self.registers = []
+        """@type: list"""
+        if type(bonCode) != str:
+            program = bonCode if isinstance(bonCode, BinaryProgram) else BinaryProgram(bonCode)
+            self.instructions = list(program.instructions())
+            self.registers = list(program.registers)
+            # the binary format holds the instructions and registers as numbers
+        else:
+            for line in bonCode.splitlines():
+                if not line or line[0] == ";":
+                    continue
+                    # comments are ignored
+                elif line[0] == "#":
+                    self.registers.append(int(line[1:]))
+                else:
+                    operand = line[3:].strip()
+                    self.instructions.append((line[:3], int(operand) if operand else None))
+        for opcode, operand in self.instructions:
+            if opcode in ["INC", "DEC", "TST"] and not 0 < operand <= len(self.registers):
+                raise SimulatorError("Register {} is used but not defined.".format(operand))
+        self.counts = [0]*len(self.instructions)
+        """@type: list"""
+        self.runs = 0
+        """@type: int"""
+        self.steps = 0
+        """@type: int"""
+
+    def run(self, registers=None, maxSteps=10000000) -> list:
+        """
+        Execute the program and return the final values of all registers.
+
+        Parameters:
+            @param registers: the start values of registers overriding the values
+                              set in the code, by their 0-based index
+            @param maxSteps:  the number of instructions after which the program is
+                              considered not to halt
+
+            @type registers: dict
+            @type maxSteps:  int
+
+        @return: the values of all registers when the program halted
+        @rtype: list
+        """
+        values = list(self.registers)
+        for register, value in (registers or {}).items():
+            values[register] = value
+        counts = [0]*len(self.instructions)
+        line = 0
+        steps = 0
+        while True:
+            if not 0 <= line < len(self.instructions):
+                raise SimulatorError("The program ran past its end to line {}.".format(line+1))
+            elif steps == maxSteps:
+                raise SimulatorError("The program did not halt within {} steps.".format(maxSteps))
+            steps += 1
+            counts[line] += 1
+            opcode, operand = self.instructions[line]
+            if opcode == "INC":
+                values[operand-1] += 1
+                line += 1
+            elif opcode == "DEC":
+                if values[operand-1] == 0:
+                    raise SimulatorError("Register {} is decremented below zero on line {}.".format(operand, line+1))
+                values[operand-1] -= 1
+                line += 1
+            elif opcode == "JMP":
+                line = operand-1
+            elif opcode == "TST":
+                line += 2 if values[operand-1] == 0 else 1
+                # the next line is skipped if the register is zero
+            elif opcode == "HLT":
+                break
+            else:
+                raise SimulatorError("Unknown instruction {} on line {}.".format(opcode, line+1))
+        self.counts = [old+new for old, new in zip(self.counts, counts)]
+        self.runs += 1
+        self.steps += steps
+        return values
+
+    def rollUp(self, lineMap: list) -> dict:
+        """
+        Sum up the execution counts of the lines by what the given map assigns them to.
+
+        Parameters:
+            @param lineMap: the key of every line, e.g. the source map of the program
+
+            @type lineMap: list
+
+        @return: the number of executed instructions by key
+        @rtype: dict
+        """
+        steps = {}
+        for key, count in zip(lineMap, self.counts):
+            steps[key] = steps.get(key, 0)+count
+        return steps
+
+class SimulatorError(Exception):
+
+    """An error raised by the simulator if a program cannot be executed."""
+
+    pass
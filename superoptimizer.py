@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+"""
+Superoptimizer for the Bonsai code templates of Py2Bon.
+
+The code generator expands add, sub, mov and cmp instructions and some common
+pairs of them into fixed templates of Bonsai code, which it reads from the
+table in templates.json. This offline tool searches for equivalent templates
+taking fewer lines or steps, exhaustively for short templates and stochastically
+by random rewrites for longer ones, and verifies every candidate on all register
+values up to a bound. Improvements can be written back to the table.
+
+Templates use the registers x and y for the operands, h for a help register,
+which is zero before and after the template, and target for the jump target
+of a comparison. Jumps are relative to the jumping line.
+
+Exports:
+    TEMPLATES_PATH: str     - the path of the table of templates
+    SPECS: dict             - the semantics of every template
+    run: func               - execute a template on the given register values
+    verify: func            - check a template against its semantics
+    measureCost: func       - fit the number of steps of a template
+    searchExhaustive: func  - find the shortest template by enumeration
+    searchStochastic: func  - improve a template by random rewrites
+"""
+
+import argparse
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from itertools import product
+from math import exp
+from random import Random
+
+TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates.json")
+"""the path of the table of templates read by the code generator"""
+
+OBJECTIVES = ["steps", "size"]
+"""the objectives templates are optimized for, the code generator uses the first one"""
+
+RESTART_ITERATIONS = 2000
+"""the number of rewrites without improvement after which the stochastic search restarts"""
+
+Spec = namedtuple("Spec", ["registers", "exits", "result", "precondition", "terms", "aliased"])
+"""
+The semantics of a template.
+
+registers:    the registers the template may use, all but h are inputs
+exits:        the ways to leave the template, end for running past its last line
+              and target for jumping to the target of a comparison
+result:       function returning the expected registers and exit for given registers
+precondition: function returning whether the template must handle given registers
+terms:        the terms of the registers its steps are fitted to by name
+aliased:      function like result if x and y may be the same register or None
+"""
+
+def _compare(opcode):
+    # return the spec of a comparison jumping to target if x opcode y holds
+    relation = {"je": lambda a, b: a == b, "jne": lambda a, b: a != b, "jg": lambda a, b: a > b,
+                "jge": lambda a, b: a >= b, "jl": lambda a, b: a < b, "jle": lambda a, b: a <= b}[opcode]
+    return Spec(["x", "y", "h"], ["end", "target"],
+                lambda v: (dict(v), "target" if relation(v["x"], v["y"]) else "end"),
+                lambda v: True, {"min(x,y)": lambda v: min(v["x"], v["y"])}, None)
+
+SPECS = {
+    "add": Spec(["x", "y", "h"], ["end"], lambda v: (dict(v, x=v["x"]+v["y"]), "end"), lambda v: True,
+                {"y": lambda v: v["y"]}, lambda v: (dict(v, x=2*v["x"]), "end")),
+    "sub": Spec(["x", "y", "h"], ["end"], lambda v: (dict(v, x=v["x"]-v["y"]), "end"), lambda v: v["x"] >= v["y"],
+                {"y": lambda v: v["y"]}, None),
+    "clear": Spec(["x"], ["end"], lambda v: (dict(v, x=0), "end"), lambda v: True, {"x": lambda v: v["x"]}, None),
+    "mov": Spec(["x", "y", "h"], ["end"], lambda v: (dict(v, x=v["y"]), "end"), lambda v: True,
+                {"x": lambda v: v["x"], "y": lambda v: v["y"]}, None),
+    "mov_reset": Spec(["x", "y", "h"], ["end"], lambda v: (dict(v, x=v["y"], y=0), "end"), lambda v: True,
+                      {"x": lambda v: v["x"], "y": lambda v: v["y"]}, None),
+    "cmp_je": _compare("je"),
+    "cmp_jne": _compare("jne"),
+    "cmp_jg": _compare("jg"),
+    "cmp_jge": _compare("jge"),
+    "cmp_jl": _compare("jl"),
+    "cmp_jle": _compare("jle")
+}
+"""the semantics of every template by its name in the table; mov_reset is a mov followed by a reset of its source"""
+
+def run(code: list, values: dict, maxSteps: int) -> tuple:
+    """
+    Execute a template on the given register values.
+
+    The template must leave it by running past its last line or by jumping to target.
+    Jumps are given as absolute line numbers.
+
+    Parameters:
+        @param code:     the template as a list of (opcode, operand) tuples
+        @param values:   the start values of the registers by name
+        @param maxSteps: the number of instructions after which the template fails
+
+        @type code:     list
+        @type values:   dict
+        @type maxSteps: int
+
+    @return: the exit, either end or target, the final values of the registers and the
+             number of executed instructions or None if the template fails
+    @rtype: tuple
+    """
+    registers = dict(values)
+    end = len(code)
+    line = 0
+    steps = 0
+    while line < end:
+        if steps == maxSteps:
+            return None
+        steps += 1
+        opcode, operand = code[line]
+        if opcode == "INC":
+            registers[operand] += 1
+            line += 1
+        elif opcode == "DEC":
+            if registers[operand] == 0:
+                return None
+            registers[operand] -= 1
+            line += 1
+        elif opcode == "TST":
+            line += 2 if registers[operand] == 0 else 1
+        elif opcode == "JMP":
+            if operand == "target":
+                return "target", registers, steps
+            line = operand
+        else:
+            return None
+    if line != end:
+        return None
+        # a test on the last line skipped past the end
+    return "end", registers, steps
+
+def _inputs(spec: Spec, bound: int) -> list:
+    # return all start values of the registers up to bound the template must handle
+    inputs = [name for name in spec.registers if name != "h"]
+    tests = []
+    for values in product(range(bound+1), repeat=len(inputs)):
+        values = dict(zip(inputs, values))
+        if "h" in spec.registers:
+            values["h"] = 0
+        if spec.precondition(values):
+            tests.append(values)
+    return tests
+
+def _max_steps(bound: int) -> int:
+    # return the number of steps after which a run is considered not to halt
+    return 40*(bound+2)
+
+def _errors(code: list, spec: Spec, tests: list, maxSteps: int) -> tuple:
+    # return how far the results of all tests are off and their total steps
+    # every register counts by its distance to the expected value, at most 2,
+    # a wrong exit by 2 and a failing run by 2 for every register and its exit
+    errors = 0
+    steps = 0
+    for values in tests:
+        result = run(code, values, maxSteps)
+        if result is None:
+            errors += 2*len(values)+2
+            steps += maxSteps
+            continue
+        expected, exit = spec.result(values)
+        errors += (result[0] != exit)*2 + sum(min(abs(result[1][name]-value), 2) for name, value in expected.items())
+        steps += result[2]
+    return errors, steps
+
+def _alias(code: list) -> list:
+    # return the template with y replaced by x
+    return [(opcode, "x" if operand == "y" else operand) for opcode, operand in code]
+
+def verify(code: list, spec: Spec, bound: int) -> bool:
+    """
+    Check a template against its semantics for all register values up to bound.
+
+    Parameters:
+        @param code:  the template with absolute jumps
+        @param spec:  the semantics of the template
+        @param bound: the largest value of any register to check
+
+        @type code:  list
+        @type spec:  Spec
+        @type bound: int
+
+    @return: True if the template computes the expected result for every value
+    @rtype: bool
+    """
+    maxSteps = _max_steps(bound)
+    if _errors(code, spec, _inputs(spec, bound), maxSteps)[0]:
+        return False
+    if spec.aliased is not None:
+        aliased = spec._replace(registers=[name for name in spec.registers if name != "y"], result=spec.aliased)
+        return _errors(_alias(code), aliased, _inputs(aliased, bound), maxSteps)[0] == 0
+    return True
+
+def measureCost(code: list, spec: Spec, bound: int) -> dict:
+    """
+    Fit the number of steps of a template to a constant and a factor per term.
+
+    The factors are fitted by least squares and rounded, the constant is chosen
+    so that the cost is never lower than the actual number of steps.
+
+    Parameters:
+        @param code:  the template with absolute jumps
+        @param spec:  the semantics of the template
+        @param bound: the largest value of any register to measure
+
+        @type code:  list
+        @type spec:  Spec
+        @type bound: int
+
+    @return: the constant, the factors by term and whether the cost is approximate
+    @rtype: dict
+    """
+    samples = []
+    for values in _inputs(spec, bound):
+        steps = run(code, values, _max_steps(bound))[2]
+        samples.append(([1]+[term(values) for term in spec.terms.values()], steps))
+    size = len(spec.terms)+1
+    matrix = [[Fraction(sum(row[i]*row[j] for row, steps in samples)) for j in range(size)] +
+              [Fraction(sum(row[i]*steps for row, steps in samples))] for i in range(size)]
+    for i in range(size):
+        pivot = next(j for j in range(i, size) if matrix[j][i] != 0)
+        matrix[i], matrix[pivot] = matrix[pivot], matrix[i]
+        for j in range(size):
+            if j != i:
+                ratio = matrix[j][i]/matrix[i][i]
+                matrix[j] = [a-ratio*b for a, b in zip(matrix[j], matrix[i])]
+    # solve the normal equations by Gauss-Jordan elimination
+    factors = [round(matrix[i][size]/matrix[i][i]) for i in range(1, size)]
+    residuals = [steps-sum(factor*value for factor, value in zip(factors, row[1:])) for row, steps in samples]
+    return {
+        "constant": max(residuals),
+        "terms": dict(zip(spec.terms, factors)),
+        "approximate": min(residuals) != max(residuals)
+    }
+
+def _to_absolute(code: list) -> list:
+    # return a template of the table with its relative jumps made absolute
+    return [(opcode, line+int(operand[1:]) if type(operand) == str and operand[0] == "@" else operand)
+            for line, (opcode, operand) in enumerate(code)]
+
+def _to_relative(code: list) -> list:
+    # return a template with absolute jumps in the format of the table
+    return [[opcode, "@{:+d}".format(operand-line) if type(operand) == int else operand]
+            for line, (opcode, operand) in enumerate(code)]
+
+def _alphabet(spec: Spec, length: int) -> list:
+    # return all instructions a template of the given length may consist of
+    instructions = [(opcode, register) for opcode in ["INC", "DEC", "TST"] for register in spec.registers]
+    instructions.extend(("JMP", line) for line in range(length+1))
+    if "target" in spec.exits:
+        instructions.append(("JMP", "target"))
+    return instructions
+
+def searchExhaustive(spec: Spec, maxLength: int, bound: int) -> list:
+    """
+    Find the shortest template by enumerating all templates up to a length.
+
+    Of all the shortest templates, the one taking the fewest steps is chosen.
+
+    Parameters:
+        @param spec:      the semantics of the template
+        @param maxLength: the length of the longest templates to enumerate
+        @param bound:     the largest value of any register to verify with
+
+        @type spec:      Spec
+        @type maxLength: int
+        @type bound:     int
+
+    @return: the template with absolute jumps or None if there is none this short
+    @rtype: list
+    """
+    quick = _inputs(spec, 1)
+    maxSteps = _max_steps(bound)
+    for length in range(1, maxLength+1):
+        found = []
+        for code in product(_alphabet(spec, length), repeat=length):
+            if any(opcode == "JMP" and operand == line for line, (opcode, operand) in enumerate(code)):
+                continue
+                # a jump to itself never halts
+            if _errors(code, spec, quick, maxSteps)[0] == 0 and verify(code, spec, bound):
+                found.append(list(code))
+        if found:
+            return min(found, key=lambda code: _errors(code, spec, _inputs(spec, bound), maxSteps)[1])
+    return None
+
+def searchStochastic(spec: Spec, start: list, objective: str, iterations: int, bound: int, random: Random,
+                     temperature=1.0) -> list:
+    """
+    Improve a template by random rewrites.
+
+    Instructions are randomly replaced, changed, swapped, deleted and inserted
+    and blocks of them moved.
+    A rewrite is kept if it lowers the cost, i.e. the number of errors on a set
+    of tests and the objective, or by chance depending on how much it raises it.
+    Every correct template better than the best one so far is verified and any
+    input it fails on is added to the tests. The search returns to the best template
+    after RESTART_ITERATIONS rewrites without finding a better one.
+
+    Parameters:
+        @param spec:        the semantics of the template
+        @param start:       the template to start from with absolute jumps
+        @param objective:   either steps or size
+        @param iterations:  the number of rewrites to try
+        @param bound:       the largest value of any register to verify with
+        @param random:      the source of randomness
+        @param temperature: how likely rewrites raising the cost are kept
+
+        @type spec:        Spec
+        @type start:       list
+        @type objective:   str
+        @type iterations:  int
+        @type bound:       int
+        @type random:      Random
+        @type temperature: float
+
+    @return: the best template found with absolute jumps
+    @rtype: list
+    """
+    tests = _inputs(spec, 2)
+    maxSteps = _max_steps(bound)
+
+    def score(code):
+        errors, steps = _errors(code, spec, tests, maxSteps)
+        steps /= len(tests)
+        return errors, (steps+len(code)/100 if objective == "steps" else len(code)+steps/100)
+
+    def randomInstruction(length):
+        return random.choice(_alphabet(spec, length))
+
+    def mutate(code):
+        code = list(code)
+        kind = random.randrange(6)
+        line = random.randrange(len(code))
+        if kind == 0:
+            code[line] = randomInstruction(len(code))
+        elif kind == 1:
+            opcode, operand = code[line]
+            if opcode == "JMP":
+                code[line] = (opcode, random.choice([operand for opcode, operand in _alphabet(spec, len(code))
+                                                     if opcode == "JMP"]))
+            else:
+                code[line] = (random.choice(["INC", "DEC", "TST"]), operand)
+        elif kind == 2:
+            other = random.randrange(len(code))
+            code[line], code[other] = code[other], code[line]
+        elif kind == 3 and len(code) > 1:
+            code.pop(line)
+            code = [(opcode, operand-1 if type(operand) == int and operand > line else operand)
+                    for opcode, operand in code]
+            # jumps behind the deleted line move up
+        elif kind == 4:
+            code = [(opcode, operand+1 if type(operand) == int and operand > line else operand)
+                    for opcode, operand in code]
+            code.insert(line, randomInstruction(len(code)+1))
+            # jumps behind the inserted line move down
+        elif kind == 5:
+            block = list(range(line, min(line+random.randint(1, 4), len(code))))
+            order = [old for old in range(len(code)) if old not in block]
+            other = random.randint(0, len(order))
+            order[other:other] = block
+            lines = dict((old, new) for new, old in enumerate(order))
+            lines[len(code)] = len(code)
+            code = [(opcode, lines[operand] if type(operand) == int else operand)
+                    for opcode, operand in (code[old] for old in order)]
+            # a block of instructions, such as a loop, is moved elsewhere
+            # and the jumps follow the lines they jumped to
+        return code
+
+    steps = _errors(start, spec, _inputs(spec, bound), maxSteps)[1]
+    best, bestValue = start, ((steps, len(start)) if objective == "steps" else (len(start), steps))
+    current = start
+    currentErrors, currentValue = score(current)
+    restart = 0
+    for i in range(iterations):
+        if i == restart+RESTART_ITERATIONS:
+            current, restart = best, i
+            currentErrors, currentValue = score(current)
+            # the search returns to the best template if it got lost
+        candidate = mutate(current)
+        if any(opcode == "JMP" and operand == line for line, (opcode, operand) in enumerate(candidate)):
+            continue
+        errors, value = score(candidate)
+        delta = errors-currentErrors+value-currentValue
+        if delta > 0 and random.random() >= exp(-delta/temperature):
+            continue
+        current, currentErrors, currentValue = candidate, errors, value
+        if errors:
+            continue
+        steps = _errors(candidate, spec, _inputs(spec, bound), maxSteps)[1]
+        candidateValue = (steps, len(candidate)) if objective == "steps" else (len(candidate), steps)
+        if candidateValue >= bestValue:
+            continue
+        if verify(candidate, spec, bound):
+            best, bestValue, restart = candidate, candidateValue, i
+        else:
+            for values in _inputs(spec, bound):
+                if _errors(candidate, spec, [values], maxSteps)[0] and values not in tests:
+                    tests.append(values)
+                    break
+            # the failing input is tested from now on
+            currentErrors, currentValue = score(current)
+    return best
+
+def _value(code: list, spec: Spec, objective: str, bound: int) -> tuple:
+    # return what to minimize for an objective, the steps for all inputs up to bound or the lines first
+    steps = _errors(code, spec, _inputs(spec, bound), _max_steps(bound))[1]
+    return (steps, len(code)) if objective == "steps" else (len(code), steps)
+
+def _optimize(name: str, objective: str, starts: list, chain: int, options: dict) -> tuple:
+    """
+    Search for a better template in one chain of rewrites and return it.
+
+    Parameters:
+        @param name:      the name of the template in SPECS
+        @param objective: either steps or size
+        @param starts:    the templates to start from in the format of the table
+        @param chain:     the number of the chain, the first one also enumerates templates
+        @param options:   the exhaustive length, iterations, bound and seed
+
+        @type name:      str
+        @type objective: str
+        @type starts:    list
+        @type chain:     int
+        @type options:   dict
+
+    @return: the name, the objective and the best template with absolute jumps
+    @rtype: tuple
+    """
+    spec = SPECS[name]
+    candidates = [_to_absolute(code) for code in starts]
+    if chain == 0:
+        shortest = searchExhaustive(spec, min(options["exhaustive"], min(map(len, candidates))-1), options["bound"])
+        if shortest is not None:
+            candidates.append(shortest)
+    random = Random("{}/{}/{}/{}".format(options["seed"], name, objective, chain))
+    for start in list(candidates):
+        candidates.append(searchStochastic(spec, start, objective, options["iterations"]//len(candidates),
+                                           options["bound"], random))
+    return name, objective, min(candidates, key=lambda code: _value(code, spec, objective, options["bound"]))
+
+def main():
+    """Parse command line arguments, optimize the templates and report or save the results."""
+    parser = argparse.ArgumentParser(description="Search for shorter and faster Bonsai code templates.")
+    parser.add_argument("--templates", metavar="NAME,...", default=",".join(SPECS),
+                        help="the templates to optimize, defaults to all of them")
+    parser.add_argument("--objectives", metavar="NAME,...", default=",".join(OBJECTIVES),
+                        help="optimize for the fewest steps, the fewest lines or both")
+    parser.add_argument("--exhaustive", metavar="N", type=int, default=4,
+                        help="the length up to which all templates are enumerated")
+    parser.add_argument("--iterations", metavar="N", type=int, default=100000,
+                        help="the number of random rewrites per template and chain")
+    parser.add_argument("--chains", metavar="N", type=int, default=4,
+                        help="the number of independent searches per template")
+    parser.add_argument("--bound", metavar="N", type=int, default=6, help="the largest register value to verify with")
+    parser.add_argument("--seed", metavar="N", type=int, default=0, help="the seed of the random rewrites")
+    parser.add_argument("--jobs", metavar="N", type=int, default=os.cpu_count(), help="the number of processes")
+    parser.add_argument("--write", action="store_true", help="save the improved templates in the table")
+    args = parser.parse_args()
+    with open(TEMPLATES_PATH, "r") as file:
+        table = json.load(file)
+    names = args.templates.split(",")
+    objectives = args.objectives.split(",")
+    for name in names:
+        if name not in SPECS:
+            parser.error("there is no template {}".format(name))
+    for objective in objectives:
+        if objective not in OBJECTIVES:
+            parser.error("there is no objective {}".format(objective))
+    options = {"exhaustive": args.exhaustive, "iterations": args.iterations, "bound": args.bound, "seed": args.seed}
+    jobs = [(name, objective, [table[start][name]["code"] for start in OBJECTIVES], chain, options)
+            for name in names for objective in objectives for chain in range(args.chains)]
+    # every chain starts from the templates for all objectives
+    with ProcessPoolExecutor(args.jobs) as executor:
+        results = list(executor.map(_optimize, *zip(*jobs)))
+    best = {}
+    for name, found, code in results:
+        if not verify(code, SPECS[name], 2*args.bound):
+            continue
+            # a larger bound rules out templates only correct for small values
+        for objective in objectives:
+            if ((name, objective) not in best or _value(code, SPECS[name], objective, args.bound) <
+                    _value(best[name, objective], SPECS[name], objective, args.bound)):
+                best[name, objective] = code
+                # a template found for one objective may also be the best one for another
+    print("{:<12} {:<6} {:>13}  {}".format("template", "goal", "lines", "steps"))
+    for (name, objective), code in best.items():
+        old = table[objective][name]
+        cost = measureCost(code, SPECS[name], args.bound)
+        print("{:<12} {:<6} {:>5} -> {:>3}  {}{}+{}".format(
+            name, objective, len(old["code"]), len(code), "~" if cost["approximate"] else "",
+            "+".join("{}*{}".format(factor, term) for term, factor in cost["terms"].items()), cost["constant"]))
+        table[objective][name] = {"code": _to_relative(code), "cost": cost}
+    if args.write:
+        with open(TEMPLATES_PATH, "w") as file:
+            json.dump(table, file, indent=4, sort_keys=True)
+            file.write("\n")
+
+if __name__ == "__main__":
+    main()
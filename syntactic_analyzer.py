@@ -25,6 +25,7 @@ class AST(object):
         root        - root node of the tree
         symbolTable - a table containing all used labels and registers
         registers   - the constant values for registers
+        line        - the source line new nodes are created for
 
     Methods:
         addBlock(type: str, value: str)/ - add a new child node and enter it
@@ -43,6 +44,8 @@ class AST(object):
         """@type: dict"""
         self.registers = []
         """@type: list"""
+        self.line = None
+        """@type: int"""
 
     def addBlock(self, *args):
         """
@@ -52,6 +55,8 @@ class AST(object):
         Add a new child node and enter it.
         """
         self.currentNode = self.currentNode.addChild(*args)
+        if self.currentNode.line is None:
+            self.currentNode.line = self.line
 
     def leaveBlock(self):
         """Go to the parent node."""
@@ -64,7 +69,9 @@ class AST(object):
 
         Add a new child node, but do not leave the parent.
         """
-        self.currentNode.addChild(*args)
+        node = self.currentNode.addChild(*args)
+        if node.line is None:
+            node.line = self.line
 
 class ASTNode(object):
 
@@ -80,6 +87,7 @@ class ASTNode(object):
         children   - an ordered list of all children of this node
         parent     - a reference to the immediate predecessor of this node
         decorators - a list of all decorators added by semantic analysis
+        line       - the source line this node was created for, starting at 0
 
     Methods:
         addChild(type: str, value: str)/ - adds a new child to this node
@@ -109,6 +117,8 @@ class ASTNode(object):
         """@type: list"""
         self.decorators = []
         """@type: list"""
+        self.line = None
+        """@type: int"""
 
     def addChild(self, *args):
         """
@@ -197,6 +207,8 @@ class PDA(object):
             # get the next state following the rules described in __init__'s docstring
             if next_state is not None:
                 self.current_state = next_state[0]
+                self.ast.line = token.line
+                # new nodes are attributed to the line of the current token
                 for fn in next_state[1]:
                     fn[0](self, token, *fn[1:])
                 # do all the additional processing
@@ -244,6 +256,66 @@ def _wrap_PB_STATES() -> dict:
         self.ast.currentNode.typ = typ
         self.ast.currentNode.val = token.val
 
+    def negate(self, token):
+        # insert a negation before the comparison currently being parsed
+        comparison = self.ast.currentNode.parent
+        condition = comparison.parent
+        condition.children.insert(condition.children.index(comparison), ASTNode(condition, "BOOLEAN_OPERATOR", token.val))
+
+    def buildCondition(self, token):
+        # turn the flat sequence of comparisons and boolean operators into a tree
+        # respecting the precedence of not over and over or
+        condition = self.ast.currentNode
+        disjunction = []
+        conjunction = []
+        negations = []
+        for node in condition.children + [ASTNode(None, "BOOLEAN_OPERATOR", "or")]:
+            if node.val == "not":
+                negations.append(node)
+            elif node.typ == "COMPARISON":
+                for negation in reversed(negations):
+                    negation.addChild(node)
+                    node = negation
+                negations = []
+                conjunction.append(node)
+            else:
+                if node.val == "or":
+                    disjunction.append(conjunction)
+                    conjunction = []
+        operands = []
+        for conjunction in disjunction:
+            if len(conjunction) == 1:
+                operands.append(conjunction[0])
+            else:
+                operands.append(ASTNode(None, "BOOLEAN_OPERATOR", "and"))
+                for node in conjunction:
+                    operands[-1].addChild(node)
+        root = operands[0]
+        if len(operands) > 1:
+            root = ASTNode(None, "BOOLEAN_OPERATOR", "or")
+            for node in operands:
+                root.addChild(node)
+        condition.typ = root.typ
+        condition.val = root.val
+        condition.children = []
+        for node in root.children:
+            condition.addChild(node)
+
+    def lastOperand(self):
+        # the operand added last, looking through a sign
+        node = self.ast.currentNode.children[-1]
+        return node.children[-1] if node.typ == "SIGN" else node
+
+    def wrapTerm(self, token):
+        operand = lastOperand(self)
+        parent = operand.parent
+        term = ASTNode(parent, "ARITHMETIC_OPERATOR", token.val)
+        parent.children[-1] = term
+        term.addChild(operand)
+
+    def addFactor(self, token, typ):
+        lastOperand(self).addChild(typ, token.val)
+
     return {
         # GENERAL SEQUENCE STUFF
         ("SEQUENCE", "NEW_LINE", None): ("SEQUENCE", [(push, "^")]),
@@ -275,6 +347,9 @@ def _wrap_PB_STATES() -> dict:
         ("ARITHMETIC_EXPRESSION_SIGN_NEGATIVE", None, "-"): ("ARITHMETIC_EXPRESSION", [(pop, ), (repeat, )]),
         ("ARITHMETIC_EXPRESSION_SIGN_NEGATIVE", "ARITHMETIC_OPERATOR", None): ("ARITHMETIC_EXPRESSION_SIGN_NEGATIVE", [(pushToken, )]),
         ("ARITHMETIC_EXPRESSION_COMPLETE", "ARITHMETIC_OPERATOR", None): ("ARITHMETIC_EXPRESSION", [(pushToken, )]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "MULTIPLICATIVE_OPERATOR", None): ("ARITHMETIC_EXPRESSION_FACTOR", [(wrapTerm, )]),
+        ("ARITHMETIC_EXPRESSION_FACTOR", "NUMBER", None): ("ARITHMETIC_EXPRESSION_COMPLETE", [(addFactor, "CONSTANT")]),
+        ("ARITHMETIC_EXPRESSION_FACTOR", "IDENTIFIER", None): ("ARITHMETIC_EXPRESSION_COMPLETE", [(addFactor, "REGISTER")]),
 
         # ASSIGNMENT
         ("SEQUENCE", "IDENTIFIER", None): ("ASSIGNMENT", [(addBlock, "ASSIGNMENT"), (addNode, "REGISTER")]),
@@ -295,21 +370,47 @@ def _wrap_PB_STATES() -> dict:
 
         # CONDITIONS
         ("ARITHMETIC_EXPRESSION_COMPLETE", "COMPARISON_OPERATOR", "COMPOUND_0"): ("ARITHMETIC_EXPRESSION", [(pop, ), (push, "COMPOUND_1"), (leaveBlock, ), (rewrite, "COMPARISON"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
-        ("ARITHMETIC_EXPRESSION_COMPLETE", "COLON", "COMPOUND_0"): ("SEQUENCE", [(pop, ), (push, "EXPECT_BLOCK"), (leaveBlock, ), (addNode, "CONSTANT", "0"), (leaveBlock, )]),
-        ("ARITHMETIC_EXPRESSION_COMPLETE", "COLON", "COMPOUND_1"): ("SEQUENCE", [(pop, ), (push, "EXPECT_BLOCK"), (leaveBlock, ), (leaveBlock, )]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "COLON", "COMPOUND_0"): ("SEQUENCE", [(pop, ), (push, "EXPECT_BLOCK"), (leaveBlock, ), (addNode, "CONSTANT", "0"), (leaveBlock, ), (buildCondition, ), (leaveBlock, )]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "COLON", "COMPOUND_1"): ("SEQUENCE", [(pop, ), (push, "EXPECT_BLOCK"), (leaveBlock, ), (leaveBlock, ), (buildCondition, ), (leaveBlock, )]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "AND", "COMPOUND_0"): ("ARITHMETIC_EXPRESSION", [(leaveBlock, ), (addNode, "CONSTANT", "0"), (leaveBlock, ), (addNode, "BOOLEAN_OPERATOR"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "AND", "COMPOUND_1"): ("ARITHMETIC_EXPRESSION", [(pop, ), (push, "COMPOUND_0"), (leaveBlock, ), (leaveBlock, ), (addNode, "BOOLEAN_OPERATOR"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "OR", "COMPOUND_0"): ("ARITHMETIC_EXPRESSION", [(leaveBlock, ), (addNode, "CONSTANT", "0"), (leaveBlock, ), (addNode, "BOOLEAN_OPERATOR"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "OR", "COMPOUND_1"): ("ARITHMETIC_EXPRESSION", [(pop, ), (push, "COMPOUND_0"), (leaveBlock, ), (leaveBlock, ), (addNode, "BOOLEAN_OPERATOR"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
+        ("ARITHMETIC_EXPRESSION", "NOT", "COMPOUND_0"): ("ARITHMETIC_EXPRESSION", [(negate, )]),
 
         # IF STATEMENT
-        ("SEQUENCE", "IF", "^"): ("ARITHMETIC_EXPRESSION", [(pop, ), (push, "IF"), (push, "COMPOUND_0"), (addBlock, "BRANCH"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
+        ("SEQUENCE", "IF", "^"): ("ARITHMETIC_EXPRESSION", [(pop, ), (push, "IF"), (push, "COMPOUND_0"), (addBlock, "BRANCH"), (addBlock, "CONDITION"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
         ("SEQUENCE", "ELSE", "IF"): ("ELSE", [(pop, ), (push, "END_BLOCK")]),
+        ("SEQUENCE", "ELIF", "IF"): ("ARITHMETIC_EXPRESSION", [(pop, ), (push, "END_BLOCK"), (addBlock, "BLOCK"), (push, "END_BLOCK"), (push, "IF"), (push, "COMPOUND_0"), (addBlock, "BRANCH"), (addBlock, "CONDITION"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
         ("ELSE", "COLON", None): ("SEQUENCE", [(push, "EXPECT_BLOCK")]),
-        ("SEQUENCE", None, "END_BLOCK"): ("SEQUENCE", [(pop, ), (repeat, ), (leaveBlock, )]),
-        ("SEQUENCE", None, "IF"): ("SEQUENCE", [(pop, ), (repeat, ), (addNode, "BLOCK"), (leaveBlock, )]),
+        ("SEQUENCE", None, "END_BLOCK"): ("END_OF_BLOCK", [(pop, ), (repeat, ), (leaveBlock, )]),
+        ("SEQUENCE", None, "IF"): ("END_OF_BLOCK", [(pop, ), (repeat, ), (addNode, "BLOCK"), (leaveBlock, )]),
+
+        # END OF BLOCK STATEMENT
+        ("END_OF_BLOCK", None, "END_BLOCK"): ("END_OF_BLOCK", [(pop, ), (repeat, ), (leaveBlock, )]),
+        ("END_OF_BLOCK", None, "#"): ("SEQUENCE", [(push, "^"), (repeat, )]),
+        ("END_OF_BLOCK", None, "INDENT"): ("SEQUENCE", [(push, "^"), (repeat, )]),
+
+        # WHILE LOOP
+        ("SEQUENCE", "WHILE", "^"): ("ARITHMETIC_EXPRESSION", [(pop, ), (push, "END_BLOCK"), (push, "COMPOUND_0"), (addBlock, "CONDITIONAL_LOOP"), (addBlock, "CONDITION"), (addBlock, "COMPARISON", ">"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
+
+        # FOR LOOP
+        ("SEQUENCE", "FOR", "^"): ("FOR", [(pop, ), (push, "END_BLOCK"), (addBlock, "COUNTED_LOOP")]),
+        ("FOR", "IDENTIFIER", None): ("FOR_IN", [(addNode, "LOOP_VARIABLE")]),
+        ("FOR_IN", "IN", None): ("FOR_RANGE", []),
+        ("FOR_RANGE", "RANGE", None): ("FOR_RANGE_OPEN", []),
+        ("FOR_RANGE_OPEN", "OPENING_PARENTHESIS", None): ("ARITHMETIC_EXPRESSION", [(push, "RANGE"), (addBlock, "ARITHMETIC_OPERATOR", "+")]),
+        ("ARITHMETIC_EXPRESSION_COMPLETE", "CLOSING_PARENTHESIS", "RANGE"): ("FOR_RANGE_CLOSE", [(pop, ), (leaveBlock, )]),
+        ("FOR_RANGE_CLOSE", "COLON", None): ("SEQUENCE", [(push, "EXPECT_BLOCK")]),
 
         # END OF FILE
         ("SEQUENCE", "EOF", "^"): ("SEQUENCE", [(pop, ), (repeat, )]),
         ("SEQUENCE", "EOF", "#"): ("EOF", [])
     }
 
+PB_STATES = _wrap_PB_STATES()
+"""the transition rules for parsing Python Bonsai, built once and only read by the PDAs"""
+
 def SyntacticAnalysis(tokens: list) -> AST:
     """
     Parse the given tokens and return an abstract syntax tree.
@@ -322,4 +423,4 @@ def SyntacticAnalysis(tokens: list) -> AST:
     @return: the abstract syntax tree representing the input stream
     @rtype: AST
     """
-    return PDA(tokens, "SEQUENCE", _wrap_PB_STATES(), ["EOF"], ["^"]).ast
\ No newline at end of file
+    return PDA(tokens, "SEQUENCE", PB_STATES, ["EOF"], ["^"]).ast
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""
+Tests of the compilation of conditions by Py2Bon.
+
+Programs are compiled at every level and run in the simulator; the results
+have to match those of Python.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compile import simulatePB
+from passes import LEVELS, PassManager
+
+class ShortCircuitTest(unittest.TestCase):
+
+    def assertResult(self, source: str, register: str, value: int):
+        for level in LEVELS:
+            with self.subTest(level=level):
+                simulator, results = simulatePB(source, passes=PassManager(level))
+                self.assertEqual(results[0][register], value)
+
+    def test_subtraction_after_false_comparison(self):
+        # a-b would drop below zero, but Python never evaluates it
+        self.assertResult("""a = 1
+b = 3
+c = 0
+d = 0
+r = 0
+if a+c >= b+d and a-b > 0:
+    r = 1
+else:
+    r = 2
+""", "r", 2)
+
+    def test_division_after_false_comparison(self):
+        # a//b would divide by zero, but Python never evaluates it
+        self.assertResult("""a = 5
+b = 0
+c = 0
+d = 0
+r = 0
+if b+c > d and a//b > 0:
+    r = 1
+else:
+    r = 2
+""", "r", 2)
+
+if __name__ == "__main__":
+    unittest.main()
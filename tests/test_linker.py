@@ -0,0 +1,47 @@
+"""
+Tests of the linker of Py2Bon.
+
+Objects are compiled separately, linked and run in the simulator; the results
+have to match those of the unoptimized objects.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compile import compileObjectPB
+from linker import link
+from passes import PassManager
+from simulator import Simulator
+
+LOOP = """a = 2
+b = 2
+r = 0
+k = 0
+while k < a+b:
+    label .back
+    k += 1
+    r += 1
+"""
+"""a loop with a loop invariant sum that another object jumps into"""
+
+REENTRY = """goto .back
+"""
+"""an object jumping into the loop of LOOP"""
+
+class LinkTest(unittest.TestCase):
+
+    def run_linked(self, sources: list, level: str) -> list:
+        objects = [compileObjectPB(source, passes=PassManager(level)) for source in sources]
+        return Simulator(link(objects)).run()
+
+    def test_jump_into_loop(self):
+        # the invariant a+b must not be hoisted in front of a loop another object enters
+        for level in ["0", "2", "3", "s"]:
+            with self.subTest(level=level):
+                self.assertEqual(self.run_linked([REENTRY, LOOP], level)[:4], [2, 2, 4, 4])
+
+if __name__ == "__main__":
+    unittest.main()